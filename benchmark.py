@@ -0,0 +1,624 @@
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import shlex
+import shutil
+import socket
+import tempfile
+import platform
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import fire
+import httpx
+
+from llama_stats import percentile
+
+# End to end benchmark: the launcher, N workers, fake_ollama.py and a
+# callback sink, on this box. Jobs go in through /upload-json, we time them
+# until their callback arrives.
+#
+#   python benchmark.py --jobs=500 --workers=2 --slots=4 --output=bench.json
+#   python benchmark.py --jobs=500 --workers=2 --slots=4 --baseline=bench.json
+#
+# Everything runs in a temporary DATA folder, the queue of the box is not
+# touched. The logs of every process are in <workdir>/logs, --keep keeps them.
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+
+# VALID_HOSTNAMES of the worker, it rejects the jobs of the other hosts
+HOSTNAME = "gputop-dev-machine-20240829-103727"
+
+VOCABULARY = (
+    "shares rose fell after quarterly results beat missed estimates analysts "
+    "expect margins revenue guidance demand chips cloud growth slowed dividend "
+    "buyback merger regulators approved lawsuit settlement outlook raised cut "
+    "inflation rates central bank yields oil prices supply chain retail sales "
+    "earnings call investors upgrade downgrade target price market volatility"
+).split()
+
+PS = (50, 90, 95, 99)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def summarize(values, ps=PS):
+    values = sorted(values)
+    stats = {"count": len(values)}
+    if values:
+        stats["mean"] = round(sum(values) / len(values), 4)
+        stats["max"] = round(values[-1], 4)
+
+    for p in ps:
+        value = percentile(values, p)
+        stats[f"p{p}"] = round(value, 4) if value is not None else None
+
+    return stats
+
+
+class CallbackSink:
+    """The callback_url of the jobs, records when every job came back."""
+
+    def __init__(self, port):
+        self.lock = threading.Lock()
+        self.arrivals = {}
+        self.posts = 0
+        self.batches = 0
+
+        sink = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                try:
+                    body = json.loads(self.rfile.read(length) or b"{}")
+                except ValueError:
+                    body = {}
+
+                answer = sink.receive(body)
+                data = json.dumps(answer).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def receive(self, body):
+        now = time.time()
+        items = body["batch"] if isinstance(body.get("batch"), list) else [body]
+
+        with self.lock:
+            self.posts += 1
+            if "batch" in body:
+                self.batches += 1
+
+            for item in items:
+                if isinstance(item, dict) and "id" in item:
+                    self.arrivals.setdefault(item["id"], now)
+
+        if "batch" in body:
+            return {"results": [{"ok": True} for _ in items]}
+
+        return {"status": "success"}
+
+    def received(self, ids):
+        with self.lock:
+            return sum(1 for job_id in ids if job_id in self.arrivals)
+
+    def stop(self):
+        self.server.shutdown()
+
+
+def read_proc(pid):
+    """Peak RSS, context switches, I/O syscalls and CPU time of a process."""
+    counters = {}
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in ("VmHWM", "VmRSS"):
+                    counters[key.lower() + "_kb"] = int(value.split()[0])
+                elif key in ("voluntary_ctxt_switches", "nonvoluntary_ctxt_switches"):
+                    counters[key] = int(value)
+
+        with open(f"/proc/{pid}/io") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                counters[key] = int(value)
+
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+            ticks = os.sysconf("SC_CLK_TCK")
+            counters["cpu_secs"] = round((int(fields[11]) + int(fields[12])) / ticks, 2)
+    except (OSError, ValueError, IndexError):
+        pass
+
+    return counters
+
+
+def process_tree(pid):
+    pids = [pid]
+    try:
+        for tid in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{tid}/children") as f:
+                for child in f.read().split():
+                    pids += process_tree(int(child))
+    except OSError:
+        pass
+
+    return pids
+
+
+class ProcessSampler:
+    """Keeps the last counters of every process of the run and its children,
+    so a process that exits before the end is still counted."""
+
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.roles = {}
+        self.last = {}
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+
+    def add(self, role, process):
+        self.roles[role] = process
+
+    def sample(self):
+        for role, process in self.roles.items():
+            for pid in process_tree(process.pid):
+                counters = read_proc(pid)
+                if counters:
+                    with self.lock:
+                        self.last[pid] = (role, counters)
+
+    def loop(self):
+        while not self.stop_event.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.sample()
+
+    def totals(self):
+        """Counters summed per role, and peak_rss_kb as the sum of the VmHWM."""
+        totals = {}
+        with self.lock:
+            for role, counters in self.last.values():
+                role = role.rstrip("0123456789").rstrip("_")
+                total = totals.setdefault(role, {"processes": 0})
+                total["processes"] += 1
+                for key, value in counters.items():
+                    if key == "vmrss_kb":
+                        continue
+
+                    key = "peak_rss_kb" if key == "vmhwm_kb" else key
+                    total[key] = round(total.get(key, 0) + value, 2)
+
+        return totals
+
+
+def spawn(workdir, name, args, env=None):
+    log = open(os.path.join(workdir, "logs", name + ".log"), "w")
+    return subprocess.Popen(
+        args,
+        cwd=workdir,
+        stdout=log,
+        stderr=subprocess.STDOUT,
+        env=dict(os.environ, **(env or {})),
+    )
+
+
+def stop(process, timeout=30):
+    if process.poll() is not None:
+        return
+
+    process.terminate()
+    try:
+        process.wait(timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def wait_for(url, timeout, check=None):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            response = httpx.get(url, timeout=5)
+            if response.status_code == 200 and (not check or check(response.json())):
+                return True
+        except (httpx.HTTPError, ValueError):
+            pass
+
+        time.sleep(0.25)
+
+    raise RuntimeError(f"{url} not ready after {timeout} seconds")
+
+
+def make_text(rng, size):
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(VOCABULARY)
+        words.append(word)
+        length += len(word) + 1
+
+    return " ".join(words).capitalize() + "."
+
+
+def make_jobs(run_id, jobs, types, size, corpus, callback, seed):
+    """Generated jobs, or the jobs of a JSON lines corpus, cycled to `jobs`."""
+    rng = random.Random(seed)
+
+    templates = []
+    if corpus:
+        with open(corpus) as f:
+            templates = [json.loads(line) for line in f if line.strip()]
+
+    if isinstance(types, str):
+        types = types.split(",")
+
+    made = []
+    for index in range(jobs):
+        if templates:
+            job = dict(templates[index % len(templates)])
+        elif types[index % len(types)] == "raw_llama":
+            job = {
+                "type": "raw_llama",
+                "subtype": "chat",
+                "raw_messages": [{"role": "user", "content": make_text(rng, size)}],
+            }
+        else:
+            job = {"type": "article", "article": make_text(rng, size)}
+
+        job.setdefault("type", "article")
+        job["id"] = f"BENCH_{run_id}_{index}"
+        job["callback_url"] = callback
+        job["hostname"] = HOSTNAME
+        made.append(job)
+
+    return made
+
+
+def upload(url, jobs, concurrency):
+    """POST every job to /upload-json, returns ({id: submit time}, latencies, errors)."""
+    submitted = {}
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    with httpx.Client(base_url=url, limits=limits, timeout=60) as client:
+
+        def send(job):
+            start = time.time()
+            try:
+                response = client.post("/upload-json", json=job)
+                ok = response.status_code == 200
+                error = None if ok else response.status_code
+            except httpx.HTTPError as e:
+                ok = False
+                error = type(e).__name__
+
+            with lock:
+                latencies.append(time.time() - start)
+                if ok:
+                    submitted[job["id"]] = start
+                else:
+                    errors.append(error)
+
+        with ThreadPoolExecutor(concurrency) as pool:
+            list(pool.map(send, jobs))
+
+    return submitted, latencies, errors
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=REPO,
+            capture_output=True,
+            text=True,
+            timeout=10,
+        ).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def compare(results, baseline_path):
+    """Relative change of the headline numbers against an older results file."""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+
+    def pick(data, path):
+        for key in path:
+            if not isinstance(data, dict):
+                return None
+            data = data.get(key)
+        return data
+
+    changes = {}
+    for name, path in {
+        "throughput_jobs_per_sec": ["throughput_jobs_per_sec"],
+        "upload_per_sec": ["upload", "per_sec"],
+        "e2e_p50": ["end_to_end_secs", "p50"],
+        "e2e_p95": ["end_to_end_secs", "p95"],
+        "worker_peak_rss_kb": ["processes", "worker", "peak_rss_kb"],
+        "launcher_peak_rss_kb": ["processes", "launcher", "peak_rss_kb"],
+    }.items():
+        old, new = pick(baseline, path), pick(results, path)
+        if old and new is not None:
+            changes[name] = {"baseline": old, "current": new, "change": round((new - old) / old, 4)}
+
+    return changes
+
+
+def main(
+    jobs: int = 200,
+    workers: int = 1,
+    slots: int = 4,
+    launcher: str = "asgi",
+    launcher_workers: int = 1,
+    concurrency: int = 16,
+    types: str = "article",
+    size: int = 2000,
+    corpus: str = None,
+    latency: float = 0.2,
+    tokens_per_sec: float = 50,
+    tokens: int = 64,
+    failure_rate: float = 0.0,
+    no_tool_rate: float = 0.0,
+    parallel: int = 0,
+    worker_args: str = "",
+    timeout: int = 600,
+    seed: int = 1,
+    output: str = None,
+    baseline: str = None,
+    workdir: str = None,
+    keep: bool = False,
+):
+    """Run the whole system on fake_ollama.py and write the results as JSON.
+
+    --jobs of --types (article, raw_llama, comma separated and cycled) with
+    --size characters of text, or the jobs of a JSON lines --corpus. Every
+    job gets a benchmark id, the callback sink and a valid hostname.
+
+    --workers worker daemons with --slots threads each, --worker_args are
+    added to their command line, like "--nocache --nodedup" to measure the
+    inference path only.
+
+    --launcher asgi (uvicorn with --launcher_workers) or flask, the uploads
+    are sent --concurrency at a time.
+
+    --latency, --tokens_per_sec, --tokens, --failure_rate, --no_tool_rate
+    and --parallel go to fake_ollama.py, see there.
+
+    Results go to --output (benchmark_<time>.json by default): throughput,
+    upload and end to end latency percentiles, the job and stage times the
+    workers recorded, and per process role the peak RSS, CPU seconds,
+    context switches and the /proc io counters (syscr and syscw are the
+    read and write syscalls). --baseline compares with an older results file.
+    """
+    run_id = uuid.uuid4().hex[:8]
+    workdir = workdir or tempfile.mkdtemp(prefix="llama_bench_")
+    os.makedirs(os.path.join(workdir, "logs"), exist_ok=True)
+    output = output or f"benchmark_{time.strftime('%Y%m%d_%H%M%S')}.json"
+
+    fake_port = free_port()
+    launcher_port = free_port()
+    sink_port = free_port()
+    launcher_url = f"http://127.0.0.1:{launcher_port}"
+    fake_url = f"http://127.0.0.1:{fake_port}"
+
+    print(f" BENCHMARK {run_id} IN {workdir}")
+
+    sink = CallbackSink(sink_port)
+    sampler = ProcessSampler()
+    processes = []
+    worker_processes = []
+
+    try:
+        fake = spawn(
+            workdir,
+            "fake_ollama",
+            [
+                sys.executable,
+                os.path.join(REPO, "fake_ollama.py"),
+                f"--port={fake_port}",
+                f"--latency={latency}",
+                f"--tokens_per_sec={tokens_per_sec}",
+                f"--tokens={tokens}",
+                f"--failure_rate={failure_rate}",
+                f"--no_tool_rate={no_tool_rate}",
+                f"--parallel={parallel}",
+                f"--seed={seed}",
+            ],
+        )
+        processes.append(fake)
+        sampler.add("fake_ollama", fake)
+
+        if launcher == "flask":
+            args = [
+                sys.executable, "-m", "flask",
+                "--app", os.path.join(REPO, "imgapi_llama_launcher.py"),
+                "run", "--port", str(launcher_port), "--with-threads",
+            ]
+        else:
+            args = [
+                sys.executable, "-m", "uvicorn", "imgapi_llama_asgi:app",
+                "--app-dir", REPO, "--port", str(launcher_port),
+                "--workers", str(launcher_workers), "--no-access-log", "--log-level", "warning",
+            ]
+
+        server = spawn(workdir, "launcher", args)
+        processes.append(server)
+        sampler.add("launcher", server)
+
+        wait_for(fake_url + "/api/version", 30)
+        wait_for(launcher_url + "/api_v1/count", 60)
+
+        for index in range(workers):
+            worker = spawn(
+                workdir,
+                f"worker_{index}",
+                [
+                    sys.executable,
+                    os.path.join(REPO, "llama_batch_process.py"),
+                    "localhost",
+                    str(launcher_port),
+                    "--daemon",
+                    f"--workers={slots}",
+                    f"--worker_id=bench-{run_id}-{index}",
+                    "--metrics_port=0",
+                ]
+                + shlex.split(worker_args),
+                env={"OLLAMA_HOST": fake_url},
+            )
+            processes.append(worker)
+            worker_processes.append(worker)
+            sampler.add(f"worker_{index}", worker)
+
+        # The daemons write their heartbeat once they are up
+        wait_for(launcher_url + "/api_v1/eta", 120, lambda data: data.get("workers", 0) >= workers)
+
+        sampler.start()
+
+        corpus_jobs = make_jobs(
+            run_id, jobs, types, size, corpus, f"http://127.0.0.1:{sink_port}/callback", seed
+        )
+
+        print(f" UPLOADING {len(corpus_jobs)} JOBS")
+        start = time.time()
+        submitted, upload_latencies, upload_errors = upload(launcher_url, corpus_jobs, concurrency)
+        upload_secs = time.time() - start
+
+        deadline = start + timeout
+        while time.time() < deadline:
+            done = sink.received(submitted)
+            if done >= len(submitted):
+                break
+
+            print(f" {done}/{len(submitted)} CALLBACKS", end="\r")
+            time.sleep(1)
+
+        print()
+        elapsed = time.time() - start
+        sampler.stop()
+
+        # They write their last job times when they stop
+        for worker in worker_processes:
+            stop(worker)
+
+        with sink.lock:
+            arrivals = {job_id: sink.arrivals[job_id] for job_id in submitted if job_id in sink.arrivals}
+
+        end_to_end = [arrivals[job_id] - submitted[job_id] for job_id in arrivals]
+        last = max(arrivals.values()) if arrivals else time.time()
+
+        try:
+            window = int(elapsed) + 60
+            job_times = httpx.get(f"{launcher_url}/api_v1/stats?window={window}", timeout=30).json()["stats"]
+        except (httpx.HTTPError, ValueError, KeyError):
+            job_times = None
+
+        try:
+            fake_stats = httpx.get(fake_url + "/fake/stats", timeout=10).json()
+        except (httpx.HTTPError, ValueError):
+            fake_stats = None
+
+        results = {
+            "run_id": run_id,
+            "revision": git_revision(),
+            "started": start,
+            "host": {
+                "python": platform.python_version(),
+                "cpus": os.cpu_count(),
+                "platform": platform.platform(),
+            },
+            "config": {
+                "jobs": jobs,
+                "workers": workers,
+                "slots": slots,
+                "launcher": launcher,
+                "launcher_workers": launcher_workers,
+                "concurrency": concurrency,
+                "types": types,
+                "size": size,
+                "corpus": corpus,
+                "latency": latency,
+                "tokens_per_sec": tokens_per_sec,
+                "tokens": tokens,
+                "failure_rate": failure_rate,
+                "no_tool_rate": no_tool_rate,
+                "parallel": parallel,
+                "worker_args": worker_args,
+                "seed": seed,
+            },
+            "completed": len(arrivals),
+            "missing": len(submitted) - len(arrivals),
+            "elapsed_secs": round(elapsed, 3),
+            "throughput_jobs_per_sec": round(len(arrivals) / max(last - start, 1e-6), 3),
+            "upload": dict(
+                summarize(upload_latencies),
+                per_sec=round(len(corpus_jobs) / max(upload_secs, 1e-6), 1),
+                secs=round(upload_secs, 3),
+                errors=len(upload_errors),
+            ),
+            "end_to_end_secs": summarize(end_to_end),
+            "job_times": job_times,
+            "callbacks": {"posts": sink.posts, "batches": sink.batches},
+            "fake_ollama": fake_stats,
+            "processes": sampler.totals(),
+        }
+
+    finally:
+        # Workers first, they finish their jobs and their callbacks
+        for process in reversed(processes):
+            stop(process)
+
+        sink.stop()
+
+        if not keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if baseline:
+        results["baseline"] = compare(results, baseline)
+
+    with open(output, "w") as f:
+        json.dump(results, f, indent=4)
+
+    print(
+        f" {results['completed']}/{jobs} JOBS IN {results['elapsed_secs']}s"
+        f" {results['throughput_jobs_per_sec']} JOBS/S"
+        f" E2E p50 {results['end_to_end_secs']['p50']}s p95 {results['end_to_end_secs']['p95']}s"
+    )
+    for name, change in results.get("baseline", {}).items():
+        print(f" {name:<26} {change['baseline']:>12} -> {change['current']:>12} {change['change']:+.1%}")
+
+    print(f" RESULTS IN {output}")
+    return None
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
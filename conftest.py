@@ -0,0 +1,11 @@
+import os
+import tempfile
+
+# The *_test.py files are scripts against a live Ollama, not tests
+collect_ignore_glob = ["*_test.py"]
+
+
+def pytest_configure(config):
+    # The modules make ./DATA and their SQLite files when they are imported,
+    # keep them out of the checkout
+    os.chdir(tempfile.mkdtemp(prefix="llama-tests-"))
@@ -0,0 +1,517 @@
+import json
+import time
+import random
+import threading
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import fire
+
+# Stand-in for Ollama, to run the worker and the launchers on a box without
+# a GPU. It speaks /api/chat and /api/generate (tools, format, streaming),
+# /api/ps, /api/tags and /api/version, and answers tool calls that are valid
+# for the schema of the tools in the request, so the article pipeline runs
+# to the end. Time to first token and token rate are simulated, and so are
+# the failures and the lazy answers without tool_calls.
+#
+#   python fake_ollama.py --port=11434 --tokens_per_sec=40 --failure_rate=0.01
+#   OLLAMA_HOST=http://127.0.0.1:11434 python llama_batch_process.py localhost 5111 --daemon
+#
+# GET /fake/stats has the counters, the benchmark reads them.
+
+TICKERS = ["AAPL", "MSFT", "NVDA", "INTC", "AMZN", "GOOGL", "TSLA", "AMD"]
+COMPANIES = ["Apple", "Microsoft", "Nvidia", "Intel", "Amazon", "Alphabet", "Tesla", "AMD"]
+WORDS = (
+    "the company said shares rose after results beat estimates while analysts "
+    "expect margins to improve next quarter as demand for chips stays strong"
+).split()
+
+# The schemas of the worker only give these ranges in the description
+INTEGER_RANGES = {
+    "interest_score": (0, 10),
+    "defcon_level": (1, 5),
+    "sentiment_score": (-10, 10),
+}
+
+
+def parse_keep_alive(keep_alive, default=300):
+    """Seconds, None to keep the model forever."""
+    if keep_alive is None:
+        return default
+
+    if isinstance(keep_alive, (int, float)):
+        return None if keep_alive < 0 else keep_alive
+
+    keep_alive = str(keep_alive).strip()
+    units = {"s": 1, "m": 60, "h": 3600}
+    if keep_alive[-1:] in units:
+        value = float(keep_alive[:-1])
+        return None if value < 0 else value * units[keep_alive[-1]]
+
+    value = float(keep_alive)
+    return None if value < 0 else value
+
+
+def timestamp(ts=None):
+    return datetime.fromtimestamp(ts or time.time(), timezone.utc).isoformat()
+
+
+class FakeOllama:
+    """The simulated model server, shared by the request threads.
+
+    A chat takes latency + prompt tokens / prompt_rate until the first token
+    (plus load_time if the model is not loaded), then tokens_per_sec. Every
+    time is multiplied by a random factor in 1 +- jitter. With parallel > 0
+    only that many requests generate at the same time, the others wait like
+    they do with OLLAMA_NUM_PARALLEL.
+    """
+
+    def __init__(
+        self,
+        latency=0.2,
+        prompt_rate=2000,
+        tokens_per_sec=50,
+        tokens=64,
+        jitter=0.1,
+        failure_rate=0.0,
+        no_tool_rate=0.0,
+        parallel=0,
+        load_time=0.0,
+        seed=None,
+    ):
+        self.latency = latency
+        self.prompt_rate = prompt_rate
+        self.tokens_per_sec = tokens_per_sec
+        self.tokens = tokens
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.no_tool_rate = no_tool_rate
+        self.load_time = load_time
+
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.slots = threading.Semaphore(parallel) if parallel else None
+
+        # model -> {"loaded": ts, "expires": ts or None}
+        self.loaded = {}
+
+        self.counters = {
+            "requests": 0,
+            "chat": 0,
+            "generate": 0,
+            "stream": 0,
+            "tool_calls": 0,
+            "no_tool_calls": 0,
+            "failures": 0,
+            "prompt_tokens": 0,
+            "eval_tokens": 0,
+            "active": 0,
+            "max_active": 0,
+        }
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def chance(self, rate):
+        with self.lock:
+            return self.random.random() < rate
+
+    def vary(self, seconds):
+        with self.lock:
+            factor = 1 + self.random.uniform(-self.jitter, self.jitter)
+
+        return max(0, seconds * factor)
+
+    def choice(self, values):
+        with self.lock:
+            return self.random.choice(values)
+
+    def randint(self, low, high):
+        with self.lock:
+            return self.random.randint(low, high)
+
+    def load(self, model, keep_alive):
+        """Seconds to load the model, 0 if it is loaded. Sets its expiry."""
+        now = time.time()
+        seconds = parse_keep_alive(keep_alive)
+
+        with self.lock:
+            state = self.loaded.get(model)
+            if state and state["expires"] is not None and state["expires"] < now:
+                state = None
+
+            load_seconds = 0 if state else self.load_time
+            if seconds == 0:
+                self.loaded.pop(model, None)
+            else:
+                self.loaded[model] = {
+                    "loaded": state["loaded"] if state else now,
+                    "expires": None if seconds is None else now + load_seconds + seconds,
+                }
+
+        return load_seconds
+
+    def running(self):
+        now = time.time()
+        models = []
+        with self.lock:
+            for model, state in list(self.loaded.items()):
+                if state["expires"] is not None and state["expires"] < now:
+                    del self.loaded[model]
+                    continue
+
+                expires = state["expires"] or now + 10 * 365 * 24 * 3600
+                models.append(
+                    {
+                        "name": model,
+                        "model": model,
+                        "size": 5 << 30,
+                        "digest": "0" * 64,
+                        "details": {"format": "gguf", "family": "fake"},
+                        "expires_at": timestamp(expires),
+                        "size_vram": 5 << 30,
+                    }
+                )
+
+        return models
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, loaded=sorted(self.loaded))
+
+    # Values for a JSON schema
+
+    def value(self, schema, name=""):
+        if not isinstance(schema, dict):
+            return self.text(4)
+
+        if "enum" in schema and schema["enum"]:
+            return self.choice(schema["enum"])
+
+        kind = schema.get("type", "string")
+        if isinstance(kind, list):
+            kind = next((k for k in kind if k != "null"), "string")
+
+        if kind == "object":
+            properties = schema.get("properties", {})
+            return {key: self.value(prop, key) for key, prop in properties.items()}
+
+        if kind == "array":
+            items = schema.get("items")
+            if items:
+                return [self.value(items, name) for _ in range(self.randint(1, 3))]
+
+            if "ticker" in name:
+                return [self.choice(TICKERS) for _ in range(self.randint(1, 3))]
+
+            if "compan" in name:
+                return [self.choice(COMPANIES) for _ in range(self.randint(1, 3))]
+
+            return [self.text(2) for _ in range(self.randint(1, 3))]
+
+        if kind in ("integer", "number"):
+            low, high = INTEGER_RANGES.get(name, (0, 10))
+            low = schema.get("minimum", low)
+            high = schema.get("maximum", high)
+            number = self.randint(int(low), int(high))
+            return number if kind == "integer" else float(number)
+
+        if kind == "boolean":
+            return self.chance(0.5)
+
+        if "ticker" in name:
+            return self.choice(TICKERS)
+
+        return self.text(12)
+
+    def text(self, words):
+        return " ".join(self.choice(WORDS) for _ in range(words))
+
+    def tool_calls(self, tools):
+        calls = []
+        for tool in tools:
+            function = tool.get("function", {})
+            calls.append(
+                {
+                    "function": {
+                        "name": function.get("name", "tool"),
+                        "arguments": self.value(function.get("parameters", {"type": "object"})),
+                    }
+                }
+            )
+
+        return calls
+
+    def answer(self, body, prompt_chars):
+        """(content, tool_calls, prompt tokens, completion tokens) of a request."""
+        tools = body.get("tools") or []
+        response_format = body.get("format")
+
+        # The tool schemas are part of the prompt
+        if tools:
+            prompt_chars += len(json.dumps(tools))
+
+        prompt_tokens = max(1, prompt_chars // 4)
+
+        if tools and not self.chance(self.no_tool_rate):
+            calls = self.tool_calls(tools)
+            self.count("tool_calls")
+            return "", calls, prompt_tokens, max(1, len(json.dumps(calls)) // 4)
+
+        if tools:
+            self.count("no_tool_calls")
+
+        if isinstance(response_format, dict):
+            content = json.dumps(self.value(response_format))
+            return content, None, prompt_tokens, max(1, len(content) // 4)
+
+        words = self.randint(max(1, self.tokens // 2), max(1, self.tokens * 3 // 2))
+        content = self.text(words)
+        if response_format == "json":
+            content = json.dumps({"response": content})
+
+        return content, None, prompt_tokens, words
+
+
+class FakeOllamaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "FakeOllama/0.1"
+    fake = None
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, data, code=200):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path == "/api/ps":
+            self.send_json({"models": self.fake.running()})
+        elif path == "/api/tags":
+            self.send_json({"models": self.fake.running()})
+        elif path == "/api/version":
+            self.send_json({"version": "0.0.0-fake"})
+        elif path == "/fake/stats":
+            self.send_json(self.fake.stats())
+        elif path == "/":
+            self.send_response(200)
+            self.send_header("Content-Length", "17")
+            self.end_headers()
+            self.wfile.write(b"Ollama is running")
+        else:
+            self.send_json({"error": "not found"}, 404)
+
+    def do_POST(self):
+        path = self.path.split("?")[0]
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self.send_json({"error": "invalid JSON"}, 400)
+            return
+
+        if path not in ("/api/chat", "/api/generate"):
+            self.send_json({"error": "not found"}, 404)
+            return
+
+        fake = self.fake
+        fake.count("requests")
+        fake.count("chat" if path == "/api/chat" else "generate")
+
+        if not body.get("model"):
+            self.send_json({"error": "model is required"}, 400)
+            return
+
+        if fake.chance(fake.failure_rate):
+            fake.count("failures")
+            self.send_json({"error": "fake failure"}, 500)
+            return
+
+        if fake.slots:
+            fake.slots.acquire()
+
+        with fake.lock:
+            fake.counters["active"] += 1
+            fake.counters["max_active"] = max(fake.counters["max_active"], fake.counters["active"])
+
+        try:
+            self.generate(path, body)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client went away, like the worker closing an aborted stream
+            pass
+        finally:
+            with fake.lock:
+                fake.counters["active"] -= 1
+
+            if fake.slots:
+                fake.slots.release()
+
+    def generate(self, path, body):
+        fake = self.fake
+        model = body["model"]
+        chat = path == "/api/chat"
+        start = time.time()
+
+        load_seconds = fake.load(model, body.get("keep_alive"))
+
+        if chat:
+            messages = body.get("messages") or []
+            prompt_chars = sum(len(str(m.get("content") or "")) for m in messages)
+        else:
+            prompt_chars = len(body.get("prompt") or "")
+
+            # An empty prompt only loads the model, the residency preload does that
+            if not prompt_chars:
+                time.sleep(load_seconds)
+                self.send_json(
+                    {
+                        "model": model,
+                        "created_at": timestamp(),
+                        "response": "",
+                        "done": True,
+                        "done_reason": "unload" if body.get("keep_alive") == 0 else "load",
+                    }
+                )
+                return
+
+        content, tool_calls, prompt_tokens, eval_tokens = fake.answer(body, prompt_chars)
+        fake.count("prompt_tokens", prompt_tokens)
+        fake.count("eval_tokens", eval_tokens)
+
+        prompt_seconds = fake.vary(fake.latency + prompt_tokens / fake.prompt_rate)
+        eval_seconds = fake.vary(eval_tokens / fake.tokens_per_sec)
+
+        time.sleep(load_seconds + prompt_seconds)
+
+        def final(**fields):
+            data = {
+                "model": model,
+                "created_at": timestamp(),
+                "done": True,
+                "done_reason": "stop",
+                "total_duration": int((time.time() - start) * 1e9),
+                "load_duration": int(load_seconds * 1e9),
+                "prompt_eval_count": prompt_tokens,
+                "prompt_eval_duration": int(prompt_seconds * 1e9),
+                "eval_count": eval_tokens,
+                "eval_duration": int(max(eval_seconds, 1e-3) * 1e9),
+            }
+            data.update(fields)
+            return data
+
+        def message(text, calls=None):
+            msg = {"role": "assistant", "content": text}
+            if calls:
+                msg["tool_calls"] = calls
+            return {"message": msg} if chat else {"response": text}
+
+        # Ollama streams unless told not to
+        if not body.get("stream", True):
+            time.sleep(eval_seconds)
+            self.send_json(final(**message(content, tool_calls)))
+            return
+
+        fake.count("stream")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def chunk(data):
+            line = (json.dumps(data) + "\n").encode("utf-8")
+            self.wfile.write(f"{len(line):x}\r\n".encode() + line + b"\r\n")
+            self.wfile.flush()
+
+        if tool_calls:
+            # Tool calls come whole in one chunk
+            time.sleep(eval_seconds)
+            chunk(dict(model=model, created_at=timestamp(), done=False, **message("", tool_calls)))
+        else:
+            words = content.split(" ")
+            delay = eval_seconds / max(1, len(words))
+            for index, word in enumerate(words):
+                time.sleep(delay)
+                text = word if index == 0 else " " + word
+                chunk(dict(model=model, created_at=timestamp(), done=False, **message(text)))
+
+        chunk(final(**message("")))
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+
+def serve(fake=None, port=11434, host="127.0.0.1"):
+    """Serve the fake on a daemon thread, returns the server."""
+    handler = type("Handler", (FakeOllamaHandler,), {"fake": fake or FakeOllama()})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main(
+    port: int = 11434,
+    host: str = "127.0.0.1",
+    latency: float = 0.2,
+    prompt_rate: float = 2000,
+    tokens_per_sec: float = 50,
+    tokens: int = 64,
+    jitter: float = 0.1,
+    failure_rate: float = 0.0,
+    no_tool_rate: float = 0.0,
+    parallel: int = 0,
+    load_time: float = 0.0,
+    seed: int = None,
+):
+    """Run the fake Ollama server until Ctrl-C.
+
+    --latency seconds before the first token, plus the prompt evaluation at
+    --prompt_rate tokens per second (4 characters a token).
+
+    --tokens_per_sec and --tokens, the generation speed and the average
+    length of a text answer. Tool calls are as long as their JSON.
+
+    --jitter, every time is multiplied by a random factor in 1 +- jitter.
+
+    --failure_rate, share of the requests answered with a 500.
+    --no_tool_rate, share of the requests with tools answered with text, the
+    lazy answers the worker retries on the fallback model.
+
+    --parallel, requests generated at the same time, the others wait. 0 is
+    no limit.
+
+    --load_time, seconds to load a model that is not loaded (see /api/ps and
+    keep_alive).
+
+    --seed makes the answers and the failures the same on every run.
+    """
+    fake = FakeOllama(
+        latency,
+        prompt_rate,
+        tokens_per_sec,
+        tokens,
+        jitter,
+        failure_rate,
+        no_tool_rate,
+        parallel,
+        load_time,
+        seed,
+    )
+    server = serve(fake, port, host)
+    print(f" FAKE OLLAMA ON http://{host}:{port}")
+
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
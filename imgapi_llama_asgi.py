@@ -0,0 +1,187 @@
+import json
+import time
+import zlib
+import asyncio
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+
+from llama_ingest import (
+    BULK_MAX_JOBS,
+    BULK_MAX_BYTES,
+    BodyTooLarge,
+    decompress_body,
+    parse_bulk_jobs,
+    queue_listing,
+    queue_count,
+    queue_eta,
+    invalidate,
+    save_job,
+    save_bulk,
+    job_stats,
+    job_status,
+    job_state,
+    job_changed,
+    sse_event,
+    JobWatcher,
+    POLL_INTERVAL,
+    LONG_POLL_MAX,
+    EVENTS_MAX,
+    EVENTS_PING,
+)
+
+# ASGI version of imgapi_llama_launcher.py, same routes and same answers.
+# The event loop only parses requests, the file writes, the folder scans and
+# the queue index run on the thread pool. Serve it with run_asgi.sh:
+#
+#   uvicorn imgapi_llama_asgi:app --host 0.0.0.0 --port 5111 --workers 4
+
+app = FastAPI(title="img-api-llama", docs_url=None, redoc_url=None)
+
+
+@app.get("/api_v1/")
+async def hello(page: str = "0", per_page: str = "100"):
+    try:
+        page = int(page)
+        per_page = min(int(per_page), 1000)
+    except ValueError:
+        return JSONResponse({"status": "error", "message": "Invalid page parameters"}, 400)
+
+    return JSONResponse(await run_in_threadpool(queue_listing, page, per_page))
+
+
+@app.get("/api_v1/count")
+async def hello_count():
+    return JSONResponse(await run_in_threadpool(queue_count))
+
+
+@app.get("/api_v1/eta")
+async def api_eta():
+    return JSONResponse(dict(await run_in_threadpool(queue_eta), status="success"))
+
+
+@app.get("/api_v1/stats")
+async def api_stats(window: str = "3600"):
+    try:
+        window = int(window)
+    except ValueError:
+        return JSONResponse({"status": "error", "message": "Invalid window parameter"}, 400)
+
+    return JSONResponse(await run_in_threadpool(job_stats, window))
+
+
+@app.get("/api_v1/invalidate/{hours}")
+async def api_invalidate_files(hours: str):
+    try:
+        # Convert hours to an integer
+        hours = int(hours)
+    except ValueError:
+        return JSONResponse({"status": "error", "message": "Invalid hours parameter"}, 400)
+
+    try:
+        return JSONResponse(await run_in_threadpool(invalidate, hours))
+    except Exception as e:
+        return JSONResponse({"status": "error", "message": str(e)}, 500)
+
+
+@app.post("/upload-json")
+@app.post("/api_v1/upload-json")
+async def upload_json(request: Request):
+    # Same check as flask request.is_json
+    content_type = request.headers.get("content-type", "").split(";")[0].strip()
+    if not (content_type == "application/json" or content_type.endswith("+json")):
+        return JSONResponse({"error": "Invalid JSON format"}, 400)
+
+    try:
+        data = json.loads(await request.body())
+
+        if "id" not in data:
+            return JSONResponse({"error": "Invalid JSON format"}, 400)
+
+        return JSONResponse(await run_in_threadpool(save_job, data))
+    except Exception as e:
+        return JSONResponse({"error": str(e)}, 400)
+
+
+def read_bulk(body, content_encoding):
+    return parse_bulk_jobs(decompress_body(body, content_encoding))
+
+
+@app.post("/upload-bulk")
+@app.post("/api_v1/upload-bulk")
+async def upload_bulk(request: Request):
+    """Queue many jobs in one request, see imgapi_llama_launcher.upload_bulk"""
+    if int(request.headers.get("content-length") or 0) > BULK_MAX_BYTES:
+        return JSONResponse(
+            {"status": "error", "message": f"Body larger than {BULK_MAX_BYTES} bytes"}, 413
+        )
+
+    body = await request.body()
+
+    try:
+        jobs = await run_in_threadpool(read_bulk, body, request.headers.get("content-encoding"))
+    except BodyTooLarge as e:
+        return JSONResponse({"status": "error", "message": str(e)}, 413)
+    except (ValueError, zlib.error) as e:
+        return JSONResponse({"status": "error", "message": str(e)}, 400)
+
+    if len(jobs) > BULK_MAX_JOBS:
+        return JSONResponse(
+            {"status": "error", "message": f"More than {BULK_MAX_JOBS} jobs"}, 413
+        )
+
+    return JSONResponse(await run_in_threadpool(save_bulk, jobs))
+
+
+@app.get("/api_v1/jobs/{job_id}")
+async def api_job_status(job_id: str, wait: str = "0", since: str = None):
+    """Same as imgapi_llama_launcher.api_job_status, the wait doesn't hold a thread."""
+    try:
+        wait = float(wait)
+    except ValueError:
+        return JSONResponse({"status": "error", "message": "Invalid wait parameter"}, 400)
+
+    deadline = time.time() + min(wait, LONG_POLL_MAX)
+
+    state = await run_in_threadpool(job_state, job_id)
+    while not job_changed(state, since) and time.time() < deadline:
+        await asyncio.sleep(POLL_INTERVAL)
+        state = await run_in_threadpool(job_state, job_id)
+
+    status = await run_in_threadpool(job_status, job_id)
+
+    if not status:
+        return JSONResponse({"status": "error", "message": "Unknown job"}, 404)
+
+    return JSONResponse(dict(status, status="success"))
+
+
+async def job_events(job_id):
+    watcher = JobWatcher(job_id)
+    start = last_sent = time.time()
+
+    while time.time() - start < EVENTS_MAX:
+        for event, data in await run_in_threadpool(watcher.poll):
+            yield sse_event(event, data)
+            last_sent = time.time()
+
+        if watcher.finished:
+            return
+
+        # Keeps the proxies from closing an idle stream
+        if time.time() - last_sent >= EVENTS_PING:
+            yield ": ping\n\n"
+            last_sent = time.time()
+
+        await asyncio.sleep(POLL_INTERVAL)
+
+
+@app.get("/api_v1/jobs/{job_id}/events")
+async def api_job_events(job_id: str):
+    """Server-Sent Events of a job, its state changes and its partial answer."""
+    return StreamingResponse(
+        job_events(job_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
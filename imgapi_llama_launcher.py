@@ -1,10 +1,24 @@
-import os
-import json
-from flask import Flask, request, jsonify
-from datetime import datetime, timedelta
-
-# Load the configuration file from the environment variable
-FLASK_CONFIG_PATH = os.environ.get("FLASK_CONFIG_PATH", "config.json")
+import zlib
+from flask import Flask, Response, request, jsonify
+
+# The queue logic is shared with the ASGI launcher (imgapi_llama_asgi.py)
+from llama_ingest import (
+    FLASK_CONFIG_PATH,
+    BULK_MAX_JOBS,
+    BULK_MAX_BYTES,
+    BodyTooLarge,
+    decompress_body,
+    parse_bulk_jobs,
+    queue_listing,
+    queue_count,
+    queue_eta,
+    invalidate,
+    save_job,
+    save_bulk,
+    wait_job_status,
+    job_events,
+    job_stats,
+)
 
 
 app = Flask(__name__)
@@ -12,117 +26,47 @@ app = Flask(__name__)
 app.config.from_json(FLASK_CONFIG_PATH)
 
 
-def create_folder(folder_path):
-    if not os.path.exists(folder_path):
-        os.makedirs(folder_path)
-
-    return folder_path
-
-
-SAVE_FOLDER = create_folder(app.config.get("SAVE_FOLDER", "./DATA/JSON_TO_PROCESS"))
-PRIORITY_FOLDER = create_folder(app.config.get("PRIORITY_FOLDER", "./DATA/JSON_TO_PROCESS_PRIORITY"))
-USER_PROMPT_FOLDER = create_folder(app.config.get("USER_PROMPT_FOLDER", "./DATA/JSON_TO_PROCESS_USER_PROMPT"))
-
-
-def invalidate_files(folder_path, cutoff_date):
-    """
-    Invalidates all files in a folder older than the given cutoff date by deleting them.
-
-    Args:
-        folder_path (str): Path to the folder containing files to check.
-        cutoff_date (datetime): Date before which files should be invalidated (deleted).
-
-    Returns:
-        list: A list of file paths that were deleted.
-    """
-    if not os.path.exists(folder_path):
-        raise ValueError(f"Folder '{folder_path}' does not exist.")
-
-    if not os.path.isdir(folder_path):
-        raise ValueError(f"Path '{folder_path}' is not a directory.")
-
-    deleted_files = []
-
-    # Iterate over all files in the folder
-    for filename in os.listdir(folder_path):
-        file_path = os.path.join(folder_path, filename)
-
-        # Only process files (not directories)
-        if os.path.isfile(file_path):
-            # Get the last modification time of the file
-            file_mod_time = datetime.fromtimestamp(os.path.getmtime(file_path))
-
-            # Check if the file is older than the cutoff date
-            if file_mod_time < cutoff_date:
-                os.remove(file_path)  # Delete the file
-                deleted_files.append(file_path)
-
-    return deleted_files
-
-
-def get_files_and_dates_sorted(folder_path):
-    files_info = []
-    for dirpath, dirnames, filenames in os.walk(folder_path):
-        for file in filenames:
-            file_path = os.path.join(dirpath, file)
-            if os.path.isfile(file_path):
-                # Get the last modification date
-                mod_time = os.path.getmtime(file_path)
-                files_info.append(
-                    (file_path, mod_time)
-                )  # Store the timestamp for sorting
-
-    # Sort by modification time
-    files_info.sort(key=lambda x: x[1])  # Sort by timestamp
-    # Convert the timestamp back to a readable date
-    sorted_files = [
-        (file, datetime.fromtimestamp(mod_time).strftime("%Y-%m-%d %H:%M:%S"))
-        for file, mod_time in files_info
-    ]
-    return sorted_files
-
-
-def count_files_in_folder(folder_path):
-    file_count = 0
-    for dirpath, dirnames, filenames in os.walk(folder_path):
-        file_count += len(filenames)
-    return file_count
-
-
 @app.route("/api_v1/")
 def hello():
+    try:
+        page = int(request.args.get("page", 0))
+        per_page = min(int(request.args.get("per_page", 100)), 1000)
+    except ValueError:
+        return jsonify({"status": "error", "message": "Invalid page parameters"}), 400
+
     return (
-        jsonify(
-            {
-                "process": get_files_and_dates_sorted(SAVE_FOLDER),
-                "priority": get_files_and_dates_sorted(PRIORITY_FOLDER),
-                "status": "success",
-            }
-        ),
+        jsonify(queue_listing(page, per_page)),
         200,
     )
 
 
 @app.route("/api_v1/count")
 def hello_count():
+    return (
+        jsonify(queue_count()),
+        200,
+    )
 
-    ret = {
-        "process": count_files_in_folder(SAVE_FOLDER),
-        "priority": count_files_in_folder(PRIORITY_FOLDER),
-        "status": "success",
-    }
-    try:
-        stats_file = ".stats.json"
-        if os.path.isfile(stats_file):
-            with open(stats_file, "r") as f:
-                data = json.load(f)
-                ret['queue_hours_estimate'] = round(((ret['process'] + ret['priority']) * data['average_time']) / (60*60), 2)
 
-    except Exception as e:
-        print(" CRASHED ")
+@app.route("/api_v1/eta")
+def api_eta():
+    """Drain time of the queue, p50 and p90, with the job classes in it."""
+    return (
+        jsonify(dict(queue_eta(), status="success")),
+        200,
+    )
+
+
+@app.route("/api_v1/stats")
+def api_stats():
+    """Count, mean, EWMA and percentiles of the job times, ?window=3600 seconds."""
+    try:
+        window = int(request.args.get("window", 3600))
+    except ValueError:
+        return jsonify({"status": "error", "message": "Invalid window parameter"}), 400
 
     return (
-        jsonify(ret),
+        jsonify(job_stats(window)),
         200,
     )
 
@@ -132,27 +76,18 @@ def api_invalidate_files(hours):
     try:
         # Convert hours to an integer
         hours = int(hours)
-        cutoff = datetime.now() - timedelta(hours=hours)
     except ValueError:
         return jsonify({"status": "error", "message": "Invalid hours parameter"}), 400
 
-    invalidate_files(SAVE_FOLDER, cutoff)
-    invalidate_files(PRIORITY_FOLDER, cutoff)
-
     try:
         return (
-            jsonify(
-                {
-                    "process": count_files_in_folder(SAVE_FOLDER),
-                    "priority": count_files_in_folder(PRIORITY_FOLDER),
-                    "status": "success",
-                }
-            ),
+            jsonify(invalidate(hours)),
             200,
         )
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
+
 # Route to handle file upload
 @app.route("/upload-json", methods=["POST"])
 @app.route("/api_v1/upload-json", methods=["POST"])
@@ -166,39 +101,8 @@ def upload_json():
             if "id" not in data:
                 return jsonify({"error": "Invalid JSON format"}), 400
 
-            folder = SAVE_FOLDER
-            if "priority" in data:
-                print(" FOUND PRIORITY FILE ")
-                folder = PRIORITY_FOLDER
-
-            # for chats
-            if data["type"] == "user_prompt":
-                folder = USER_PROMPT_FOLDER
-
-            # Define the filename
-
-            fn = data["id"] + "_data.json"
-
-            if "prefix" in data:
-                fn = data["prefix"] + "_" + fn
-
-            filename = clean_path(fn, folder)
-            print(" SAVING " + filename)
-
-            # Save the JSON data to a file
-            with open(filename, "w") as json_file:
-                json.dump(data, json_file, indent=4)
-
-            total_files = count_files_in_folder(folder)
-            files_folder = get_files_and_dates_sorted(folder)
             return (
-                jsonify(
-                    {
-                        "queue_size": total_files,
-                        "files_folder": files_folder,
-                        "status": "success",
-                    }
-                ),
+                jsonify(save_job(data)),
                 200,
             )
         except Exception as e:
@@ -207,16 +111,65 @@ def upload_json():
         return jsonify({"error": "Invalid JSON format"}), 400
 
 
-def clean_path(input_path, base_folder):
-    # Remove invalid characters
-    safe_path = os.path.normpath(input_path)  # Normalize the path
-    safe_path = os.path.basename(safe_path)  # Strip to the file name
+@app.route("/upload-bulk", methods=["POST"])
+@app.route("/api_v1/upload-bulk", methods=["POST"])
+def upload_bulk():
+    """Queue many jobs in one request.
 
-    # Join with base folder and ensure it stays within it
-    absolute_base = os.path.abspath(base_folder)
-    cleaned_path = os.path.abspath(os.path.join(absolute_base, safe_path))
+    The body is a JSON array of jobs or NDJSON (one job per line), gzip
+    compressed or not. Every job is checked and routed like /upload-json,
+    the answer has the status of every item in the order they came.
+    """
+    if (request.content_length or 0) > BULK_MAX_BYTES:
+        return (
+            jsonify({"status": "error", "message": f"Body larger than {BULK_MAX_BYTES} bytes"}),
+            413,
+        )
 
-    if not cleaned_path.startswith(absolute_base):
-        raise ValueError("Invalid path: Attempt to escape base folder")
+    try:
+        body = decompress_body(request.get_data(), request.headers.get("Content-Encoding"))
+        jobs = parse_bulk_jobs(body)
+    except BodyTooLarge as e:
+        return jsonify({"status": "error", "message": str(e)}), 413
+    except (ValueError, zlib.error) as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    if len(jobs) > BULK_MAX_JOBS:
+        return (
+            jsonify({"status": "error", "message": f"More than {BULK_MAX_JOBS} jobs"}),
+            413,
+        )
+
+    return (
+        jsonify(save_bulk(jobs)),
+        200,
+    )
+
+
+@app.route("/api_v1/jobs/<job_id>")
+def api_job_status(job_id):
+    """State of a job: queued, processing, done, failed, timeout, rejected or removed.
 
-    return cleaned_path
+    ?wait=30 long-polls until the job is final, or until its state is not
+    ?since=<state> anymore. A done job has its result.
+    """
+    try:
+        wait = float(request.args.get("wait", 0))
+    except ValueError:
+        return jsonify({"status": "error", "message": "Invalid wait parameter"}), 400
+
+    status = wait_job_status(job_id, request.args.get("since"), wait)
+    if not status:
+        return jsonify({"status": "error", "message": "Unknown job"}), 404
+
+    return jsonify(dict(status, status="success")), 200
+
+
+@app.route("/api_v1/jobs/<job_id>/events")
+def api_job_events(job_id):
+    """Server-Sent Events of a job, its state changes and its partial answer."""
+    return Response(
+        job_events(job_id),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
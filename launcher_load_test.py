@@ -0,0 +1,127 @@
+import time
+import uuid
+import json
+import asyncio
+
+import fire
+import httpx
+
+# Load test of the launchers, to compare the Flask and the ASGI one:
+#
+#   ./run.sh                                      (flask on 5111)
+#   LAUNCHER_PORT=5112 ./run_asgi.sh              (uvicorn on 5112)
+#   python launcher_load_test.py --urls=http://127.0.0.1:5111,http://127.0.0.1:5112
+#
+# Every URL gets the same number of uploads and count calls at the same
+# concurrency, the uploads have their own prefix so they can be cleaned up
+# with /api_v1/invalidate or by hand. Both launchers must use the same DATA.
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def make_job(run_id, index, size):
+    return {
+        "id": f"LOADTEST_{run_id}_{index}",
+        "type": "article",
+        "prefix": "9",
+        "article": "Load test article. " * (size // 19 + 1),
+    }
+
+
+async def hit(client, method, path, latencies, errors, **kwargs):
+    start = time.perf_counter()
+    try:
+        response = await client.request(method, path, **kwargs)
+        if response.status_code != 200:
+            errors.append(response.status_code)
+    except httpx.HTTPError as e:
+        errors.append(type(e).__name__)
+
+    latencies.append(time.perf_counter() - start)
+
+
+async def run_phase(url, name, make_request, requests, concurrency):
+    latencies = []
+    errors = []
+    queue = asyncio.Queue()
+    for index in range(requests):
+        queue.put_nowait(index)
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60) as client:
+
+        async def consumer():
+            while not queue.empty():
+                index = queue.get_nowait()
+                method, path, kwargs = make_request(index)
+                await hit(client, method, path, latencies, errors, **kwargs)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[consumer() for _ in range(concurrency)])
+        elapsed = time.perf_counter() - start
+
+    return {
+        "url": url,
+        "phase": name,
+        "requests": requests,
+        "errors": len(errors),
+        "rps": round(requests / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+    }
+
+
+async def run_url(url, requests, concurrency, size):
+    run_id = uuid.uuid4().hex[:8]
+
+    def upload(index):
+        return "POST", "/api_v1/upload-json", {"json": make_job(run_id, index, size)}
+
+    def count(index):
+        return "GET", "/api_v1/count", {}
+
+    def listing(index):
+        return "GET", "/api_v1/?per_page=100", {}
+
+    results = []
+    for name, make_request in (("upload-json", upload), ("count", count), ("listing", listing)):
+        results.append(await run_phase(url, name, make_request, requests, concurrency))
+
+    return results
+
+
+def main(urls="http://127.0.0.1:5111", requests=2000, concurrency=32, size=4000, output=None):
+    """Compare the launchers listening on urls (comma separated).
+
+    requests: requests per phase and URL.
+    concurrency: requests in flight.
+    size: characters of the article of every upload.
+    output: write the results as JSON to this file too.
+    """
+    if isinstance(urls, str):
+        urls = urls.split(",")
+
+    results = []
+    for url in urls:
+        results += asyncio.run(run_url(url, requests, concurrency, size))
+
+    print(f"{'url':32} {'phase':12} {'rps':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for r in results:
+        print(
+            f"{r['url']:32} {r['phase']:12} {r['rps']:9} {r['p50_ms']:8} {r['p95_ms']:8} {r['p99_ms']:8} {r['errors']:7}"
+        )
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
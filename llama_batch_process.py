@@ -1,8 +1,8 @@
 import re
 import os
-import ast
 import json
 import asyncio
+import hashlib
 import threading
 
 import fire
@@ -14,8 +14,8 @@ import time
 import signal
 
 from datetime import datetime
-from colorama import Fore, Back, Style, init
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
 from rich.console import Console
 from rich.markdown import Markdown
@@ -24,74 +24,98 @@ console = Console()
 warnings.filterwarnings("ignore", category=urllib3.exceptions.InsecureRequestWarning)
 http = urllib3.PoolManager()
 
-init(autoreset=True)
+from llama_utils import (
+    print_w,
+    print_b,
+    print_g,
+    print_r,
+    print_h,
+    print_e,
+    print_json,
+    print_exception,
+    json_serialize_toolcall,
+)
 
 NUM_CTX = 55000
 MODEL = "llama3.1"
 VALID_HOSTNAMES = ["gputop-dev-machine-20240829-103727"]
 
-BEXIT = False
-
-
-def word_count(text):
-    # Split the text into words and normalize to lowercase
-    words = text.lower().split()
-    # Count occurrences of each word
-    word_counts = Counter(words)
-    return word_counts
+# Jobs can override MODEL and NUM_CTX, the override only lasts for the job
+DEFAULT_NUM_CTX = NUM_CTX
+DEFAULT_MODEL = MODEL
 
+# Size num_ctx to the prompt, jobs that set num_ctx keep it
+ADAPTIVE_NUM_CTX = True
+NUM_CTX_BUCKETS = None
 
-def print_w(text):
-    print(Fore.LIGHTWHITE_EX + text)
+# Batch queued jobs by (model, num_ctx), see --affinity
+SCHEDULER = None
 
+# Index of the queue folders, see llama_queue
+QUEUE = None
 
-def print_b(text):
-    print(Fore.LIGHTBLUE_EX + text)
+# Jobs this worker claimed, dead workers' jobs go back to the queue
+LEASES = None
 
+# Results of previous LLM calls, see llama_cache
+CACHE = None
 
-def print_g(text, in_place=False):
-    print(Fore.GREEN + text, end="\r" if in_place else "\n", flush=in_place)
+# Recent articles, close rewrites reuse the enrichment, see llama_dedup
+DEDUP = None
 
+# Strips the feeds' junk out of the articles, see llama_boilerplate
+BOILERPLATE = None
 
-def print_r(text, in_place=False):
-    print(Fore.RED + text, end="\r" if in_place else "\n", flush=in_place)
+# Callbacks are sent by the delivery threads in daemon mode, see llama_delivery
+DELIVERY = None
 
+# FAILED files the delivery loop looks at per tick
+DELIVERY_SCAN = 4096
 
-line_80 = (
-    "--------------------------------------------------------------------------------"
-)
+# Chats without tools stream their answer, see llama_stream
+STREAMING = None
 
+# State of every job for the launcher status API, see llama_queue.JobStates
+JOB_STATES = None
 
-def print_h(text):
-    print(Back.GREEN + Fore.BLUE + line_80)
-    print(Back.GREEN + Fore.BLUE + text.center(80))
-    print(Back.GREEN + Fore.BLUE + line_80)
-    print("\n")
+# Seconds a single job is allowed to run before SIGALRM aborts it
+JOB_TIMEOUT = 300
 
+# Daemon mode, idle backoff when the queue is empty
+IDLE_SLEEP_MIN = 1
+IDLE_SLEEP_MAX = 10
 
-def print_e(text):
-    print(Back.RED + line_80)
-    print(Back.RED + text.center(80))
-    print(Back.RED + line_80)
+# Queued copies of jobs still in processing we pass over before calling the queue empty
+CLAIM_SKIP_MAX = 64
 
+# Jobs running at the same time in the daemon, match OLLAMA_NUM_PARALLEL
+WORKERS = 1
 
-def print_json(json_in):
-    print_b(json.dumps(json_in, indent=4))
+# Job and stage times of all the workers, see llama_stats
+STATS = None
 
+BEXIT = False
+STOP_EVENT = threading.Event()
 
-def print_exception(err, text=""):
-    import traceback
 
-    print(Fore.RED + str(err))
-    traceback.print_tb(err.__traceback__)
+def word_count(text):
+    # Split the text into words and normalize to lowercase
+    words = text.lower().split()
+    # Count occurrences of each word
+    word_counts = Counter(words)
+    return word_counts
 
 
 def timeout_handler(signum, frame):
     raise TimeoutError("Program took too long to execute!")
 
 
+def stop_handler(signum, frame):
+    print_r(f" SIGNAL {signum} RECEIVED, FINISHING CURRENT JOB ")
+    STOP_EVENT.set()
+
+
 signal.signal(signal.SIGALRM, timeout_handler)
-signal.alarm(300)  # Set the alarm for 50 seconds
 
 
 def count_time():
@@ -111,6 +135,50 @@ def count_time():
 
 import ollama
 
+from llama_pipeline import Pipeline, PipelineError, Stage
+from llama_context import estimate_tokens, pick_num_ctx, count_tokens
+from llama_scheduler import AffinityScheduler
+from llama_residency import ModelResidency
+from llama_queue import QueueIndex, JobLeases, JobStates, QUEUE_DB
+from llama_cache import InferenceCache, CACHE_DB, message_to_dict
+from llama_dedup import NearDuplicateIndex, DEDUP_DB
+from llama_boilerplate import BoilerplateStripper, BOILERPLATE_DB
+from llama_delivery import CallbackDelivery
+from llama_stream import StreamingChat, GenerationAborted, PARTIAL_FOLDER
+from llama_stats import StatsStore, STATS_DB, get_job_class
+import llama_metrics
+from llama_metrics import (
+    REGISTRY,
+    QUEUE_WAIT,
+    JOB_SECONDS,
+    JOBS,
+    STAGE_SECONDS,
+    STAGE_ERRORS,
+    PROMPT_TOKENS,
+    COMPLETION_TOKENS,
+    TOKENS_PER_SECOND,
+    TIME_TO_FIRST_TOKEN,
+    FALLBACKS,
+    CACHE_LOOKUPS,
+    CALLBACK_SECONDS,
+    observe_usage,
+)
+
+# Run the independent enrichment stages at the same time, see run_enrichment
+CONCURRENT_STAGES = False
+
+# Requests give up after JOB_TIMEOUT, SIGALRM only works on the main thread
+ollama_client = ollama.Client(timeout=JOB_TIMEOUT)
+
+# Each thread of the worker pool runs its own event loop and AsyncClient
+thread_state = threading.local()
+
+# keep_alive policy and preloading of the models, see --pin
+FALLBACK_MODEL = "llama3.2"
+RESIDENCY = ModelResidency(
+    ollama_client, pinned=[DEFAULT_MODEL], fallback=FALLBACK_MODEL
+)
+
 # Configurable paths
 source_folder = "./DATA/JSON_TO_PROCESS"
 priority_folder = "./DATA/JSON_TO_PROCESS_PRIORITY"
@@ -123,6 +191,9 @@ rejected_folder = "./DATA/REJECTED"
 
 development_folder = "./DATA/DEV_FOLDER"
 
+# Answers of the chat jobs while they are generated
+partial_folder = PARTIAL_FOLDER
+
 PATHS = [
     source_folder,
     priority_folder,
@@ -133,69 +204,75 @@ PATHS = [
     failed_folder,
     rejected_folder,
     development_folder,
+    partial_folder,
 ]
 
 # Ensure processed folder exists
 for folder in PATHS:
-    if not os.path.exists(folder):
-        os.makedirs(folder)
-
-
-def fix_array(company_list):
-    """
-    Checks if the input is a string representation of a list or an actual list.
-    Converts it to a proper Python list if necessary.
-
-    Args:
-        company_list (str or list): The input to be checked and fixed.
-
-    Returns:
-        list: A properly formatted Python list.
-    """
-    if not company_list:
-        return []
+    os.makedirs(folder, exist_ok=True)
+
+# What a job in each folder means to the clients, FAILED has the result but not the callback
+FOLDER_STATES = {
+    os.path.abspath(source_folder): "queued",
+    os.path.abspath(priority_folder): "queued",
+    os.path.abspath(processing_folder): "processing",
+    os.path.abspath(processed_folder): "done",
+    os.path.abspath(development_folder): "done",
+    os.path.abspath(failed_folder): "done",
+    os.path.abspath(ai_crashed): "failed",
+    os.path.abspath(ai_timeout): "timeout",
+    os.path.abspath(rejected_folder): "rejected",
+}
+
+DELIVERED = {
+    os.path.abspath(processed_folder): True,
+    os.path.abspath(development_folder): True,
+    os.path.abspath(failed_folder): False,
+}
+
+# Jobs that end here had no result
+FAILED_FOLDERS = [os.path.abspath(f) for f in (ai_crashed, ai_timeout, rejected_folder)]
+
+
+# Seconds the depth of the folders that only grow (PROCESSED, AI_FAILED...) is kept
+ARCHIVE_DEPTH_TTL = 300
+archive_depths = {}
+
+# Listed on every scrape when they are not in the index, the workers list them anyway
+LIVE_FOLDERS = [
+    os.path.abspath(f) for f in (source_folder, priority_folder, processing_folder, partial_folder)
+]
 
-    if isinstance(company_list, str):
-        try:
-            # Try to safely evaluate the string as a list
-            parsed_list = ast.literal_eval(company_list)
-            if isinstance(parsed_list, list):
-                return parsed_list
-        except (ValueError, SyntaxError):
-            pass
-        # If parsing fails, wrap the string in a list
-        return [company_list]
 
-    elif isinstance(company_list, list):
-        return company_list
+def count_json_files(folder):
+    with os.scandir(folder) as entries:
+        return sum(1 for entry in entries if entry.name.endswith(".json"))
 
-    # If neither, raise an error
-    raise TypeError("Input must be a string or a list.")
 
+def folder_depths():
+    """Files in every DATA folder, the queue folders from the index.
 
-def fix_nested_lists(data):
+    The archive folders grow without end, they are counted every
+    ARCHIVE_DEPTH_TTL seconds.
     """
-    Recursively traverses a dictionary and fixes any keys ending with '_list'.
+    depths = {}
+    for folder in PATHS:
+        if QUEUE and QUEUE.indexed(folder):
+            count = QUEUE.count(folder)
+        elif os.path.abspath(folder) in LIVE_FOLDERS:
+            count = count_json_files(folder)
+        else:
+            counted_at, count = archive_depths.get(folder, (0, 0))
+            if time.time() - counted_at > ARCHIVE_DEPTH_TTL:
+                count = count_json_files(folder)
+                archive_depths[folder] = (time.time(), count)
 
-    Args:
-        data (dict): The dictionary to be traversed.
+        depths[(os.path.basename(folder),)] = count
 
-    Returns:
-        dict: The dictionary with fixed list formats.
-    """
-    if isinstance(data, list):
-        for obj in data:
-            fix_nested_lists(obj)
-        return obj
+    return depths
 
-    if isinstance(data, dict):
-        for key, value in data.items():
-            if key.endswith("_list"):
-                data[key] = fix_array(value)
-                continue
 
-            fix_nested_lists(value)
-    return data
+REGISTRY.gauge("llama_folder_depth", "Jobs waiting in every DATA folder", ["folder"], folder_depths)
 
 
 def get_youngest_file(folder):
@@ -238,6 +315,12 @@ def get_oldest_file_by_priority(folder):
     return arr[0]
 
 
+def sort_files_by_date(folder):
+    """Sort files by creation date (oldest first)."""
+    files = [os.path.join(folder, f) for f in os.listdir(folder) if f.endswith(".json")]
+    return sorted(files, key=os.path.getctime)
+
+
 def get_oldest_file(folder):
     """Get the oldest file in the folder."""
     files = [os.path.join(folder, f) for f in os.listdir(folder) if f.endswith(".json")]
@@ -252,46 +335,153 @@ def update_file_timestamp(filepath):
     os.utime(filepath, None)
 
 
+# Reuse the TCP/TLS connections to the callback hosts between jobs
+callback_session = requests.Session()
+
+
 def callback_url(url, data):
     """Send a callback to the URL with the processed data."""
+    if DELIVERY:
+        return DELIVERY.post(url, data)
+
+    start = time.time()
     try:
-        response = requests.post(url, json=data, verify=False)
+        response = callback_session.post(url, json=data, verify=False, timeout=30)
         response.raise_for_status()
         print_g(f" Callback {url} {response.status_code}")
+        CALLBACK_SECONDS.observe(time.time() - start, outcome="ok")
 
         return True
     except requests.exceptions.RequestException as e:
         print_e(f" Failed to callback {url}: {e}")
 
+    CALLBACK_SECONDS.observe(time.time() - start, outcome="error")
     return False
 
 
+def load_result(json_file):
+    with open(json_file, "r") as f:
+        return json.load(f)
+
+
 def upload_file(json_file):
+    """Callback with the result and move the file, True if the callback took it."""
+    result_ok = False
+
     try:
-        with open(json_file, "r") as f:
-            data = json.load(f)
+        data = load_result(json_file)
+        result_ok = callback_url(data["callback_url"], data)
+        finish_upload(json_file, data, result_ok)
 
-            result_ok = callback_url(data["callback_url"], data)
+    except Exception as e:
+        print(f"Failed to save result to file {json_file}: {e}")
 
-            if "dev" in data:
-                if result_ok:
-                    api_file_move(json_file, development_folder)
-                else:
-                    api_file_move(json_file + ".FAILED", development_folder)
+        try:
+            api_file_remove(json_file)  # Delete the file if it can't be saved
+            print(f"Deleted file due to save error: {json_file}")
+        except FileNotFoundError:
+            pass
 
-            else:
-                if result_ok:
-                    api_file_move(json_file, processed_folder)
-                else:
-                    api_file_move(json_file, failed_folder)
+    return result_ok
 
-            print("\n")
 
-    except Exception as e:
-        print(f"Failed to save result to file {json_file}: {e}")
+def finish_upload(json_file, data, result_ok):
+    """Move the result where it belongs after its callback."""
+    if "dev" in data:
+        if result_ok:
+            api_file_move(json_file, development_folder)
+        else:
+            api_file_move(
+                json_file,
+                development_folder,
+                os.path.basename(json_file) + ".FAILED",
+            )
+
+    else:
+        if result_ok:
+            api_file_move(json_file, processed_folder)
+        else:
+            api_file_move(json_file, failed_folder)
+
+    print("\n")
+
+
+def deliver_result(json_file, data=None):
+    """Hand the result to the delivery threads, or send it now without them."""
+    if not DELIVERY:
+        upload_file(json_file)
+        return
+
+    # If we die before the callback goes out, the result waits in FAILED
+    if LEASES:
+        LEASES.retarget(json_file, failed_folder)
+
+    # The result is ready for the status API before the callback goes out
+    api_job_state(json_file, "done")
+
+    # From here the file is the delivery threads', a crash of our next job leaves it alone
+    thread_state.json_file = None
+    DELIVERY.submit(json_file, data)
+
+
+def get_failed_page(cursor, limit):
+    """FAILED files by ctime after cursor (ctime, path), as (path, ctime).
+
+    From the index, the daemon indexes FAILED for the delivery even with
+    --noindex."""
+    return QUEUE.after(failed_folder, cursor, limit)
+
+
+def delivery_loop():
+    """Keep retrying the results in FAILED, as their backoff allows.
 
-        os.remove(json_file)  # Delete the file if it can't be saved
-        print(f"Deleted file due to save error: {json_file}")
+    Files that are not due (backoff, or their host's breaker is open) are
+    paged past, so they don't hold back the callbacks of the healthy hosts.
+    At most DELIVERY_SCAN files are looked at per second, the next tick
+    carries on from there.
+    """
+    resume = None
+    while not STOP_EVENT.wait(1):
+        try:
+            DELIVERY.tick()
+
+            QUEUE.sync(failed_folder)
+
+            cursor, resume = resume, None
+            scanned = 0
+            while DELIVERY.has_capacity():
+                if scanned >= DELIVERY_SCAN:
+                    resume = cursor
+                    break
+
+                page = get_failed_page(cursor, 256)
+                if not page:
+                    break
+
+                scanned += len(page)
+                cursor = (page[-1][1], page[-1][0])
+
+                for json_file, _ in page:
+                    if not DELIVERY.has_capacity():
+                        break
+
+                    if not DELIVERY.due(json_file):
+                        continue
+
+                    claimed = api_file_claim(json_file)
+                    if claimed:
+                        DELIVERY.submit(claimed)
+
+        except Exception as e:
+            print_exception(e, "DELIVERY LOOP CRASHED")
+
+
+def stop_delivery():
+    """Wait for the callbacks in flight, the queued ones go to FAILED."""
+    print_g(" STOPPING DELIVERY " + json.dumps(DELIVERY.stats()))
+
+    for json_file in DELIVERY.shutdown():
+        api_file_move(json_file, failed_folder)
 
 
 def kill_llama():
@@ -321,11 +511,277 @@ def kill_llama():
         time.sleep(10)
 
 
-def run_translation(prompt):
+# Tool schemas are built once per process so a long running worker keeps them warm.
+
+set_summary_info = {
+    "type": "function",
+    "function": {
+        "name": "set_summary_info",
+        "description": "Set all the information about the text provided",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "tickers_list": {
+                    "type": "array",
+                    "description": "A list of the tickers found in the article",
+                },
+                "company_list": {
+                    "type": "array",
+                    "description": "A list of the company names found in the article, don't include tickers",
+                },
+            },
+            "required": [
+                "tickers_list",
+                "company_list",
+            ],
+        },
+    },
+}
+
+article_classification = [
+    "Individual Company News",
+    "Company PR",
+    "Company Results",
+    "Political Analysis",
+    "Lawsuit",
+    "Market News",
+    "Stock Analysis",
+    "Sector Analysis",
+    "Economic Report",
+    "Regulatory Update",
+    "Analyst Recommendation",
+    "Analyst Prediction",
+    "AI Generated Article",
+    "Opinion/Editorial",
+    "Rage Bait",
+    "Gossip",
+    "Advertisement",
+    "Technical Analysis",
+    "Insider Trading Report",
+    "Mergers and Acquisitions",
+    "IPO News",
+    "Dividend News",
+    "Earnings Preview",
+    "Earnings Call Summary",
+    "Macro Trend Analysis",
+    "International Markets",
+    "Central Bank Policy",
+    "Commodity News",
+    "Cryptocurrency News",
+    "ESG and Sustainability",
+    "Retail Investor Trends",
+    "Institutional Investor Trends",
+    "Other",
+]
+
+sentiments_fontawesome = [
+    "rocket",
+    "anchor",
+    "bat",
+    "wine-bottle",
+    "toilet-paper",
+    "sausage",
+    "chess-queen",
+    "chess-pawn",
+    "tired",
+    "surprise",
+    "smile-wink",
+    "smile-beam",
+    "sad-tear",
+    "sad-cry",
+    "meh-rolling-eyes",
+    "meh-blank",
+    "meh",
+    "laugh-wink",
+    "laugh-squint",
+    "laugh-beam",
+    "laugh-laugh",
+    "kiss-wink-heart",
+    "kiss-beam",
+    "kiss",
+    "grin-wink",
+    "grin-tongue-wink",
+    "grin-tongue-squint",
+    "grin-tongue",
+    "grin-tears",
+    "grin-stars",
+    "grin-squint-tears",
+    "grin-squint",
+    "grin-hearts",
+    "grin-beam-sweat",
+    "grin-beam",
+    "grin-alt",
+    "grin",
+    "grimace",
+    "frown-open",
+    "frown",
+    "flushed",
+    "dizzy",
+    "angry",
+]
+
+bullshit = (
+    "Translate the article from bullshit to no-bullshit. Be funny and sarcastic. Short text."
+)
+
+set_article_function = {
+    "type": "function",
+    "function": {
+        "name": "set_article_information",
+        "description": "Set all the information about the text provided",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "gif_keywords": {
+                    "type": "string",
+                    "description": "use the sentiment to create a list of human emotions, no markdown, only comma separated list",
+                },
+                "title_clickbait": {
+                    "type": "string",
+                    "description": "Build the most click bait title possible, to show how ridiculous they can get.",
+                },
+                "title": {
+                    "type": "string",
+                    "description": "a one line title describing the text",
+                },
+                "paragraph": {
+                    "type": "string",
+                    "description": "a one paragraph, not long text. This should be a small very short summary to display as a note",
+                },
+                "article_tickers_list": {
+                    "type": "array",
+                    "description": "A list of the tickers found in the article",
+                },
+                "article_company_list": {
+                    "type": "array",
+                    "description": "A list of the company names found in the article, don't include tickers",
+                },
+                "summary": {
+                    "type": "string",
+                    "description": "a two to three paragraph summary",
+                },
+                "no_bullshit": {
+                    "type": "string",
+                    "description": bullshit,
+                },
+                "interest_score": {
+                    "type": "integer",
+                    "description": "Score from 0 to 10. An interesting article captures the reader's attention and sustains their engagement. It includes the following characteristics, Relevance, Engaging Opening, Clear Purpose, Well-Researched Content.",
+                },
+                "classification": {
+                    "type": "string",
+                    "enum": article_classification,
+                    "description": "Article classification, or source from the enumeration provided",
+                },
+            },
+            "required": [
+                "paragraph",
+                "article_tickers_list",
+                "article_company_list",
+                "title",
+                "summary",
+                "title_clickbait",
+                "classification",
+                "no_bullshit",
+                "gif_keywords",
+                "interest_score",
+            ],
+        },
+    },
+}
+
+set_growth_alert_function = {
+    "type": "function",
+    "function": {
+        "name": "set_growth_alert",
+        "description": "Extremely good news, if the growth of the stock went up more than 10%",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "message_growth": {
+                    "type": "string",
+                    "description": "A brief explanation of why.",
+                },
+            },
+            "required": ["message_growth"],
+        },
+    },
+}
+
+set_defcon_alert_function = {
+    "type": "function",
+    "function": {
+        "name": "send_portfolio_alert",
+        "description": "Send a DEFCON-style alert about an article that could affect stock prices based on its importance, like the value is going go up or down.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "defcon_level": {
+                    "type": "integer",
+                    "description": "The DEFCON level of urgency, ranging from 1 (most critical) to 5 (least critical).",
+                },
+                "defcon_outcome": {
+                    "type": "string",
+                    "description": "Good or bad outcome",
+                    "enum": ["positive", "negative"],
+                },
+                "defcon_alert": {
+                    "type": "string",
+                    "description": "A brief explanation of the alert's significance.",
+                },
+                "defcon_ticker": {
+                    "type": "string",
+                    "description": "Ticker to monitor",
+                },
+                "actions_required": {
+                    "type": "string",
+                    "description": "The recommended actions for the user in response to the alert.",
+                },
+            },
+            "required": ["defcon_level", "defcon_alert", "defcon_outcome"],
+        },
+    },
+}
+
+set_sentiment_icon_function = {
+    "type": "function",
+    "function": {
+        "name": "set_sentiment_icon",
+        "description": "Sentiment calculation from the article",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "sentiment": {
+                    "type": "string",
+                    "description": "Just sentiment on the article ",
+                },
+                "article_icon": {
+                    "type": "string",
+                    "enum": sentiments_fontawesome,
+                    "description": "Select from the enum an icon ",
+                },
+                "sentiment_score": {
+                    "type": "integer",
+                    "description": "A value from -10 to 10 that represents how much impact will have on the stock. -10 means will go down, 10 bullish",
+                },
+            },
+            "required": [
+                "sentiment",
+                "article_icon",
+                "sentiment_score",
+            ],
+        },
+    },
+}
+
+
+def run_translation(prompt, model=MODEL):
     start_time = time.time()  # Start time measurement
-    response = ollama.chat(
-        model=MODEL,
+    response = cached_chat(
+        model=model,
         messages=[{"role": "user", "content": prompt}],
+        keep_alive=RESIDENCY.keep_alive(model),
+        stage="translation",
         tools=[
             {
                 "type": "function",
@@ -395,16 +851,17 @@ def lowercase_keys(data):
     return data
 
 
-def run_prompt_function(raw_messages, raw_tools, model=MODEL):
+def run_prompt_function(raw_messages, raw_tools, model=MODEL, num_ctx=NUM_CTX):
     start_time = time.time()  # Start time measurement
 
     try:
-        response = ollama.chat(
+        response = cached_chat(
             model=model,
             messages=raw_messages,
             tools=raw_tools,
-            options={"num_ctx": NUM_CTX},
-            keep_alive=1,
+            options={"num_ctx": num_ctx},
+            keep_alive=RESIDENCY.keep_alive(model),
+            stage="prompt_function",
         )
 
         if "content" in response["message"]:
@@ -435,57 +892,18 @@ def run_prompt_function(raw_messages, raw_tools, model=MODEL):
     return None
 
 
-def json_serialize_toolcall(result):
-
-    serialz = []
-    for tool in result:
-        f = tool["function"]
-        old_format = {
-            "function": {
-                "name": f["name"],
-                "arguments": f["arguments"],
-            }
-        }
-        serialz.append(old_format)
-
-    fix_nested_lists(serialz)
-    dmp = json.dumps(serialz, indent=4)
+def clean_summary(result):
+    return re.sub(r"(?i)summary.*(text|article).*markdown.*facts[:\s]*", "", result)
 
-    return dmp
-
-def run_company_tickers_extraction(message,  model):
 
-    set_summary_info = {
-        "type": "function",
-        "function": {
-            "name": "set_summary_info",
-            "description": "Set all the information about the text provided",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "tickers_list": {
-                        "type": "array",
-                        "description": "A list of the tickers found in the article",
-                    },
-                    "company_list": {
-                        "type": "array",
-                        "description": "A list of the company names found in the article, don't include tickers",
-                    },
-                },
-                "required": [
-                    "tickers_list",
-                    "company_list",
-                ],
-            },
-        },
-    }
+def get_tickers_messages(message):
 
     system = f"You are an expert that knows the stock market and how tickers and companies names are structured."
     system += "You have great attention to detail and can highlight in text important and relevant information."
 
     message = "Text to find companies and highlight: " + message
 
-    messages = [
+    return [
         {
             "role": "system",
             "content": system,
@@ -496,114 +914,8 @@ def run_company_tickers_extraction(message,  model):
         },
     ]
 
-    try:
-        response_growth = ollama.chat(
-            model=model,
-            messages=messages,
-            tools=[
-                set_summary_info,
-            ],
-        )
-
-        result = response_growth["message"]["tool_calls"]
-
-        dmp = json_serialize_toolcall(result)
-        print(dmp)
-        return json.loads(dmp)
-
-    except Exception as e:
-        print_exception(e, "CRASH")
-
-    return []
-
-def run_prompt(system, assistant, message, model=MODEL):
-    start_time = time.time()  # Start time measurement
-
-    article_classification = [
-        "Individual Company News",
-        "Company PR",
-        "Company Results",
-        "Political Analysis",
-        "Lawsuit",
-        "Market News",
-        "Stock Analysis",
-        "Sector Analysis",
-        "Economic Report",
-        "Regulatory Update",
-        "Analyst Recommendation",
-        "Analyst Prediction",
-        "AI Generated Article",
-        "Opinion/Editorial",
-        "Rage Bait",
-        "Gossip",
-        "Advertisement",
-        "Technical Analysis",
-        "Insider Trading Report",
-        "Mergers and Acquisitions",
-        "IPO News",
-        "Dividend News",
-        "Earnings Preview",
-        "Earnings Call Summary",
-        "Macro Trend Analysis",
-        "International Markets",
-        "Central Bank Policy",
-        "Commodity News",
-        "Cryptocurrency News",
-        "ESG and Sustainability",
-        "Retail Investor Trends",
-        "Institutional Investor Trends",
-        "Other",
-    ]
-
-    sentiments_fontawesome = [
-        "rocket",
-        "anchor",
-        "bat",
-        "wine-bottle",
-        "toilet-paper",
-        "sausage",
-        "chess-queen",
-        "chess-pawn",
-        "tired",
-        "surprise",
-        "smile-wink",
-        "smile-beam",
-        "sad-tear",
-        "sad-cry",
-        "meh-rolling-eyes",
-        "meh-blank",
-        "meh",
-        "laugh-wink",
-        "laugh-squint",
-        "laugh-beam",
-        "laugh-laugh",
-        "kiss-wink-heart",
-        "kiss-beam",
-        "kiss",
-        "grin-wink",
-        "grin-tongue-wink",
-        "grin-tongue-squint",
-        "grin-tongue",
-        "grin-tears",
-        "grin-stars",
-        "grin-squint-tears",
-        "grin-squint",
-        "grin-hearts",
-        "grin-beam-sweat",
-        "grin-beam",
-        "grin-alt",
-        "grin",
-        "grimace",
-        "frown-open",
-        "frown",
-        "flushed",
-        "dizzy",
-        "angry",
-    ]
 
-    bullshit = (
-        "Translate the article from bullshit to no-bullshit. Be funny and sarcastic. Short text."
-    )
+def get_article_messages(system, assistant, message):
 
     gif_prompt = ". No markdown on gif_keywords, find a funny list of keywords appropiate to the text to find an image that represents the text, and meme related, "
 
@@ -613,289 +925,364 @@ def run_prompt(system, assistant, message, model=MODEL):
     system += "Write a bullshit to no bullshit field as descripted, you are sophisticated, "
     system += "don't use phrases like 'Let's get real, folks', 'No Bullshit:', 'Let's cut to the chase', 'TL;DR', 'Translation:' or anything that starts with let's or uses folks.\n"
 
-    set_article_function = {
-        "type": "function",
-        "function": {
-            "name": "set_article_information",
-            "description": "Set all the information about the text provided",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "gif_keywords": {
-                        "type": "string",
-                        "description": "use the sentiment to create a list of human emotions, no markdown, only comma separated list",
-                    },
-                    "title_clickbait": {
-                        "type": "string",
-                        "description": "Build the most click bait title possible, to show how ridiculous they can get.",
-                    },
-                    "title": {
-                        "type": "string",
-                        "description": "a one line title describing the text",
-                    },
-                    "paragraph": {
-                        "type": "string",
-                        "description": "a one paragraph, not long text. This should be a small very short summary to display as a note",
-                    },
-                    "article_tickers_list": {
-                        "type": "array",
-                        "description": "A list of the tickers found in the article",
-                    },
-                    "article_company_list": {
-                        "type": "array",
-                        "description": "A list of the company names found in the article, don't include tickers",
-                    },
-                    "summary": {
-                        "type": "string",
-                        "description": "a two to three paragraph summary",
-                    },
-                    "no_bullshit": {
-                        "type": "string",
-                        "description": bullshit,
-                    },
-                    "interest_score": {
-                        "type": "integer",
-                        "description": "Score from 0 to 10. An interesting article captures the reader's attention and sustains their engagement. It includes the following characteristics, Relevance, Engaging Opening, Clear Purpose, Well-Researched Content.",
-                    },
-                    "classification": {
-                        "type": "string",
-                        "enum": article_classification,
-                        "description": "Article classification, or source from the enumeration provided",
-                    },
-                },
-                "required": [
-                    "paragraph",
-                    "article_tickers_list",
-                    "article_company_list",
-                    "title",
-                    "summary",
-                    "title_clickbait",
-                    "classification",
-                    "no_bullshit",
-                    "gif_keywords",
-                    "interest_score",
-                ],
-            },
+    return [
+        {
+            "role": "assistant",
+            "content": assistant,
         },
-    }
-
-    set_growth_alert_function = {
-        "type": "function",
-        "function": {
-            "name": "set_growth_alert",
-            "description": "Extremely good news, if the growth of the stock went up more than 10%",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "message_growth": {
-                        "type": "string",
-                        "description": "A brief explanation of why.",
-                    },
-                },
-                "required": ["message_growth"],
-            },
+        {
+            "role": "system",
+            "content": system,
         },
-    }
-
-    set_defcon_alert_function = {
-        "type": "function",
-        "function": {
-            "name": "send_portfolio_alert",
-            "description": "Send a DEFCON-style alert about an article that could affect stock prices based on its importance, like the value is going go up or down.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "defcon_level": {
-                        "type": "integer",
-                        "description": "The DEFCON level of urgency, ranging from 1 (most critical) to 5 (least critical).",
-                    },
-                    "defcon_outcome": {
-                        "type": "string",
-                        "description": "Good or bad outcome",
-                        "enum": ["positive", "negative"],
-                    },
-                    "defcon_alert": {
-                        "type": "string",
-                        "description": "A brief explanation of the alert's significance.",
-                    },
-                    "defcon_ticker": {
-                        "type": "string",
-                        "description": "Ticker to monitor",
-                    },
-                    "actions_required": {
-                        "type": "string",
-                        "description": "The recommended actions for the user in response to the alert.",
-                    },
-                },
-                "required": ["defcon_level", "defcon_alert", "defcon_outcome"],
-            },
+        {
+            "role": "user",
+            "content": message,
         },
-    }
+    ]
 
-    messages = [
+
+def get_icon_messages(assistant):
+    return [
         {
             "role": "assistant",
             "content": assistant,
         },
         {
             "role": "system",
-            "content": system,
+            "content": "You are an expert web designer and you have to select icons for each article, provided is the article",
         },
         {
             "role": "user",
-            "content": message,
+            "content": "Find the right icons to represent this article from this list: "
+            + str(sentiments_fontawesome),
         },
     ]
 
-    print_g(">> MODEL " + model + " NUM_CTX " + str(NUM_CTX))
 
-    response = ollama.chat(
-        model=model,
-        messages=messages,
-        tools=[
-            set_article_function,
-        ],
-        options={"num_ctx": NUM_CTX},
-    )
+# The article enrichment. Each stage declares its prompt, tool and inputs, the
+# pipeline works out which ones can run at the same time.
+ENRICHMENT_PIPELINE = Pipeline(
+    [
+        Stage(
+            "summary",
+            lambda ctx: ctx["arr_messages"],
+            inputs=["arr_messages"],
+            provides="ai_summary",
+            num_ctx=True,
+            required=True,
+        ),
+        Stage(
+            "article",
+            lambda ctx: get_article_messages(
+                ctx["system"], ctx["assistant"], ctx["message"]
+            ),
+            tool=set_article_function,
+            inputs=["system", "assistant", "message"],
+            num_ctx=True,
+            required=True,
+        ),
+        Stage(
+            "defcon",
+            lambda ctx: get_article_messages(
+                ctx["system"], ctx["assistant"], ctx["message"]
+            ),
+            tool=set_defcon_alert_function,
+            inputs=["system", "assistant", "message"],
+            num_ctx=True,
+        ),
+        Stage(
+            "sentiment_icon",
+            lambda ctx: get_icon_messages(ctx["assistant"]),
+            tool=set_sentiment_icon_function,
+            inputs=["assistant"],
+            model="llama3.1",
+            num_ctx=True,
+        ),
+        Stage(
+            "tickers",
+            lambda ctx: get_tickers_messages(clean_summary(ctx["ai_summary"])),
+            tool=set_summary_info,
+            inputs=["ai_summary"],
+            num_ctx=True,
+        ),
+    ]
+)
 
-    if "tool_calls" not in response["message"]:
-        print_r("Failed loading JSON from result")
-        return None
+# What run_prompt used to do, the stages that go into data["dict"]
+ARTICLE_STAGES = ["article", "defcon", "sentiment_icon"]
+
+
+def run_company_tickers_extraction(message,  model):
+
+    messages = get_tickers_messages(message)
 
     try:
-        result = response["message"]["tool_calls"]
+        response_growth = cached_chat(
+            model=model,
+            messages=messages,
+            tools=[
+                set_summary_info,
+            ],
+            keep_alive=RESIDENCY.keep_alive(model),
+            stage="tickers",
+        )
 
-        # with open("test_return.json", "w") as f:
-        #   json.dump(result, f, indent=4)
+        result = response_growth["message"]["tool_calls"]
 
         dmp = json_serialize_toolcall(result)
-
         print(dmp)
-        d = json.loads(dmp)
+        return json.loads(dmp)
 
-        args = {}
+    except Exception as e:
+        print_exception(e, "CRASH")
 
-        try:
-            response_growth = ollama.chat(
-                model=model,
-                messages=messages,
-                tools=[
-                    set_defcon_alert_function,
-                ],
-            )
+    return []
 
-            result = response_growth["message"]["tool_calls"]
 
-            dmp = json_serialize_toolcall(result)
+def cache_count(hit):
+    """Count a cache lookup of the job running on this thread."""
+    CACHE_LOOKUPS.inc(result="hit" if hit else "miss")
 
-            d.extend(json.loads(dmp))
-            print(dmp)
+    if hit:
+        thread_state.cache_hits = getattr(thread_state, "cache_hits", 0) + 1
+    else:
+        thread_state.cache_misses = getattr(thread_state, "cache_misses", 0) + 1
 
-        except Exception as e:
-            print_exception(e, "CRASH")
 
-        try:
-            response_growth = ollama.chat(
+def call_chat(model, messages, tools=None, options=None, keep_alive=None, stage="chat"):
+    """ollama chat, streamed when there are no tools and --stream is on.
+
+    The stream stats of the job are kept in thread_state.stream, the partial
+    answer goes to thread_state.partial_file if the job has one. The latency
+    and the token counts go to the metrics under `stage`.
+    """
+    start = time.time()
+    try:
+        if not STREAMING or tools:
+            response = ollama_client.chat(
                 model=model,
                 messages=messages,
-                tools=[
-                    set_defcon_alert_function,
-                ],
+                tools=tools,
+                options=options,
+                keep_alive=keep_alive,
             )
 
-            result = response_growth["message"]["tool_calls"]
+            STAGE_SECONDS.observe(time.time() - start, stage=stage, model=model)
+            add_stage_time(stage, time.time() - start)
+            observe_usage(stage, model, response)
+            return response
 
-            dmp = json_serialize_toolcall(result)
+        partial_file = getattr(thread_state, "partial_file", None)
+        message, stats = STREAMING.chat(model, messages, options, keep_alive, partial_file)
 
-            d.extend(json.loads(dmp))
-            print(dmp)
+    except GenerationAborted as e:
+        thread_state.stream = e.stats
+        print_r(f" {e}")
+        STAGE_ERRORS.inc(stage=stage, model=model)
+        raise
 
-        except Exception as e:
-            print_exception(e, "CRASH")
+    except Exception:
+        STAGE_ERRORS.inc(stage=stage, model=model)
+        raise
 
-        try:
+    thread_state.stream = stats
+    print_g(
+        f" STREAM {stats['tokens']} TOKENS TTFT {stats['ttft']}s {stats['tokens_per_sec']} T/S"
+    )
 
-            set_sentiment_icon_function = {
-                "type": "function",
-                "function": {
-                    "name": "set_sentiment_icon",
-                    "description": "Sentiment calculation from the article",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "sentiment": {
-                                "type": "string",
-                                "description": "Just sentiment on the article ",
-                            },
-                            "article_icon": {
-                                "type": "string",
-                                "enum": sentiments_fontawesome,
-                                "description": "Select from the enum an icon ",
-                            },
-                            "sentiment_score": {
-                                "type": "integer",
-                                "description": "A value from -10 to 10 that represents how much impact will have on the stock. -10 means will go down, 10 bullish",
-                            },
-                        },
-                        "required": [
-                            "sentiment",
-                            "article_icon",
-                            "sentiment_score",
-                        ],
-                    },
-                },
-            }
+    STAGE_SECONDS.observe(time.time() - start, stage=stage, model=model)
+    add_stage_time(stage, time.time() - start)
+    if stats["ttft"] is not None:
+        TIME_TO_FIRST_TOKEN.observe(stats["ttft"], model=model)
 
-            messages = [
-                {
-                    "role": "assistant",
-                    "content": assistant,
-                },
-                {
-                    "role": "system",
-                    "content": "You are an expert web designer and you have to select icons for each article, provided is the article",
-                },
-                {
-                    "role": "user",
-                    "content": "Find the right icons to represent this article from this list: "
-                    + str(sentiments_fontawesome),
-                },
-            ]
+    if stats.get("prompt_tokens"):
+        PROMPT_TOKENS.inc(stats["prompt_tokens"], stage=stage, model=model)
 
-            # print(str(messages))
-            response_growth = ollama.chat(
-                model="llama3.1",
-                messages=messages,
-                tools=[
-                    set_sentiment_icon_function,
-                ],
+    COMPLETION_TOKENS.inc(stats["tokens"], stage=stage, model=model)
+    if stats["tokens_per_sec"]:
+        TOKENS_PER_SECOND.observe(stats["tokens_per_sec"], model=model)
+
+    return {"message": message}
+
+
+def cached_chat(model, messages, tools=None, options=None, keep_alive=None, stage="chat"):
+    """ollama chat through the inference cache.
+
+    Returns {"message": {...}} with the content and the tool_calls as plain
+    dicts, a hit and a call look the same to the caller. Answers without the
+    tool_calls we asked for are not stored, the retry has to ask again.
+    """
+    if not CACHE:
+        return call_chat(
+            model=model,
+            messages=messages,
+            tools=tools,
+            options=options,
+            keep_alive=keep_alive,
+            stage=stage,
+        )
+
+    key = CACHE.key(model, messages, tools, options)
+    message = CACHE.get(key)
+    cache_count(message is not None)
+
+    if message is not None:
+        print_g(" CACHE HIT " + key[:12])
+        return {"message": message}
+
+    response = call_chat(
+        model=model,
+        messages=messages,
+        tools=tools,
+        options=options,
+        keep_alive=keep_alive,
+        stage=stage,
+    )
+
+    message = message_to_dict(response["message"])
+    if not tools or message.get("tool_calls"):
+        CACHE.put(key, model, message)
+
+    return {"message": message}
+
+
+def get_async_client():
+    """Event loop and AsyncClient of this thread, they live as long as the thread."""
+    if not hasattr(thread_state, "loop"):
+        thread_state.loop = asyncio.new_event_loop()
+        thread_state.client = ollama.AsyncClient(timeout=JOB_TIMEOUT)
+
+    return thread_state.loop, thread_state.client
+
+
+def run_async(coro):
+    """Run a coroutine on the event loop of this thread."""
+    async_loop, _ = get_async_client()
+
+    task = async_loop.create_task(coro)
+    try:
+        return async_loop.run_until_complete(task)
+    except BaseException:
+        # SIGALRM or a crash, don't leave orphan requests running on the loop
+        pending = asyncio.all_tasks(async_loop)
+        for t in pending:
+            t.cancel()
+
+        async_loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        raise
+
+
+def get_enrichment_context(system, assistant, message, arr_messages=None):
+    return {
+        "system": system,
+        "assistant": assistant,
+        "message": message,
+        "arr_messages": arr_messages,
+    }
+
+
+def run_enrichment(context, model=MODEL, targets=None, num_ctx=NUM_CTX):
+    """Run the enrichment pipeline on the job context.
+
+    With --concurrent the independent stages go out at the same time, set
+    OLLAMA_NUM_PARALLEL on the Ollama server so they really run in parallel.
+    """
+    print_g(">> MODEL " + model + " NUM_CTX " + str(num_ctx))
+
+    _, async_client = get_async_client()
+    enrichment = run_async(
+        ENRICHMENT_PIPELINE.arun(
+            async_client,
+            context,
+            model,
+            num_ctx=num_ctx,
+            targets=targets,
+            parallel=CONCURRENT_STAGES,
+            keep_alive=RESIDENCY.keep_alive,
+            cache=CACHE,
+            stream=STREAMING,
+        )
+    )
+
+    if CACHE:
+        for name in enrichment.timings:
+            cache_count(name in enrichment.cached)
+
+    observe_enrichment(enrichment, model)
+
+    # Inference is down, this is not a lazy model. Let the caller crash the job.
+    for name, err in enrichment.errors.items():
+        if ENRICHMENT_PIPELINE.stages[name].required and not isinstance(
+            err, PipelineError
+        ):
+            raise err
+
+    return enrichment
+
+
+def observe_enrichment(enrichment, model):
+    """Latency and tokens of the pipeline stages that called the model."""
+    for name, elapsed in enrichment.timings.items():
+        stage_model = ENRICHMENT_PIPELINE.stages[name].model or model
+
+        if name in enrichment.errors:
+            err = enrichment.errors[name]
+            if isinstance(err, GenerationAborted):
+                thread_state.stream = err.stats
+
+            STAGE_ERRORS.inc(stage=name, model=stage_model)
+            continue
+
+        if name in enrichment.cached or name in enrichment.skipped:
+            continue
+
+        STAGE_SECONDS.observe(elapsed, stage=name, model=stage_model)
+        add_stage_time(name, elapsed)
+        observe_usage(name, stage_model, enrichment.usage.get(name))
+
+        stats = enrichment.usage.get(name, {}).get("stream")
+        if stats:
+            thread_state.stream = stats
+            print_g(
+                f" STREAM {name} {stats['tokens']} TOKENS TTFT {stats['ttft']}s {stats['tokens_per_sec']} T/S"
             )
 
-            result = response_growth["message"]["tool_calls"]
+            if stats["ttft"] is not None:
+                TIME_TO_FIRST_TOKEN.observe(stats["ttft"], model=stage_model)
 
-            dmp = json_serialize_toolcall(result)
 
-            d.extend(json.loads(dmp))
-            print(dmp)
+def get_article_dict(enrichment, model):
+    """The run_prompt result from a pipeline run, None if the article failed."""
+    if not enrichment.ok:
+        print_r("Failed loading JSON from result")
+        return None
 
-        except Exception as e:
-            print_exception(e, "CRASH")
+    d = ENRICHMENT_PIPELINE.merge(enrichment, ARTICLE_STAGES)
 
-        end_time = time.time()  # End time measurement
+    res = d[0]["function"]["arguments"]
+    res["model"] = model
+    res["process_time"] = enrichment.elapsed
 
-        res = d[0]["function"]["arguments"]
-        res["model"] = model
-        res["process_time"] = round(end_time - start_time, 2)
+    return d
 
-        print(
-            f"Time taken to process run_prompt: {end_time - start_time:.2f} seconds"
-        )  # Print elapsed time
 
-        return d
-    except json.JSONDecodeError as e:
-        print(f"Invalid JSON format Error: {e}")
+def run_prompt(system, assistant, message, model=MODEL, num_ctx=NUM_CTX):
+    start_time = time.time()  # Start time measurement
 
-    return None
+    context = get_enrichment_context(system, assistant, message)
+    enrichment = run_enrichment(context, model, ARTICLE_STAGES, num_ctx)
+
+    d = get_article_dict(enrichment, model)
+    if d:
+        d[0]["function"]["arguments"]["process_time"] = round(
+            time.time() - start_time, 2
+        )
+
+    print(
+        f"Time taken to process run_prompt: {time.time() - start_time:.2f} seconds"
+    )  # Print elapsed time
+
+    return d
 
 
 def get_generic_system(data):
@@ -947,6 +1334,103 @@ def get_legacy(data):
     return assistant, message, call_tools
 
 
+def strip_boilerplate(data):
+    """Copy of the job with the boilerplate out of the article fields.
+
+    The callback keeps the original article. at_tokens_saved is what every
+    request of the job doesn't have to prefill. Nothing is learned here, see
+    learn_boilerplate.
+    """
+    if not BOILERPLATE:
+        return data
+
+    job = dict(data)
+    saved = 0
+
+    for key in ("article", "assistant", "message"):
+        text = data.get(key)
+        if not text or not isinstance(text, str):
+            continue
+
+        try:
+            job[key] = BOILERPLATE.strip(text)
+        except Exception as e:
+            print_exception(e, "BOILERPLATE FAILED")
+            continue
+
+        saved += count_tokens(text) - count_tokens(job[key])
+
+    data["at_tokens_saved"] = saved
+    if saved:
+        print_g(f" BOILERPLATE {saved} TOKENS SAVED")
+
+    return job
+
+
+def learn_boilerplate(data):
+    """Learn the sentences of a job that is not a near duplicate, the
+    reprints of a wire story would turn the story itself into boilerplate."""
+    if not BOILERPLATE:
+        return
+
+    for key in ("article", "assistant", "message"):
+        text = data.get(key)
+        if not text or not isinstance(text, str):
+            continue
+
+        try:
+            BOILERPLATE.learn(text, f"{data.get('id')}:{key}" if data.get("id") else None)
+        except Exception as e:
+            print_exception(e, "BOILERPLATE LEARN FAILED")
+
+
+def get_dedup_key(model, system, assistant, message):
+    """Article text and the scope a near duplicate has to share to be reused."""
+    if assistant:
+        text, prompt = assistant, message
+    else:
+        # COMPANY SIMPLE FORMAT, the message is the article
+        text, prompt = message, ""
+
+    scope = hashlib.sha1(
+        json.dumps([model, system, prompt], default=str).encode("utf-8")
+    ).hexdigest()
+
+    return str(text or ""), scope
+
+
+def find_duplicate(model, system, assistant, message):
+    if not DEDUP:
+        return None
+
+    text, scope = get_dedup_key(model, system, assistant, message)
+
+    try:
+        return DEDUP.find(text, scope)
+    except Exception as e:
+        print_exception(e, "DEDUP FIND FAILED")
+
+    return None
+
+
+def remember_article(data, model, system, assistant, message):
+    """Keep the enrichment of this article for its rewrites."""
+    if not DEDUP or not data.get("dict") or not data.get("ai_summary"):
+        return
+
+    text, scope = get_dedup_key(model, system, assistant, message)
+
+    try:
+        DEDUP.add(
+            data.get("id"),
+            text,
+            scope,
+            {"ai_summary": data["ai_summary"], "dict": data["dict"]},
+        )
+    except Exception as e:
+        print_exception(e, "DEDUP ADD FAILED")
+
+
 def get_generic_messages(data, system, assistant, prompt):
 
     if "raw_ollama" in data:
@@ -988,62 +1472,329 @@ def get_generic_messages(data, system, assistant, prompt):
     return arr_messages
 
 
-def api_file_move(json_file, new_folder):
+def get_job_request(data):
+    """(messages, tools) of the largest request the job sends.
+
+    Built straight from the job so the scheduler can size jobs that are still
+    on the queue, the prompts we add on top are covered by the token margin.
+    """
+    if data.get("type") == "raw_llama":
+        return data.get("raw_messages") or [], data.get("raw_tools")
+
+    messages = data.get("raw_ollama")
+    if not messages:
+        messages = [
+            {"content": get_generic_system(data)},
+            {"content": data.get("assistant")},
+            {"content": data.get("article")},
+            {"content": data.get("prompt")},
+            {"content": data.get("message")},
+        ]
+
+    if data.get("type") == "user_prompt":
+        return messages, None
+
+    return messages, [set_article_function]
+
+
+def choose_num_ctx(data):
+    """num_ctx for the job, the smallest bucket that fits its largest request."""
+    if "num_ctx" in data:
+        return data["num_ctx"]
+
+    if not ADAPTIVE_NUM_CTX:
+        return DEFAULT_NUM_CTX
+
+    messages, tools = get_job_request(data)
+    tokens = estimate_tokens(messages, tools)
+    data["at_prompt_tokens"] = tokens
+
+    return pick_num_ctx(tokens, NUM_CTX_BUCKETS)
+
+
+def job_affinity(json_file):
+    """(model, num_ctx) a queued job is going to run with."""
+    with open(json_file, "r") as f:
+        data = json.load(f)
+
+    return data.get("model", DEFAULT_MODEL), choose_num_ctx(data)
+
+
+def get_queue_files(folder, limit, by_priority=True):
+    """First files of a queue folder, from the index if we have one."""
+    if not QUEUE or not QUEUE.indexed(folder):
+        if by_priority:
+            files = sort_files_by_ascii_and_date(folder) or []
+        else:
+            files = sort_files_by_date(folder)
+
+        return files[:limit]
+
+    QUEUE.sync(folder)
+    return QUEUE.peek(folder, limit, by_priority)
+
+
+def get_next_job(skip=()):
+    """Next file from the queue, priority orders first.
+
+    skip are files we couldn't claim because the same job is in processing.
+    """
+
+    def waiting(folder, limit, by_priority=True):
+        files = get_queue_files(folder, limit + len(skip), by_priority)
+        return [json_file for json_file in files if json_file not in skip][:limit]
+
+    if SCHEDULER:
+        json_file = SCHEDULER.next_job(
+            waiting(priority_folder, SCHEDULER.lookahead, by_priority=False),
+            waiting(source_folder, SCHEDULER.lookahead),
+        )
+
+        if json_file:
+            print_g(
+                f" BATCH {SCHEDULER.current} #{SCHEDULER.batch_size} SWITCHES {SCHEDULER.switches}"
+            )
+
+        return json_file
+
+    if QUEUE or skip:
+        files = waiting(priority_folder, 1, by_priority=False)
+        if not files:
+            files = waiting(source_folder, 1)
+
+        return files[0] if files else None
+
+    json_file = get_oldest_file(priority_folder)
+    if not json_file:
+        json_file = get_oldest_file_by_priority(source_folder)
+
+    return json_file
+
+
+def get_failed_upload():
+    files = get_queue_files(failed_folder, 1, by_priority=False)
+    return files[0] if files else None
+
+
+def api_file_move(json_file, new_folder, name=None):
     print_b(" " + os.path.basename(json_file) + " >> " + new_folder)
-    ret = os.path.join(new_folder, os.path.basename(json_file))
+    ret = os.path.join(new_folder, name or os.path.basename(json_file))
     shutil.move(json_file, ret)
+
+    if QUEUE:
+        QUEUE.moved(json_file, ret)
+
+    if LEASES:
+        LEASES.release(json_file)
+
+    folder = os.path.abspath(new_folder)
+    api_job_state(ret, FOLDER_STATES.get(folder, "unknown"), DELIVERED.get(folder))
+
+    job_type = getattr(thread_state, "job_type", None)
+    if job_type and folder in FAILED_FOLDERS:
+        JOBS.inc(type=job_type, outcome=FOLDER_STATES[folder])
+
     return ret
 
 
-def api_update_stats(total_time):
-    stats_file = ".stats.json"
-    try:
-        if os.path.isfile(stats_file):
-            with open(stats_file, "r") as f:
-                data = json.load(f)
-
-                data["files_processed"] += 1
-                data["total_time"] += total_time
-                data["average_time"] = round(
-                    data["total_time"] / data["files_processed"], 2
-                )
-        else:
-            data = {
-                "files_processed": 1,
-                "total_time": total_time,
-                "average_time": total_time,
-            }
+def api_file_remove(json_file):
+    os.remove(json_file)
 
-        with open(stats_file, "w") as f:
-            json.dump(data, f, indent=4)
+    if QUEUE:
+        QUEUE.remove(json_file)
 
-    except json.JSONDecodeError as e:
-        os.remove(stats_file)  # Delete the file if it's invalid
+    if LEASES:
+        LEASES.release(json_file)
+
+    api_job_state(json_file, "removed")
+
+
+def api_file_claim(json_file):
+    """Move the job into processing, None if another worker claimed it first."""
+    if not LEASES:
+        claimed = api_file_move(json_file, processing_folder)
+    else:
+        claimed = LEASES.claim(json_file)
+        if claimed:
+            print_b(" " + os.path.basename(json_file) + " >> " + processing_folder)
+
+    if not claimed:
+        return None
+
+    # A result coming back from FAILED is still done, only its callback is retried
+    if os.path.abspath(os.path.dirname(json_file)) == os.path.abspath(failed_folder):
+        api_job_state(claimed, "done", False)
+    else:
+        api_job_state(claimed, "processing")
+
+    return claimed
+
+
+def api_job_state(json_file, state, delivered=None):
+    if not JOB_STATES:
         return
+
+    try:
+        JOB_STATES.update(json_file, state, delivered)
     except Exception as e:
-        print_exception(e, "CRASHED")
+        print_exception(e, "JOB STATE FAILED")
+
+
+def api_requeue_stale_jobs():
+    for json_file in LEASES.reap(source_folder):
+        print_r(" STALE CLAIM, BACK TO THE QUEUE " + json_file)
+
+        folder = os.path.abspath(os.path.dirname(json_file))
+        api_job_state(json_file, FOLDER_STATES.get(folder, "queued"), DELIVERED.get(folder))
+
+
+def api_abandon_job(folder):
+    """The job of this thread crashed, take it out of processing.
+
+    Only the job being processed, the results waiting on their callback
+    belong to the delivery threads.
+    """
+    json_file = getattr(thread_state, "json_file", None)
+    thread_state.json_file = None
+
+    if json_file and os.path.exists(json_file):
+        api_file_move(json_file, folder)
+
+
+def remove_partial():
+    """The result is delivered, the partial answer of the job is not needed."""
+    partial_file = getattr(thread_state, "partial_file", None)
+    if not partial_file:
         return
 
+    thread_state.partial_file = None
+    try:
+        os.remove(partial_file)
+    except FileNotFoundError:
+        pass
 
-def main(host: str, port: int):
-    # Loop through the folder and process the oldest JSON file
 
-    global MODEL, NUM_CTX
+def get_fallback(model):
+    """Model for the retry of a lazy answer, counted for the fallback rate."""
+    fallback = RESIDENCY.fallback_for(model)
+    FALLBACKS.inc(model=model, fallback=fallback)
+    return fallback
+
+
+def api_update_stats(total_time, model=None, job_type=None, job_class=None):
+    if not STATS:
+        return
 
+    try:
+        STATS.record(
+            total_time,
+            model,
+            job_type,
+            getattr(thread_state, "stage_times", None),
+            job_class,
+        )
+    except Exception as e:
+        print_exception(e, "STATS FAILED")
+
+
+def add_stage_time(stage, seconds):
+    """Time the job running on this thread spent on a stage."""
+    stage_times = getattr(thread_state, "stage_times", None)
+    if stage_times is not None:
+        stage_times[stage] = round(stage_times.get(stage, 0) + seconds, 3)
+
+
+def retry_failed_upload():
     # Try to process failed uploads, maybe the service is back up
-    json_file = get_oldest_file(failed_folder)
+    json_file = get_failed_upload()
     if json_file:
-        upload_file(json_file)
+        json_file = api_file_claim(json_file)
+        if json_file:
+            upload_file(json_file)
 
-    # We process first priority orders
-    json_file = get_oldest_file(priority_folder)
-    if not json_file:
-        json_file = get_oldest_file_by_priority(source_folder)
 
-    # Process our queue being the first ones more important
-    if not json_file:
-        print_g(">> No JSON files to process. " + str(datetime.now()), in_place=True)
-        return
+def claim_next_job():
+    """Claim the next job of the queue.
+
+    Returns the claimed file, False if there is nothing to do and None if
+    another worker claimed the job first.
+    """
+
+    skip = set()
+    while True:
+        # We process first priority orders
+        json_file = get_next_job(skip)
+
+        # Process our queue being the first ones more important
+        if not json_file:
+            print_g(">> No JSON files to process. " + str(datetime.now()), in_place=True)
+            return False
+
+        # The launcher renames the job into the queue, its ctime is the upload time
+        try:
+            queued_at = os.path.getctime(json_file)
+        except OSError:
+            queued_at = None
+
+        # Move file to processing folder
+        claimed = api_file_claim(json_file)
+        if claimed:
+            break
+
+        print_r(" ALREADY CLAIMED " + os.path.basename(json_file))
+
+        # Another worker won the race
+        if not os.path.exists(json_file):
+            return None
+
+        # The same job is in processing, this copy waits and the next one goes
+        skip.add(json_file)
+        if len(skip) >= CLAIM_SKIP_MAX:
+            return False
+
+    if queued_at:
+        QUEUE_WAIT.observe(
+            time.time() - queued_at, queue=os.path.basename(os.path.dirname(json_file))
+        )
+
+    return claimed
+
+
+def main(host: str, port: int):
+    """Process one job from the queue.
+
+    Returns True if a job was picked from the queue, False if it was empty.
+    """
+
+    thread_state.json_file = None
+
+    if not DELIVERY:
+        retry_failed_upload()
+
+    json_file = claim_next_job()
+    if json_file is False:
+        return False
+
+    if json_file:
+        process_job(json_file)
+
+    return True
+
+
+def process_job(json_file):
+    """Run a claimed job and deliver its result.
+
+    The model and num_ctx are per job, several jobs can run at the same time
+    on the worker pool threads.
+    """
+
+    thread_state.json_file = json_file
+    thread_state.cache_hits = 0
+    thread_state.cache_misses = 0
+    thread_state.stream = None
+    thread_state.partial_file = None
+    thread_state.job_type = None
+    thread_state.stage_times = {}
 
     # Load the JSON data
     try:
@@ -1051,24 +1802,24 @@ def main(host: str, port: int):
             data = json.load(f)
     except json.JSONDecodeError as e:
         print_e(f"Invalid JSON format in file: {json_file}. Error: {e}")
-        os.remove(json_file)  # Delete the file if it's invalid
+        api_file_remove(json_file)  # Delete the file if it's invalid
         print_r(f"Deleted invalid file: {json_file}")
-        return
+        return True
 
     # Check the expected format
     if "id" not in data or "callback_url" not in data:
         print_e(f"Invalid format in file: {json_file}")
-        os.remove(json_file)
-        return
+        api_file_remove(json_file)
+        return True
 
     print_w(" " + data["id"])
 
-    # Move file to processing folder
-    json_file = api_file_move(json_file, processing_folder)
-
     translation = False
     res_json = None
     result = None
+    tickers = None
+    enrich = False
+    duplicate = None
     message = ""
 
     start_time = time.time()
@@ -1077,43 +1828,58 @@ def main(host: str, port: int):
     if "type" in data and data["type"]:
         my_type = data["type"]
 
-    if "model" in data:
-        MODEL = data["model"]
+    thread_state.job_type = str(my_type)
 
-    if "num_ctx" in data:
-        NUM_CTX = data["num_ctx"]
+    # Same class as the launcher gave the job in the queue index
+    job_class = get_job_class(data)
+
+    model = data.get("model", DEFAULT_MODEL)
+    num_ctx = choose_num_ctx(data)
+
+    # Chats publish their answer while it is generated
+    if STREAMING and (my_type == "user_prompt" or (my_type == "raw_llama" and not data.get("raw_tools"))):
+        thread_state.partial_file = os.path.join(partial_folder, os.path.basename(json_file))
 
     if "hostname" not in data or data["hostname"] not in VALID_HOSTNAMES:
         print_r(">> REJECTED " + str(data["hostname"]))
         api_file_move(json_file, rejected_folder)
-        return
+        return True
 
     if my_type == "raw_llama":
         print_g(" RUNNING LLAMA IN RAW MODE >> " + str(data["subtype"]))
 
         if data.get("raw_tools"):
             print_g(" RAW TOOLS ")
-            print_g(" CHAT MESSAGE >> " + MODEL + " " + str(NUM_CTX))
+            print_g(" CHAT MESSAGE >> " + model + " " + str(num_ctx))
 
             res_json = run_prompt_function(
-                data["raw_messages"], data["raw_tools"], MODEL
+                data["raw_messages"], data["raw_tools"], model, num_ctx
             )
             if not res_json:
                 print_r(" RETRY, MAYBE OUR LLAMA 3.1 WAS LAZY")
                 res_json = run_prompt_function(
-                    data["raw_messages"], data["raw_tools"], "llama3.2"
+                    data["raw_messages"],
+                    data["raw_tools"],
+                    get_fallback(model),
+                    num_ctx,
                 )
 
             if not res_json:
                 print_r(" FAILED LLAMA3.2 TOO ")
         else:
-            print_g(" CHAT MESSAGE >> " + MODEL + " " + str(NUM_CTX))
+            print_g(" CHAT MESSAGE >> " + model + " " + str(num_ctx))
 
-            response = ollama.chat(
-                model=MODEL,
-                messages=data["raw_messages"],
-                options={"num_ctx": NUM_CTX},
-            )
+            try:
+                response = cached_chat(
+                    model=model,
+                    messages=data["raw_messages"],
+                    options={"num_ctx": num_ctx},
+                    keep_alive=RESIDENCY.keep_alive(model),
+                )
+            except GenerationAborted:
+                remove_partial()
+                api_file_move(json_file, ai_timeout)
+                return True
             # Process the message using the run_main function
 
             result = response["message"]["content"]
@@ -1124,29 +1890,69 @@ def main(host: str, port: int):
         if my_type == "translation":
             print_h(" FOUND TRANSLATION ")
             translation = True
-            res_json = run_translation(message)
+            res_json = run_translation(message, model)
 
         system = get_generic_system(data)
 
-        assistant, message, call_tools = get_legacy(data)
-        arr_messages = get_generic_messages(data, system, assistant, message)
+        job = data if translation else strip_boilerplate(data)
+
+        assistant, message, call_tools = get_legacy(job)
+        arr_messages = get_generic_messages(job, system, assistant, message)
+
+        enrich = call_tools and not translation
 
-        print_g(">> MODEL " + MODEL)
+        print_g(">> MODEL " + model + " NUM_CTX " + str(num_ctx))
         print(str(message))
 
+        if enrich:
+            duplicate = find_duplicate(model, system, assistant, message)
+
+        if not translation and not duplicate:
+            learn_boilerplate(data)
+
         try:
             if not translation:
-                response = ollama.chat(
-                    model=MODEL,
-                    messages=arr_messages,
-                    options={"num_ctx": NUM_CTX},
-                )
-                # Process the message using the run_main function
+                if duplicate:
+                    print_g(
+                        f" NEAR DUPLICATE OF {duplicate['job_id']} {duplicate['similarity']}"
+                    )
+                    data["at_duplicate_of"] = duplicate["job_id"]
+                    data["at_similarity"] = duplicate["similarity"]
+
+                    # The tickers are already in the stored dict
+                    result = duplicate["result"]["ai_summary"]
+                    res_json = duplicate["result"]["dict"]
+                    tickers = []
+
+                    res = res_json[0]["function"]["arguments"]
+                    res["model"] = model
+                    res["process_time"] = 0
+
+                elif enrich:
+                    context = get_enrichment_context(
+                        system, assistant, message, arr_messages
+                    )
+                    enrichment = run_enrichment(context, model, num_ctx=num_ctx)
+                    data["at_stage_times"] = enrichment.timings
+
+                    if "summary" in enrichment.errors:
+                        raise enrichment.errors["summary"]
+
+                    result = enrichment.outputs["summary"]
+                    res_json = get_article_dict(enrichment, model)
+                    tickers = enrichment.outputs.get("tickers", [])
+                else:
+                    response = cached_chat(
+                        model=model,
+                        messages=arr_messages,
+                        options={"num_ctx": num_ctx},
+                        keep_alive=RESIDENCY.keep_alive(model),
+                    )
+                    # Process the message using the run_main function
 
-                result = response["message"]["content"]
-                result = re.sub(
-                    r"(?i)summary.*(text|article).*markdown.*facts[:\s]*", "", result
-                )
+                    result = response["message"]["content"]
+
+                result = clean_summary(result)
 
                 console.print(Markdown(result))
 
@@ -1157,10 +1963,18 @@ def main(host: str, port: int):
 
             if call_tools:
 
-                res_json = run_prompt(system, assistant, message, MODEL)
+                if not enrich:
+                    res_json = run_prompt(system, assistant, message, model, num_ctx)
+
                 if not res_json:
                     print_r(" RETRY, MAYBE OUR LLAMA 3.1 WAS LAZY")
-                    res_json = run_prompt(system, assistant, message, "llama3.2")
+                    res_json = run_prompt(
+                        system,
+                        assistant,
+                        message,
+                        get_fallback(model),
+                        num_ctx,
+                    )
 
                 if not res_json:
                     print_r(" FAILED LLAMA3.2 TOO ")
@@ -1168,16 +1982,20 @@ def main(host: str, port: int):
         except TimeoutError as e:
             print(e)
             print("---------------- TIMEOUT DOING PROCESSING --------------")
+            remove_partial()
             api_file_move(json_file, ai_timeout)
+            return True
 
         except Exception as e:
+            remove_partial()
             api_file_move(json_file, ai_crashed)
             print_r(f"Failed to contact inference {json_file}: {e}")
+            return True
 
     if not translation and not result and not res_json:
         print_r(f"NO RESULT {json_file}")
         api_file_move(json_file, ai_crashed)
-        return
+        return True
 
     if res_json != None:
         data["type"] = "dict"
@@ -1185,12 +2003,14 @@ def main(host: str, port: int):
         if result:
             data["ai_summary"] = str(result).replace("StepType.inference> ", "")
 
-            try:
-                res = run_company_tickers_extraction(data["ai_summary"], MODEL)
-                if res:
-                    data["dict"].extend(res)
-            except Exception as e:
-                print_exception(e, "CRASH")
+            if tickers is None:
+                try:
+                    tickers = run_company_tickers_extraction(data["ai_summary"], model)
+                except Exception as e:
+                    print_exception(e, "CRASH")
+
+            if tickers:
+                data["dict"].extend(tickers)
 
     else:
         if result:
@@ -1202,20 +2022,360 @@ def main(host: str, port: int):
         print_w(" " + data["id"])
 
         data["at_process_time_secs"] = round(end_time - start_time, 2)
+        data["at_num_ctx"] = num_ctx
+
+        if thread_state.stream:
+            data["at_stream"] = thread_state.stream
+
+        # Served from the cache when no model call was made for this job
+        cache_hits = getattr(thread_state, "cache_hits", 0)
+        if CACHE and cache_hits:
+            data["at_cache_hit"] = not getattr(thread_state, "cache_misses", 0)
+            data["at_cache_hits"] = cache_hits
+
         print_b(f" Process Time {end_time - start_time:.2f} secs ")
 
         with open(json_file, "w") as f:
             json.dump(data, f, indent=4)
 
-        upload_file(json_file)
+        deliver_result(json_file, data)
 
     except Exception as e:
         print_e(f"Failed to save result to file {json_file}: {e}")
 
-    api_update_stats(time.time() - start_time)
+    if enrich and not duplicate:
+        remember_article(data, model, system, assistant, message)
+
+    remove_partial()
+
+    JOBS.inc(type=str(my_type), outcome="done")
+    JOB_SECONDS.observe(time.time() - start_time, type=str(my_type))
+
+    api_update_stats(time.time() - start_time, model, my_type, job_class)
 
     BEXIT = True
 
 
+def run_pool(host, port, workers):
+    """Run up to `workers` jobs at the same time on a thread pool.
+
+    This thread picks and claims the jobs, in the same order as the single
+    worker, and hands them to the pool when a slot is free. Ollama serves
+    OLLAMA_NUM_PARALLEL requests at the same time on a loaded model, the pool
+    keeps those slots busy from one process. There is no SIGALRM on the pool
+    threads, the ollama clients time out after JOB_TIMEOUT instead.
+    """
+
+    slots = threading.Semaphore(workers)
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="llama-job")
+
+    def run_job(json_file):
+        try:
+            process_job(json_file)
+        except Exception as e:
+            print_exception(e, "JOB CRASHED")
+            remove_partial()
+            api_abandon_job(ai_crashed)
+        finally:
+            slots.release()
+
+    print_g(f" WORKER POOL {workers} SLOTS")
+
+    idle_sleep = IDLE_SLEEP_MIN
+    last_reap = 0
+    while not STOP_EVENT.is_set():
+        if LEASES and time.time() - last_reap > LEASES.lease_ttl / 2:
+            api_requeue_stale_jobs()
+            last_reap = time.time()
+
+        # Wait for a free slot, but keep listening to SIGTERM
+        if not slots.acquire(timeout=1):
+            continue
+
+        try:
+            if not DELIVERY:
+                retry_failed_upload()
+
+            json_file = claim_next_job()
+        except Exception as e:
+            print_exception(e, "DISPATCH CRASHED")
+            json_file = False
+
+        if not json_file:
+            slots.release()
+
+            if json_file is False:
+                STOP_EVENT.wait(idle_sleep)
+                idle_sleep = min(idle_sleep * 2, IDLE_SLEEP_MAX)
+
+            continue
+
+        idle_sleep = IDLE_SLEEP_MIN
+        pool.submit(run_job, json_file)
+
+    # Let the running jobs finish, their leases keep beating until then
+    print_g(" WAITING FOR RUNNING JOBS ")
+    pool.shutdown(wait=True)
+
+
+def run_daemon(host, port):
+    """Keep the interpreter, clients and schemas warm and process jobs until SIGTERM."""
+
+    signal.signal(signal.SIGTERM, stop_handler)
+    signal.signal(signal.SIGINT, stop_handler)
+
+    print_h(" LLAMA WORKER DAEMON " + str(os.getpid()))
+    RESIDENCY.preload()
+
+    if DELIVERY:
+        threading.Thread(target=delivery_loop, daemon=True).start()
+
+    if WORKERS > 1:
+        run_pool(host, port, WORKERS)
+    else:
+        run_loop(host, port)
+
+    if DELIVERY:
+        stop_delivery()
+
+    if LEASES:
+        LEASES.stop()
+
+    if CACHE:
+        print_g(" CACHE " + json.dumps(CACHE.stats()))
+
+    if STATS:
+        STATS.stop()
+
+    print_h(" LLAMA WORKER STOPPED ")
+
+
+def run_loop(host, port):
+    """One job at a time on the main thread, SIGALRM enforces JOB_TIMEOUT."""
+
+    idle_sleep = IDLE_SLEEP_MIN
+    last_reap = 0
+    while not STOP_EVENT.is_set():
+        if LEASES and time.time() - last_reap > LEASES.lease_ttl / 2:
+            api_requeue_stale_jobs()
+            last_reap = time.time()
+
+        signal.alarm(JOB_TIMEOUT)
+        try:
+            found = main(host, port)
+        except Exception as e:
+            signal.alarm(0)
+            print_exception(e, "JOB CRASHED")
+            remove_partial()
+
+            if LEASES:
+                api_abandon_job(ai_timeout if isinstance(e, TimeoutError) else ai_crashed)
+
+            found = True
+        finally:
+            signal.alarm(0)
+
+        if found:
+            idle_sleep = IDLE_SLEEP_MIN
+            continue
+
+        # Empty queue, wait without spinning. A SIGTERM wakes us up straight away.
+        STOP_EVENT.wait(idle_sleep)
+        idle_sleep = min(idle_sleep * 2, IDLE_SLEEP_MAX)
+
+
+def worker(
+    host: str,
+    port: int,
+    daemon: bool = False,
+    concurrent: bool = False,
+    adaptive_ctx: bool = True,
+    num_ctx_buckets=None,
+    affinity: bool = False,
+    lookahead: int = 64,
+    max_delay: int = 60,
+    pin=None,
+    keep_alive="5m",
+    fallback: str = FALLBACK_MODEL,
+    index: bool = True,
+    worker_id: str = None,
+    lease_ttl: int = 120,
+    workers: int = 1,
+    cache: bool = True,
+    cache_max_age: int = 7 * 24 * 3600,
+    cache_max_mb: int = 256,
+    dedup: bool = True,
+    dedup_threshold: float = 0.8,
+    dedup_window: int = 100000,
+    boilerplate: bool = True,
+    learn_boilerplate: bool = True,
+    delivery: bool = True,
+    callback_concurrency: int = 8,
+    callback_timeout: int = 30,
+    callback_failures: int = 5,
+    callback_probe: int = 30,
+    callback_batch_size: int = 50,
+    callback_batch_wait: float = 2,
+    callback_batch_hosts=None,
+    stream: bool = True,
+    stream_max_tokens: int = 8192,
+    stream_max_secs: int = 240,
+    stream_stall: int = 120,
+    job_states: bool = True,
+    metrics_port: int = 9108,
+):
+    """Process a single job, or run as a long lived worker with --daemon.
+
+    --concurrent fans out the independent article stages, set OLLAMA_NUM_PARALLEL
+    on the Ollama server so they really run in parallel.
+
+    --num_ctx_buckets=4096,16384,55000 sets the context sizes the adaptive
+    num_ctx picks from, --noadaptive_ctx always sends NUM_CTX.
+
+    --affinity runs queued jobs in batches of the same model and num_ctx,
+    looking --lookahead jobs ahead. A job is not skipped for more than
+    --max_delay seconds.
+
+    --pin=llama3.1,llama3.2 are the models kept loaded and preloaded by the
+    daemon, the default model is always pinned. Other models unload after
+    --keep_alive. Lazy answers retry on --fallback if it is loaded.
+
+    The queue is read from the SQLite index in DATA/queue.sqlite, rebuilt from
+    the folders on startup. --noindex scans the queue folders on every job,
+    the delivery threads still index DATA/FAILED.
+
+    Jobs are claimed with a lease in DATA/PROCESSING, so any number of workers
+    can share the DATA folder. A job whose lease is not refreshed for
+    --lease_ttl seconds goes back to the queue.
+
+    --workers=4 runs 4 jobs at the same time in the daemon, set it to the
+    OLLAMA_NUM_PARALLEL of the Ollama server.
+
+    LLM results are cached in DATA/cache.sqlite for --cache_max_age seconds
+    and up to --cache_max_mb, --nocache always calls the model.
+
+    Articles with a MinHash similarity over --dedup_threshold with one of the
+    last --dedup_window articles reuse its enrichment. --nodedup runs every
+    article.
+
+    Known boilerplate is stripped from the articles before inference, and
+    sentences repeated across many articles are learned as boilerplate.
+    --nolearn_boilerplate only uses the known patterns, --noboilerplate
+    sends the articles untouched.
+
+    In daemon mode the callbacks go out on --callback_concurrency delivery
+    threads, the next job doesn't wait for them. Results in FAILED are
+    retried with exponential backoff. --nodelivery sends the callback
+    before the next job, like the one shot mode.
+
+    A callback host that fails --callback_failures times in a row is parked,
+    a single probe goes out every --callback_probe seconds (doubling while
+    it fails) and the backlog is flushed when the host is back.
+
+    Jobs with "callback_batch": true, and every job going to one of
+    --callback_batch_hosts=api.example.com,..., are posted together as
+    {"batch": [...]} once --callback_batch_size results are waiting or after
+    --callback_batch_wait seconds.
+
+    Chats without tools are streamed, the text stages of the article pipeline
+    (the summary) too, the callback gets the time to first token and the
+    tokens per second in at_stream. A generation is aborted
+    after --stream_max_tokens tokens, --stream_max_secs seconds or
+    --stream_stall seconds without a token. user_prompt and raw_llama chats
+    write their answer so far to DATA/PARTIAL. --nostream waits for the
+    whole answer.
+
+    Every move of a job is recorded in DATA/queue.sqlite for the launcher
+    /api_v1/jobs/<id> status API, --nojob_states doesn't record them.
+
+    Job and stage times go to DATA/stats.sqlite, the launcher estimates the
+    queue from them and serves their percentiles on /api_v1/stats. The daemon
+    writes a heartbeat with its --workers there too, /api_v1/eta spreads the
+    queue on the live slots.
+
+    The daemon serves Prometheus metrics on http://0.0.0.0:--metrics_port/metrics,
+    give every worker of the host its own port. --metrics_port=0 turns it off.
+    """
+    global CONCURRENT_STAGES, ADAPTIVE_NUM_CTX, NUM_CTX_BUCKETS, SCHEDULER, QUEUE
+    global LEASES, WORKERS, CACHE, DEDUP, BOILERPLATE, DELIVERY, STREAMING, JOB_STATES
+    global STATS
+    CONCURRENT_STAGES = concurrent
+    WORKERS = max(1, int(workers))
+    ADAPTIVE_NUM_CTX = adaptive_ctx
+
+    if num_ctx_buckets:
+        if isinstance(num_ctx_buckets, str):
+            num_ctx_buckets = num_ctx_buckets.split(",")
+
+        NUM_CTX_BUCKETS = [int(size) for size in num_ctx_buckets]
+
+    if affinity:
+        SCHEDULER = AffinityScheduler(job_affinity, lookahead, max_delay)
+
+    if isinstance(pin, str):
+        pin = pin.split(",")
+
+    RESIDENCY.pinned = [DEFAULT_MODEL] + list(pin or [])
+    RESIDENCY.default_keep_alive = keep_alive
+    RESIDENCY.fallback = fallback
+
+    if index:
+        QUEUE = QueueIndex(QUEUE_DB, [source_folder, priority_folder, failed_folder])
+    elif daemon and delivery:
+        # The delivery loop pages through FAILED, don't list it every second
+        QUEUE = QueueIndex(QUEUE_DB, [failed_folder])
+
+    if QUEUE:
+        QUEUE.rebuild()
+
+    if job_states:
+        JOB_STATES = JobStates(QUEUE_DB)
+
+    STATS = StatsStore(STATS_DB)
+
+    LEASES = JobLeases(processing_folder, worker_id, lease_ttl, QUEUE)
+    LEASES.start()
+
+    if cache:
+        CACHE = InferenceCache(CACHE_DB, cache_max_age, cache_max_mb << 20)
+
+    if dedup:
+        DEDUP = NearDuplicateIndex(DEDUP_DB, dedup_threshold, dedup_window)
+
+    if boilerplate:
+        BOILERPLATE = BoilerplateStripper(BOILERPLATE_DB, learn=learn_boilerplate)
+
+    if stream:
+        STREAMING = StreamingChat(JOB_TIMEOUT, stream_max_tokens, stream_max_secs, stream_stall)
+
+    if isinstance(callback_batch_hosts, str):
+        callback_batch_hosts = callback_batch_hosts.split(",")
+
+    if daemon:
+        STATS.start(LEASES.worker_id, WORKERS)
+
+        if metrics_port:
+            llama_metrics.serve(metrics_port)
+
+        if delivery:
+            DELIVERY = CallbackDelivery(
+                upload_file,
+                callback_concurrency,
+                callback_timeout,
+                failure_threshold=callback_failures,
+                reset_timeout=callback_probe,
+                load=load_result,
+                finish=finish_upload,
+                batch_size=callback_batch_size,
+                batch_wait=callback_batch_wait,
+                batch_hosts=callback_batch_hosts,
+            )
+
+        return run_daemon(host, port)
+
+    signal.alarm(JOB_TIMEOUT)
+    main(host, port)
+
+
 if __name__ == "__main__":
-    fire.Fire(main)
+    fire.Fire(worker)
@@ -0,0 +1,208 @@
+import os
+import re
+import math
+import time
+import hashlib
+import sqlite3
+import threading
+
+BOILERPLATE_DB = "./DATA/boilerplate.sqlite"
+
+# Known junk of the feeds we process, keep adding here when you find more
+BOILERPLATE_PATTERNS = [
+    # Zacks, the footer with the free reports runs to the end of the article
+    r"Want the latest recommendations from Zacks Investment Research\?(.|\n)*$",
+    r"To read this article on Zacks\.com click here\.?",
+    r"(Zacks Investment Research )?Image Source: Zacks Investment Research",
+    r"Zacks Investment Research\s*$",
+    # Insider Monkey
+    r"A copy of the letter can be downloaded here\.",
+    r"In addition, please check the fund’s top five holdings to know its best picks in \d{4}\.",
+    r"If you are looking for an AI stock that is as promising as NVIDIA[^.]*\.[^.]*cheapest AI stock\.",
+    r"In addition, please check out our hedge fund investor letters Q\d \d{4} page for more investor letters from hedge funds and other leading investors\.",
+    r"READ NEXT:[^.]*\.",
+    r"Disclosure: None\.",
+    r"This article is originally published at Insider Monkey\.",
+    # Yahoo and the rest
+    r"View Comments",
+    r"We use cookies[^.]*\.",
+    r"By clicking [\"“]?Accept[^.]*\.",
+    r"Sign in to access your portfolio",
+]
+
+sentence_re = re.compile(r"[^.!?\n]+[.!?]*")
+word_re = re.compile(r"\w+")
+
+
+def normalize(segment):
+    return " ".join(word_re.findall(segment.lower()))
+
+
+def segment_hash(segment):
+    digest = hashlib.blake2b(normalize(segment).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+
+class BoilerplateStripper:
+    """Takes the boilerplate out of the articles before they go to the model.
+
+    Two passes: the maintained BOILERPLATE_PATTERNS, then the sentences we
+    learned are boilerplate because they showed up in min_docs different
+    articles, and in at least min_share of the articles of the last
+    doc_window seconds, so a story syndicated to 20 outlets on a busy day
+    is not taken for a footer. Sentences shorter than min_words are never
+    learned, they are too likely to be real content ("Shares rose 2%.").
+
+    Every document is counted once, a retried job doesn't count again. The
+    worker only learns from the articles that are not near duplicates.
+
+    Sentence counts live in SQLite, the ones seen once are forgotten after
+    forget_after seconds so the table doesn't grow with the corpus.
+    """
+
+    def __init__(
+        self,
+        db_path=BOILERPLATE_DB,
+        patterns=BOILERPLATE_PATTERNS,
+        learn=True,
+        min_docs=20,
+        min_share=0.01,
+        min_words=6,
+        refresh_every=50,
+        forget_after=24 * 3600,
+        doc_window=7 * 24 * 3600,
+    ):
+        self.patterns = [re.compile(p, re.IGNORECASE) for p in patterns]
+        self.learning = learn
+        self.min_docs = min_docs
+        self.min_share = min_share
+        self.doc_window = doc_window
+        self.threshold = min_docs
+        self.min_words = min_words
+        self.refresh_every = refresh_every
+        self.forget_after = forget_after
+
+        self.lock = threading.RLock()
+        self.learned = set()
+        self.docs = 0
+        self.db = None
+
+        if not learn:
+            return
+
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+
+        self.db = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS segments (
+                hash INTEGER PRIMARY KEY,
+                docs INTEGER NOT NULL,
+                last_seen REAL NOT NULL,
+                sample TEXT
+            );
+            CREATE INDEX IF NOT EXISTS segments_docs ON segments (docs);
+
+            CREATE TABLE IF NOT EXISTS documents (
+                doc_id TEXT PRIMARY KEY,
+                seen REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS documents_seen ON documents (seen);
+            """
+        )
+        self.db.commit()
+
+        self.refresh()
+
+    def refresh(self):
+        """Reload the learned boilerplate, other workers learn too."""
+        with self.lock:
+            corpus = self.db.execute(
+                "SELECT COUNT(*) FROM documents WHERE seen >= ?",
+                (time.time() - self.doc_window,),
+            ).fetchone()[0]
+            self.threshold = max(self.min_docs, math.ceil(self.min_share * corpus))
+
+            rows = self.db.execute(
+                "SELECT hash FROM segments WHERE docs >= ?", (self.threshold,)
+            )
+            self.learned = set(row[0] for row in rows)
+
+    def segments(self, text):
+        for match in sentence_re.finditer(text):
+            segment = match.group(0)
+            if len(word_re.findall(segment)) >= self.min_words:
+                yield match, segment
+
+    def learn(self, text, doc_id=None):
+        """Count the sentences of a document, once per doc_id."""
+        if not self.learning or not text:
+            return
+
+        now = time.time()
+        rows = {}
+        for _, segment in self.segments(text):
+            rows[segment_hash(segment)] = segment.strip()[:200]
+
+        if doc_id is None:
+            doc_id = str(segment_hash(text))
+
+        with self.lock:
+            seen = self.db.execute(
+                "INSERT OR IGNORE INTO documents (doc_id, seen) VALUES (?, ?)",
+                (str(doc_id), now),
+            )
+            if not seen.rowcount:
+                self.db.commit()
+                return
+
+            self.db.executemany(
+                """
+                INSERT INTO segments (hash, docs, last_seen, sample) VALUES (?, 1, ?, ?)
+                ON CONFLICT(hash) DO UPDATE SET docs = docs + 1, last_seen = excluded.last_seen
+                """,
+                [(h, now, sample) for h, sample in rows.items()],
+            )
+
+            self.docs += 1
+            if self.docs % (self.refresh_every * 10) == 0:
+                self.db.execute(
+                    "DELETE FROM segments WHERE docs = 1 AND last_seen < ?",
+                    (now - self.forget_after,),
+                )
+                self.db.execute(
+                    "DELETE FROM documents WHERE seen < ?", (now - self.doc_window,)
+                )
+
+            self.db.commit()
+
+            if self.docs % self.refresh_every == 0:
+                self.refresh()
+
+    def strip_learned(self, text):
+        if not self.learned:
+            return text
+
+        parts = []
+        last = 0
+        for match, segment in self.segments(text):
+            if segment_hash(segment) in self.learned:
+                parts.append(text[last : match.start()])
+                last = match.end()
+
+        parts.append(text[last:])
+        return "".join(parts)
+
+    def strip(self, text):
+        """The text without boilerplate, whitespace collapsed."""
+        if not text or not isinstance(text, str):
+            return text
+
+        for pattern in self.patterns:
+            text = pattern.sub(" ", text)
+
+        text = self.strip_learned(text)
+
+        return re.sub(r"[ \t]+", " ", text).strip()
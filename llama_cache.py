@@ -0,0 +1,176 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+
+CACHE_DB = "./DATA/cache.sqlite"
+
+
+def normalize_messages(messages):
+    """Only what the model sees, with the whitespace collapsed."""
+    normalized = []
+    for msg in messages or []:
+        entry = {
+            "role": msg.get("role"),
+            "content": " ".join(str(msg.get("content") or "").split()),
+        }
+        if msg.get("tool_calls"):
+            entry["tool_calls"] = json.loads(json.dumps(msg["tool_calls"], default=str))
+
+        normalized.append(entry)
+
+    return normalized
+
+
+def message_to_dict(message):
+    """Plain dict of an ollama response message, the way we store it."""
+    d = {"role": message["role"], "content": message["content"] or ""}
+
+    tool_calls = message.get("tool_calls") if hasattr(message, "get") else None
+    if tool_calls:
+        d["tool_calls"] = [
+            {
+                "function": {
+                    "name": tool["function"]["name"],
+                    "arguments": dict(tool["function"]["arguments"]),
+                }
+            }
+            for tool in tool_calls
+        ]
+
+    return d
+
+
+class InferenceCache:
+    """Results of the LLM calls on disk, keyed by what was asked.
+
+    The key is a sha256 of the model, the normalized messages, the tool
+    schemas and the options, so the same article sent twice under another id
+    is answered from here. Entries older than max_age seconds are dropped, and
+    the least recently used ones go when the cache is over max_bytes.
+    """
+
+    def __init__(self, db_path=CACHE_DB, max_age=7 * 24 * 3600, max_bytes=256 << 20):
+        self.db_path = db_path
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.puts = 0
+
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+
+        self.db = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS results (
+                key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                last_used REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS results_created ON results (created);
+            CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used);
+            """
+        )
+        self.db.commit()
+
+        self.evict()
+
+    def key(self, model, messages, tools=None, options=None, namespace="chat"):
+        """The namespace keeps apart values of different shapes, the chats
+        store the ollama message and the pipeline stages their parsed output."""
+        raw = json.dumps(
+            [namespace, model, normalize_messages(messages), tools or None, options or None],
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """The stored value, None on a miss."""
+        now = time.time()
+        with self.lock:
+            row = self.db.execute(
+                "SELECT value, created FROM results WHERE key = ?", (key,)
+            ).fetchone()
+
+            if not row or now - row[1] > self.max_age:
+                self.misses += 1
+                return None
+
+            self.db.execute("UPDATE results SET last_used = ? WHERE key = ?", (now, key))
+            self.db.commit()
+            self.hits += 1
+
+        return json.loads(row[0])
+
+    def put(self, key, model, value):
+        raw = json.dumps(value)
+        now = time.time()
+
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO results (key, model, value, size, created, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model, raw, len(raw), now, now),
+            )
+            self.db.commit()
+
+            self.puts += 1
+            if self.puts % 100 == 0:
+                self.evict()
+
+    def evict(self):
+        """Drop the expired entries, then the least recently used over max_bytes."""
+        with self.lock:
+            cur = self.db.execute(
+                "DELETE FROM results WHERE created < ?", (time.time() - self.max_age,)
+            )
+            evicted = cur.rowcount
+
+            total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+            if total > self.max_bytes:
+                rows = self.db.execute(
+                    "SELECT key, size FROM results ORDER BY last_used"
+                ).fetchall()
+
+                drop = []
+                for key, size in rows:
+                    if total <= self.max_bytes * 0.9:
+                        break
+
+                    drop.append((key,))
+                    total -= size
+
+                self.db.executemany("DELETE FROM results WHERE key = ?", drop)
+                evicted += len(drop)
+
+            self.db.commit()
+            self.evicted += evicted
+
+        return evicted
+
+    def stats(self):
+        with self.lock:
+            entries, size = self.db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results"
+            ).fetchone()
+
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0,
+            "entries": entries,
+            "size_bytes": size,
+            "evicted": self.evicted,
+        }
@@ -0,0 +1,78 @@
+import json
+import threading
+
+# Context sizes we load the models with. Few buckets means few runner reloads
+# in Ollama, every different num_ctx needs a reload of the model.
+NUM_CTX_BUCKETS = [4096, 8192, 16384, 32768, 55000]
+
+# Tokens left free for the answer, the tool calls write a few paragraphs
+RESPONSE_TOKENS = 2048
+
+# tiktoken is not the llama tokenizer, count a bit more to be safe
+TOKEN_MARGIN = 1.15
+
+# Tokens the chat template adds around every message
+MESSAGE_OVERHEAD = 8
+
+encoder = None
+encoder_failed = False
+encoder_lock = threading.Lock()
+
+
+def get_encoder():
+    global encoder, encoder_failed
+
+    if encoder or encoder_failed:
+        return encoder
+
+    # The pool threads would all download the encoding at the same time
+    with encoder_lock:
+        if encoder or encoder_failed:
+            return encoder
+
+        try:
+            import tiktoken
+
+            encoder = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            # No tiktoken or no way to download the encoding, use the estimate
+            print(" TIKTOKEN NOT AVAILABLE " + str(e))
+            encoder_failed = True
+
+    return encoder
+
+
+def count_tokens(text):
+    if not text:
+        return 0
+
+    enc = get_encoder()
+    if not enc:
+        return len(text) // 4 + 1
+
+    return len(enc.encode(text, disallowed_special=()))
+
+
+def estimate_tokens(messages=None, tools=None):
+    """Tokens of a chat request, the messages plus the tool schemas."""
+    total = 0
+
+    for msg in messages or []:
+        total += count_tokens(str(msg.get("content") or "")) + MESSAGE_OVERHEAD
+
+    if tools:
+        total += count_tokens(json.dumps(tools))
+
+    return total
+
+
+def pick_num_ctx(tokens, buckets=None):
+    """Smallest bucket that fits the prompt and the answer, the largest otherwise."""
+    buckets = sorted(buckets or NUM_CTX_BUCKETS)
+
+    needed = int(tokens * TOKEN_MARGIN) + RESPONSE_TOKENS
+    for size in buckets:
+        if size >= needed:
+            return size
+
+    return buckets[-1]
@@ -0,0 +1,210 @@
+import os
+import re
+import json
+import time
+import random
+import hashlib
+import sqlite3
+import threading
+
+from array import array
+
+DEDUP_DB = "./DATA/dedup.sqlite"
+
+# Hash functions of the MinHash signature
+NUM_PERM = 128
+
+# Shorter texts are too easy to match, a one line headline is not a rewrite
+MIN_WORDS = 50
+
+MERSENNE_PRIME = (1 << 61) - 1
+
+word_re = re.compile(r"\w+")
+
+# Same permutations on every worker and every run, the signatures are stored
+perm_random = random.Random(20240829)
+PERMUTATIONS = [
+    (perm_random.randrange(1, MERSENNE_PRIME), perm_random.randrange(0, MERSENNE_PRIME))
+    for _ in range(NUM_PERM)
+]
+
+
+def shingles(text, size=3):
+    """Word 3-grams, a roundup with other companies shares few of them."""
+    words = word_re.findall(text.lower())
+    if len(words) < size:
+        return set(words)
+
+    return set(" ".join(words[i : i + size]) for i in range(len(words) - size + 1))
+
+
+def minhash(text):
+    """MinHash signature of the text shingles, 32 bits per hash function."""
+    hashes = [
+        int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "big")
+        for s in shingles(text)
+    ]
+    if not hashes:
+        return array("I", [0] * NUM_PERM)
+
+    return array(
+        "I",
+        [min((a * h + b) % MERSENNE_PRIME for h in hashes) & 0xFFFFFFFF for a, b in PERMUTATIONS],
+    )
+
+
+def load_signature(blob):
+    signature = array("I")
+    signature.frombytes(blob)
+    return signature
+
+
+def jaccard(sig_a, sig_b):
+    """Estimated Jaccard similarity of the two shingle sets."""
+    return sum(1 for a, b in zip(sig_a, sig_b) if a == b) / len(sig_a)
+
+
+def lsh_rows(threshold):
+    """Rows per band so the LSH catches pairs a bit below the threshold."""
+    best = 1
+    for rows in (1, 2, 4, 8, 16, 32):
+        bands = NUM_PERM // rows
+        if (1 / bands) ** (1 / rows) <= threshold - 0.05:
+            best = rows
+
+    return best
+
+
+class NearDuplicateIndex:
+    """MinHash LSH index of the articles we processed lately.
+
+    Every article keeps a MinHash signature of its word 3-grams. The signature
+    is cut in bands, articles that share a band are candidates and we keep the
+    ones whose estimated Jaccard similarity is over the threshold. A lookup is
+    one indexed query per band plus a few signature compares.
+
+    Only the last `window` articles are kept, the oldest go first. scope is
+    whatever else has to be equal to reuse a result, the model and prompt.
+    """
+
+    def __init__(self, db_path=DEDUP_DB, threshold=0.8, window=100000, min_words=MIN_WORDS):
+        self.db_path = db_path
+        self.threshold = threshold
+        self.window = window
+        self.min_words = min_words
+        self.rows = lsh_rows(threshold)
+
+        self.lock = threading.RLock()
+        self.adds = 0
+
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+
+        self.db = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS articles (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                job_id TEXT,
+                scope TEXT NOT NULL,
+                signature BLOB NOT NULL,
+                created REAL NOT NULL,
+                result TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS bands (
+                band INTEGER NOT NULL,
+                value INTEGER NOT NULL,
+                article INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS bands_value ON bands (band, value);
+            CREATE INDEX IF NOT EXISTS bands_article ON bands (article);
+            """
+        )
+        self.db.commit()
+
+    def band_values(self, signature):
+        """(band, hash of the band rows), the band number is part of the key."""
+        values = []
+        for band, start in enumerate(range(0, NUM_PERM, self.rows)):
+            digest = hashlib.blake2b(
+                signature[start : start + self.rows].tobytes(), digest_size=8
+            ).digest()
+            values.append((band, int.from_bytes(digest, "big", signed=True)))
+
+        return values
+
+    def usable(self, text):
+        return bool(text) and len(word_re.findall(text)) >= self.min_words
+
+    def find(self, text, scope, candidates=50):
+        """Most similar article over the threshold, None if there is none.
+
+        Returns a dict with the job_id, the similarity and the stored result.
+        """
+        if not self.usable(text):
+            return None
+
+        signature = minhash(text)
+
+        with self.lock:
+            ids = set()
+            for band, value in self.band_values(signature):
+                rows = self.db.execute(
+                    "SELECT article FROM bands WHERE band = ? AND value = ? ORDER BY article DESC LIMIT ?",
+                    (band, value, candidates),
+                )
+                ids.update(row[0] for row in rows)
+
+            if not ids:
+                return None
+
+            rows = self.db.execute(
+                f"SELECT id, job_id, signature, result FROM articles WHERE scope = ? AND id IN ({','.join('?' * len(ids))})",
+                [scope] + list(ids),
+            ).fetchall()
+
+        best = None
+        for article_id, job_id, other, result in rows:
+            similarity = jaccard(signature, load_signature(other))
+            if similarity < self.threshold:
+                continue
+
+            if best is None or (similarity, article_id) > best[:2]:
+                best = (similarity, article_id, job_id, result)
+
+        if not best:
+            return None
+
+        return {
+            "job_id": best[2],
+            "similarity": round(best[0], 3),
+            "result": json.loads(best[3]),
+        }
+
+    def add(self, job_id, text, scope, result):
+        if not self.usable(text):
+            return
+
+        signature = minhash(text)
+
+        with self.lock:
+            cur = self.db.execute(
+                "INSERT INTO articles (job_id, scope, signature, created, result) VALUES (?, ?, ?, ?, ?)",
+                (job_id, scope, signature.tobytes(), time.time(), json.dumps(result)),
+            )
+            article_id = cur.lastrowid
+
+            self.db.executemany(
+                "INSERT INTO bands (band, value, article) VALUES (?, ?, ?)",
+                [(band, value, article_id) for band, value in self.band_values(signature)],
+            )
+
+            # Rolling window, ids only grow so the oldest are below a cut
+            self.adds += 1
+            if self.adds % 100 == 0:
+                cut = article_id - self.window
+                self.db.execute("DELETE FROM articles WHERE id <= ?", (cut,))
+                self.db.execute("DELETE FROM bands WHERE article <= ?", (cut,))
+
+            self.db.commit()
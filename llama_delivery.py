@@ -0,0 +1,465 @@
+import os
+import time
+import random
+import threading
+
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from llama_utils import print_g, print_r, print_e, print_exception
+from llama_metrics import CALLBACK_SECONDS, CALLBACK_RETRIES, CALLBACK_PARKED
+
+
+class CircuitBreaker:
+    """Stops sending to a callback host that keeps failing.
+
+    After failure_threshold failures in a row the breaker opens and nothing
+    goes to the host. Once reset_timeout has passed a single probe is let
+    through (half open): if it works the breaker closes, if it fails the
+    breaker opens again for twice as long, up to max_reset_timeout.
+
+    Only 5xx, 408, 429, timeouts and connection errors are failures of the
+    host. A 4xx means the host is up and refused that one payload.
+    """
+
+    def __init__(self, host, failure_threshold=5, reset_timeout=30, max_reset_timeout=600):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+
+        self.lock = threading.Lock()
+        self.state = "closed"
+        self.failures = 0
+        self.open_timeout = reset_timeout
+        self.next_probe = 0
+
+        # When ready() let the probe file go, the other files wait for its answer
+        self.probe_taken = 0
+
+    def ready(self):
+        """Can a file for this host go now. Once the breaker is due for its
+        probe only one file is let through, until allow() sends it or
+        reset_timeout passed."""
+        with self.lock:
+            if self.state == "closed":
+                return True
+
+            now = time.time()
+            if self.state != "open" or now < self.next_probe:
+                return False
+
+            if now - self.probe_taken < self.reset_timeout:
+                return False
+
+            self.probe_taken = now
+            return True
+
+    def allow(self):
+        with self.lock:
+            if self.state == "closed":
+                return True
+
+            if self.state == "open" and time.time() >= self.next_probe:
+                print_g(f" PROBING {self.host}")
+                self.state = "half_open"
+                return True
+
+            return False
+
+    def success(self):
+        """Returns True if the host just recovered."""
+        with self.lock:
+            recovered = self.state != "closed"
+
+            self.state = "closed"
+            self.failures = 0
+            self.open_timeout = self.reset_timeout
+            self.probe_taken = 0
+
+        if recovered:
+            print_g(f" CIRCUIT CLOSED {self.host}")
+
+        return recovered
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+
+            if self.state == "half_open":
+                self.open_timeout = min(self.open_timeout * 2, self.max_reset_timeout)
+            elif self.failures < self.failure_threshold:
+                return
+
+            self.state = "open"
+            self.next_probe = time.time() + self.open_timeout
+            self.probe_taken = 0
+
+        print_r(f" CIRCUIT OPEN {self.host} FOR {self.open_timeout} SECS")
+
+
+class CallbackDelivery:
+    """Sends the results to their callback_url away from the inference loop.
+
+    submit() only queues the file, up to `concurrency` callbacks are in
+    flight on the delivery threads. Every callback host gets its own pooled
+    session, so we don't set up a new TLS connection on every callback.
+
+    deliver(json_file) does the callback and moves the file, it returns True
+    when the callback took it. Files that failed are retried after an
+    exponential backoff with jitter, due() tells when.
+
+    Every host has a CircuitBreaker. While it is open the callbacks to that
+    host are parked without touching the network, and the files waiting for
+    the host are not due. When the probe gets through they are all due again.
+
+    Batch mode: results of jobs with "callback_batch" set, or going to one of
+    batch_hosts, are sent as a single POST {"batch": [data, ...]} per
+    callback_url once batch_size results are waiting or the oldest waited
+    batch_wait seconds. The endpoint can report failed items with
+    {"results": [{"ok": false}, ...]} in the batch order, or with
+    {"failed": [id, ...]}, the other items count as delivered. load(json_file)
+    reads a result and finish(json_file, data, ok) moves it like deliver does.
+    """
+
+    def __init__(
+        self,
+        deliver,
+        concurrency=8,
+        timeout=30,
+        base_delay=2,
+        max_delay=600,
+        verify=False,
+        failure_threshold=5,
+        reset_timeout=30,
+        load=None,
+        finish=None,
+        batch_size=50,
+        batch_wait=2,
+        batch_hosts=(),
+    ):
+        self.deliver = deliver
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.verify = verify
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.load = load
+        self.finish = finish
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.batch_hosts = set(batch_hosts or ())
+
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.breakers = {}
+        self.pending = set()
+
+        # HTTP requests queued or running, a batch is a single one
+        self.posts = 0
+
+        # callback_url -> (time of the oldest item, [(json_file, data)])
+        self.batches = {}
+
+        # basename -> (failed attempts, next attempt time)
+        self.retries = {}
+
+        # basename -> callback host, for the files we failed to deliver
+        self.hosts = {}
+
+        # Host and outcome of the last post() of each delivery thread
+        self.local = threading.local()
+
+        self.delivered = 0
+        self.failed = 0
+        self.parked = 0
+        self.batches_sent = 0
+
+        self.pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="callback")
+
+    def session(self, url):
+        host = urlsplit(url).netloc
+        with self.lock:
+            if host not in self.sessions:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self.sessions[host] = session
+
+            return self.sessions[host]
+
+    def breaker(self, host):
+        with self.lock:
+            if host not in self.breakers:
+                self.breakers[host] = CircuitBreaker(
+                    host, self.failure_threshold, self.reset_timeout, self.max_delay
+                )
+
+            return self.breakers[host]
+
+    def request(self, url, payload):
+        """POST the payload through the host breaker, the response or None.
+
+        Sets self.local.host and self.local.parked for the caller.
+        """
+        host = urlsplit(url).netloc
+        breaker = self.breaker(host)
+
+        self.local.host = host
+        self.local.parked = not breaker.allow()
+        if self.local.parked:
+            return None
+
+        start = time.time()
+        try:
+            response = self.session(url).post(
+                url, json=payload, verify=self.verify, timeout=self.timeout
+            )
+
+            if 400 <= response.status_code < 500 and response.status_code not in (408, 429):
+                print_e(f" Callback {url} rejected {response.status_code}")
+                CALLBACK_SECONDS.observe(time.time() - start, outcome="rejected")
+
+                # Retried with a backoff, but the other results still go to the host
+                if breaker.success():
+                    self.flush(host)
+
+                return None
+
+            response.raise_for_status()
+            print_g(f" Callback {url} {response.status_code}")
+            CALLBACK_SECONDS.observe(time.time() - start, outcome="ok")
+
+            if breaker.success():
+                self.flush(host)
+
+            return response
+        except requests.exceptions.RequestException as e:
+            print_e(f" Failed to callback {url}: {e}")
+
+        CALLBACK_SECONDS.observe(time.time() - start, outcome="error")
+        breaker.failure()
+        return None
+
+    def post(self, url, data):
+        """Send a callback to the URL with the processed data."""
+        return self.request(url, data) is not None
+
+    def post_batch(self, url, items):
+        """Send the batch, returns one True/False per item."""
+        response = self.request(url, {"batch": items})
+        if response is None:
+            return [False] * len(items)
+
+        try:
+            body = response.json()
+        except ValueError:
+            body = None
+
+        if isinstance(body, dict) and isinstance(body.get("results"), list):
+            results = body["results"]
+            if len(results) == len(items):
+                return [
+                    bool(r.get("ok", True)) if isinstance(r, dict) else bool(r)
+                    for r in results
+                ]
+
+            print_e(f" Batch {url} answered {len(results)} results for {len(items)} items")
+            return [False] * len(items)
+
+        if isinstance(body, dict) and isinstance(body.get("failed"), list):
+            failed = set(str(i) for i in body["failed"])
+            return [str(item.get("id")) not in failed for item in items]
+
+        return [True] * len(items)
+
+    def flush(self, host):
+        """The host is back, everything parked for it is due now."""
+        with self.lock:
+            for name in [n for n, h in self.hosts.items() if h == host]:
+                self.retries.pop(name, None)
+
+    def backoff(self, attempts):
+        """Exponential backoff capped to max_delay, jittered so retries spread out."""
+        delay = min(self.max_delay, self.base_delay * 2 ** min(attempts, 20))
+        return random.uniform(delay / 2, delay)
+
+    def due(self, json_file):
+        name = os.path.basename(json_file)
+
+        retry = self.retries.get(name)
+        if retry and time.time() < retry[1]:
+            return False
+
+        # Last, a due breaker gives its probe to the first file that asks
+        host = self.hosts.get(name)
+        return not host or self.breaker(host).ready()
+
+    def in_flight(self):
+        with self.lock:
+            return len(self.pending)
+
+    def has_capacity(self):
+        with self.lock:
+            return self.posts < self.concurrency
+
+    def batched(self, data):
+        if not self.finish or self.batch_size < 2:
+            return False
+
+        if data.get("callback_batch"):
+            return True
+
+        return urlsplit(data.get("callback_url", "")).netloc in self.batch_hosts
+
+    def submit(self, json_file, data=None):
+        with self.lock:
+            if json_file in self.pending:
+                return
+
+            self.pending.add(json_file)
+
+        if self.finish and self.batch_size > 1:
+            try:
+                if data is None:
+                    data = self.load(json_file)
+
+                if self.batched(data):
+                    self.add_to_batch(json_file, data)
+                    return
+            except Exception as e:
+                print_exception(e, "BATCH LOAD FAILED")
+
+        with self.lock:
+            self.posts += 1
+
+        self.pool.submit(self.run, json_file)
+
+    def add_to_batch(self, json_file, data):
+        url = data["callback_url"]
+
+        with self.lock:
+            since, items = self.batches.get(url, (time.time(), []))
+            items.append((json_file, data))
+            self.batches[url] = (since, items)
+
+            if len(items) < self.batch_size:
+                return
+
+        self.send_batch(url)
+
+    def send_batch(self, url):
+        with self.lock:
+            batch = self.batches.pop(url, None)
+            if not batch:
+                return
+
+            self.posts += 1
+
+        self.pool.submit(self.run_batch, url, batch[1])
+
+    def tick(self):
+        """Send the batches that waited batch_wait seconds."""
+        now = time.time()
+        with self.lock:
+            due = [url for url, (since, _) in self.batches.items() if now - since >= self.batch_wait]
+
+        for url in due:
+            self.send_batch(url)
+
+    def run(self, json_file):
+        ok = False
+
+        self.local.host = None
+        self.local.parked = False
+
+        try:
+            ok = self.deliver(json_file)
+        except Exception as e:
+            print_exception(e, "DELIVERY CRASHED")
+
+        self.done(json_file, ok)
+
+        with self.lock:
+            self.posts -= 1
+
+    def run_batch(self, url, items):
+        self.local.host = None
+        self.local.parked = False
+
+        try:
+            results = self.post_batch(url, [data for _, data in items])
+        except Exception as e:
+            print_exception(e, "BATCH CRASHED")
+            results = [False] * len(items)
+
+        print_g(f" Batch {url} {sum(results)}/{len(items)} delivered")
+
+        with self.lock:
+            self.batches_sent += 1
+
+        for (json_file, data), ok in zip(items, results):
+            try:
+                self.finish(json_file, data, ok)
+            except Exception as e:
+                print_exception(e, "BATCH FINISH FAILED")
+
+            self.done(json_file, ok)
+
+        with self.lock:
+            self.posts -= 1
+
+    def done(self, json_file, ok):
+        name = os.path.basename(json_file)
+
+        with self.lock:
+            self.pending.discard(json_file)
+
+            if ok:
+                self.delivered += 1
+                self.retries.pop(name, None)
+                self.hosts.pop(name, None)
+                return
+
+            if self.local.host:
+                self.hosts[name] = self.local.host
+
+            if self.local.parked:
+                # The breaker decides when this one goes again
+                self.parked += 1
+                CALLBACK_PARKED.inc()
+                return
+
+            self.failed += 1
+            CALLBACK_RETRIES.inc()
+            attempts = self.retries.get(name, (0, 0))[0] + 1
+            self.retries[name] = (attempts, time.time() + self.backoff(attempts))
+
+    def shutdown(self, wait=True):
+        """Stop the delivery threads, returns the files that were not sent."""
+        for url in list(self.batches):
+            self.send_batch(url)
+
+        self.pool.shutdown(wait=wait, cancel_futures=True)
+
+        with self.lock:
+            return [f for f in self.pending if os.path.exists(f)]
+
+    def stats(self):
+        with self.lock:
+            return {
+                "delivered": self.delivered,
+                "failed": self.failed,
+                "parked": self.parked,
+                "batches": self.batches_sent,
+                "open_circuits": [h for h, b in self.breakers.items() if b.state != "closed"],
+                "in_flight": len(self.pending),
+                "retrying": len(self.retries),
+            }
@@ -0,0 +1,105 @@
+import math
+import time
+
+from llama_stats import percentile
+
+# z of the 90th percentile of a normal distribution
+Z_90 = 1.2816
+
+
+class QueueEstimator:
+    """How long the queue takes to drain, from what is in it.
+
+    The queue index knows the class of every job (type|model|size, see
+    llama_stats.get_job_class), the stats store has the recent service times
+    of every class and the heartbeats of the workers. A class with fewer than
+    min_samples samples in the window borrows the times of its job type, then
+    of all the jobs, then default_time.
+
+    The drain time of n jobs is a sum of service times, so we give its mean
+    and the 90th percentile of a normal with the summed variances, spread on
+    the live worker slots. Never less than the slowest job in the queue takes
+    on its own.
+    """
+
+    def __init__(self, queue, stats, window=6 * 3600, min_samples=5, default_time=60, cache_secs=10):
+        self.queue = queue
+        self.stats = stats
+        self.window = window
+        self.min_samples = min_samples
+        self.default_time = default_time
+        self.cache_secs = cache_secs
+        self.cache = {}
+
+    def samples(self, kind, key):
+        cached = self.cache.get((kind, key))
+        if cached and time.time() - cached[0] < self.cache_secs:
+            return cached[1]
+
+        values = self.stats.values(kind, key, self.window)
+        self.cache[(kind, key)] = (time.time(), values)
+        return values
+
+    def service_time(self, job_class):
+        """{"mean", "var", "p50", "p90", "source"} of a job of this class."""
+        lookups = [("all", "job")]
+        if job_class:
+            lookups = [("class", job_class), ("type", job_class.split("|")[0])] + lookups
+
+        for kind, key in lookups:
+            values = self.samples(kind, key)
+            if len(values) >= self.min_samples or (kind == "all" and values):
+                mean = sum(values) / len(values)
+                var = sum((v - mean) ** 2 for v in values) / len(values)
+                return {
+                    "mean": mean,
+                    "var": var,
+                    "p50": percentile(values, 50),
+                    "p90": percentile(values, 90),
+                    "source": kind,
+                }
+
+        ewma = self.stats.ewma() or self.default_time
+        return {"mean": ewma, "var": 0, "p50": ewma, "p90": ewma, "source": "default"}
+
+    def slots(self):
+        workers, slots = self.stats.live_workers()
+        return workers, max(1, slots)
+
+    def drain(self, counts):
+        """Drain time of {job_class: jobs}, in seconds."""
+        workers, slots = self.slots()
+
+        total_mean = 0
+        total_var = 0
+        slowest_p50 = 0
+        slowest_p90 = 0
+        classes = {}
+        for job_class, jobs in counts.items():
+            if not jobs:
+                continue
+
+            service = self.service_time(job_class)
+            total_mean += jobs * service["mean"]
+            total_var += jobs * service["var"]
+            slowest_p50 = max(slowest_p50, service["p50"])
+            slowest_p90 = max(slowest_p90, service["p90"])
+
+            classes[job_class or "unknown"] = {
+                "jobs": jobs,
+                "p50_secs": round(service["p50"], 2),
+                "p90_secs": round(service["p90"], 2),
+                "source": service["source"],
+            }
+
+        p50 = max(total_mean / slots, slowest_p50)
+        p90 = max((total_mean + Z_90 * math.sqrt(total_var)) / slots, slowest_p90)
+
+        return {
+            "jobs": sum(counts.values()),
+            "workers": workers,
+            "slots": slots,
+            "p50_secs": round(p50, 1),
+            "p90_secs": round(p90, 1),
+            "classes": classes,
+        }
@@ -0,0 +1,616 @@
+import os
+import json
+import time
+import zlib
+from datetime import datetime, timedelta
+
+from llama_queue import QueueIndex, JobStates, QUEUE_DB
+from llama_stats import StatsStore, STATS_DB, get_job_class
+from llama_eta import QueueEstimator
+
+# Shared by the Flask and the ASGI launchers, no web framework in here.
+# The handlers parse the request and call these, the answers are plain dicts.
+
+# Load the configuration file from the environment variable
+FLASK_CONFIG_PATH = os.environ.get("FLASK_CONFIG_PATH", "config.json")
+
+
+def load_config(path):
+    if not os.path.isfile(path):
+        return {}
+
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+CONFIG = load_config(FLASK_CONFIG_PATH)
+
+
+def create_folder(folder_path):
+    if not os.path.exists(folder_path):
+        os.makedirs(folder_path)
+
+    return folder_path
+
+
+SAVE_FOLDER = create_folder(CONFIG.get("SAVE_FOLDER", "./DATA/JSON_TO_PROCESS"))
+PRIORITY_FOLDER = create_folder(CONFIG.get("PRIORITY_FOLDER", "./DATA/JSON_TO_PROCESS_PRIORITY"))
+USER_PROMPT_FOLDER = create_folder(CONFIG.get("USER_PROMPT_FOLDER", "./DATA/JSON_TO_PROCESS_USER_PROMPT"))
+
+# Bulk uploads, jobs per request and size of the body once decompressed
+BULK_MAX_JOBS = CONFIG.get("BULK_MAX_JOBS", 50000)
+BULK_MAX_BYTES = CONFIG.get("BULK_MAX_BYTES", 256 << 20)
+
+
+class BodyTooLarge(ValueError):
+    pass
+
+
+# Shared with the workers, so they don't have to scan the folders for new jobs
+QUEUE = QueueIndex(
+    CONFIG.get("QUEUE_DB", QUEUE_DB),
+    [SAVE_FOLDER, PRIORITY_FOLDER, USER_PROMPT_FOLDER],
+)
+
+# The workers record where every job is, we answer /api_v1/jobs/<id> from it
+JOB_STATES = JobStates(CONFIG.get("QUEUE_DB", QUEUE_DB))
+
+# Job times recorded by the workers, read only here
+STATS = StatsStore(CONFIG.get("STATS_DB", STATS_DB))
+
+# Queue drain times and job ETAs, from the service times of the last hours
+ESTIMATOR = QueueEstimator(QUEUE, STATS, CONFIG.get("ETA_WINDOW", 6 * 3600))
+
+# Answers of the chat jobs while they are generated, written by the workers
+PARTIAL_FOLDER = CONFIG.get("PARTIAL_FOLDER", "./DATA/PARTIAL")
+
+# The job won't move anymore once it is in one of these
+FINAL_STATES = ("done", "failed", "timeout", "rejected", "removed")
+
+# What the status API returns of a finished job
+RESULT_KEYS = ("result", "ai_summary", "dict", "at_process_time_secs", "at_stream", "at_duplicate_of")
+
+# Long-poll and Server-Sent Events
+POLL_INTERVAL = 0.25
+LONG_POLL_MAX = 60
+EVENTS_MAX = 600
+EVENTS_PING = 15
+
+
+def invalidate_files(folder_path, cutoff_date):
+    """
+    Invalidates all files in a folder older than the given cutoff date by deleting them.
+
+    Args:
+        folder_path (str): Path to the folder containing files to check.
+        cutoff_date (datetime): Date before which files should be invalidated (deleted).
+
+    Returns:
+        list: A list of file paths that were deleted.
+    """
+    if not os.path.exists(folder_path):
+        raise ValueError(f"Folder '{folder_path}' does not exist.")
+
+    if not os.path.isdir(folder_path):
+        raise ValueError(f"Path '{folder_path}' is not a directory.")
+
+    deleted_files = []
+
+    # Iterate over all files in the folder
+    for filename in os.listdir(folder_path):
+        file_path = os.path.join(folder_path, filename)
+
+        # Only process files (not directories)
+        if os.path.isfile(file_path):
+            # Get the last modification time of the file
+            file_mod_time = datetime.fromtimestamp(os.path.getmtime(file_path))
+
+            # Check if the file is older than the cutoff date
+            if file_mod_time < cutoff_date:
+                os.remove(file_path)  # Delete the file
+                deleted_files.append(file_path)
+
+    return deleted_files
+
+
+def clean_path(input_path, base_folder):
+    # Remove invalid characters
+    safe_path = os.path.normpath(input_path)  # Normalize the path
+    safe_path = os.path.basename(safe_path)  # Strip to the file name
+
+    # Join with base folder and ensure it stays within it
+    absolute_base = os.path.abspath(base_folder)
+    cleaned_path = os.path.abspath(os.path.join(absolute_base, safe_path))
+
+    if not cleaned_path.startswith(absolute_base):
+        raise ValueError("Invalid path: Attempt to escape base folder")
+
+    return cleaned_path
+
+
+def get_queue_page(folder, page, per_page, by_priority=True):
+    """A page of the queue from the index, in the order the workers take them."""
+    QUEUE.sync(folder)
+
+    rows = QUEUE.listing(folder, page * per_page, per_page, by_priority)
+    return [
+        (path, datetime.fromtimestamp(ctime).strftime("%Y-%m-%d %H:%M:%S"))
+        for path, ctime in rows
+    ]
+
+
+def get_queue_position(filename, folder):
+    """Where a job we just saved is in the queue, the priority jobs go first."""
+    if folder == PRIORITY_FOLDER:
+        return QUEUE.position(filename, by_priority=False)
+
+    if folder == SAVE_FOLDER:
+        return QUEUE.count(PRIORITY_FOLDER) + QUEUE.position(filename)
+
+    return QUEUE.position(filename, by_priority=False)
+
+
+def get_job_folder(data):
+    folder = SAVE_FOLDER
+    if "priority" in data:
+        print(" FOUND PRIORITY FILE ")
+        folder = PRIORITY_FOLDER
+
+    # for chats
+    if data["type"] == "user_prompt":
+        folder = USER_PROMPT_FOLDER
+
+    return folder
+
+
+def get_job_filename(data, folder):
+    fn = data["id"] + "_data.json"
+
+    if "prefix" in data:
+        fn = data["prefix"] + "_" + fn
+
+    return clean_path(fn, folder)
+
+
+def validate_job(data):
+    """Error message for a job we can't queue, None if it is fine."""
+    if not isinstance(data, dict):
+        return "Job is not a JSON object"
+
+    if not isinstance(data.get("id"), str) or not data["id"]:
+        return "Missing id"
+
+    if not isinstance(data.get("type"), str):
+        return "Missing type"
+
+    if "prefix" in data and not isinstance(data["prefix"], str):
+        return "Invalid prefix"
+
+    return None
+
+
+def write_job(filename, data, indent=None):
+    """Write the job next to its final name, publish_job() renames it. The
+    workers only pick up .json files so they never read half a job.
+
+    Returns the ctime of the file, a worker may take it as soon as it is
+    renamed so don't stat it afterwards."""
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, "w") as json_file:
+        json.dump(data, json_file, indent=indent)
+        json_file.flush()
+        ctime = os.fstat(json_file.fileno()).st_ctime
+
+    return ctime
+
+
+def publish_job(filename):
+    """Make a job from write_job() visible to the workers.
+
+    Record it as queued before, a worker that takes it right away moves it
+    to processing and we must not write queued over that."""
+    os.replace(filename + ".tmp", filename)
+
+
+def discard_job(filename):
+    try:
+        os.remove(filename + ".tmp")
+    except FileNotFoundError:
+        pass
+
+
+def decompress_body(body, content_encoding=None):
+    """The request body, gunzipped if it came compressed.
+
+    Raises BodyTooLarge past BULK_MAX_BYTES, compressed or not."""
+    if len(body) > BULK_MAX_BYTES:
+        raise BodyTooLarge(f"Body larger than {BULK_MAX_BYTES} bytes")
+
+    if content_encoding == "gzip" or body[:2] == b"\x1f\x8b":
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        body = decompressor.decompress(body, BULK_MAX_BYTES)
+        if decompressor.unconsumed_tail:
+            raise BodyTooLarge(f"Body larger than {BULK_MAX_BYTES} bytes")
+
+    return body.decode("utf-8")
+
+
+def parse_bulk_jobs(text):
+    """[(job, error)] from a JSON array or NDJSON, one entry per job."""
+    text = text.strip()
+    if text.startswith("["):
+        return [(job, None) for job in json.loads(text)]
+
+    jobs = []
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+
+        try:
+            jobs.append((json.loads(line), None))
+        except ValueError as e:
+            jobs.append((None, "Invalid JSON: " + str(e)))
+
+    return jobs
+
+
+def queue_listing(page, per_page):
+    return {
+        "process": get_queue_page(SAVE_FOLDER, page, per_page),
+        "priority": get_queue_page(PRIORITY_FOLDER, page, per_page, False),
+        "process_total": QUEUE.count(SAVE_FOLDER),
+        "priority_total": QUEUE.count(PRIORITY_FOLDER),
+        "page": page,
+        "per_page": per_page,
+        "status": "success",
+    }
+
+
+def queue_count():
+    QUEUE.sync(SAVE_FOLDER)
+    QUEUE.sync(PRIORITY_FOLDER)
+
+    ret = {
+        "process": QUEUE.count(SAVE_FOLDER),
+        "priority": QUEUE.count(PRIORITY_FOLDER),
+        "status": "success",
+    }
+    try:
+        eta = queue_eta()
+        ret['queue_hours_estimate'] = round(eta["p50_secs"] / (60*60), 2)
+        ret['queue_hours_p90'] = round(eta["p90_secs"] / (60*60), 2)
+        ret['workers'] = eta["workers"]
+
+    except Exception as e:
+        print(" CRASHED " + str(e))
+
+    return ret
+
+
+def merge_counts(*counts):
+    merged = {}
+    for count in counts:
+        for job_class, jobs in count.items():
+            merged[job_class] = merged.get(job_class, 0) + jobs
+
+    return merged
+
+
+def queue_eta():
+    """Drain time of the process and priority queues, with the classes in them."""
+    return ESTIMATOR.drain(
+        merge_counts(QUEUE.class_counts(PRIORITY_FOLDER), QUEUE.class_counts(SAVE_FOLDER))
+    )
+
+
+def job_eta(path):
+    """Time until a queued job is done, None if it is not in a queue.
+
+    The workers take the priority folder first, then the process folder by
+    priority. The user prompts have their own queue.
+    """
+    folder = os.path.dirname(os.path.abspath(path))
+    by_priority = folder == os.path.abspath(SAVE_FOLDER)
+
+    ahead = QUEUE.class_counts_before(path, by_priority)
+    if ahead is None:
+        return None
+
+    if by_priority:
+        ahead = merge_counts(QUEUE.class_counts(PRIORITY_FOLDER), ahead)
+
+    jobs_ahead = sum(ahead.values())
+    eta = ESTIMATOR.drain(merge_counts(ahead, {QUEUE.job_class(path): 1}))
+
+    return {
+        "ahead": jobs_ahead,
+        "p50_secs": eta["p50_secs"],
+        "p90_secs": eta["p90_secs"],
+        "workers": eta["workers"],
+    }
+
+
+def job_stats(window, ps=(50, 90, 99)):
+    """Job times of the last `window` seconds, per model, job type and stage."""
+    return {
+        "window": window,
+        "stats": STATS.summary(window, ps),
+        "status": "success",
+    }
+
+
+def invalidate(hours):
+    cutoff = datetime.now() - timedelta(hours=hours)
+
+    deleted = invalidate_files(SAVE_FOLDER, cutoff)
+    deleted += invalidate_files(PRIORITY_FOLDER, cutoff)
+
+    for file_path in deleted:
+        QUEUE.remove(file_path)
+
+    JOB_STATES.update_many([JOB_STATES.row(file_path, "removed") for file_path in deleted])
+
+    return {
+        "process": QUEUE.count(SAVE_FOLDER),
+        "priority": QUEUE.count(PRIORITY_FOLDER),
+        "status": "success",
+    }
+
+
+def save_job(data):
+    """Queue a single job, raises on a job we can't save."""
+    folder = get_job_folder(data)
+    filename = get_job_filename(data, folder)
+    print(" SAVING " + filename)
+
+    # Save the JSON data to a file
+    ctime = write_job(filename, data, indent=4)
+    try:
+        JOB_STATES.update(filename, "queued", job_id=data["id"])
+    except Exception:
+        discard_job(filename)
+        raise
+
+    try:
+        publish_job(filename)
+    except Exception:
+        discard_job(filename)
+        JOB_STATES.update(filename, "removed", job_id=data["id"])
+        raise
+
+    QUEUE.add(filename, ctime, get_job_class(data))
+
+    # The listing of the folder is on /api_v1/?page=
+    return {
+        "queue_size": QUEUE.count(folder),
+        "position": get_queue_position(filename, folder),
+        "status": "success",
+    }
+
+
+def save_bulk(jobs):
+    """Queue the parsed jobs of a bulk upload, with the status of every item."""
+    items = []
+    written = []
+    filenames = set()
+    for index, (data, error) in enumerate(jobs):
+        item = {"index": index}
+        if isinstance(data, dict) and "id" in data:
+            item["id"] = data["id"]
+
+        if not error:
+            error = validate_job(data)
+
+        filename = None
+        if not error:
+            try:
+                filename = get_job_filename(data, get_job_folder(data))
+            except Exception as e:
+                error = str(e)
+
+        # The first one keeps the file, a second write would replace its .tmp
+        if not error and filename in filenames:
+            error = "Duplicate id"
+
+        if not error:
+            filenames.add(filename)
+            try:
+                ctime = write_job(filename, data)
+                written.append((filename, ctime, get_job_class(data), item))
+            except Exception as e:
+                discard_job(filename)
+                error = str(e)
+
+        if error:
+            item["status"] = "error"
+            item["error"] = error
+
+        items.append(item)
+
+    # All the rows go in one transaction, before any worker can see a file
+    try:
+        JOB_STATES.update_many(
+            [JOB_STATES.row(filename, "queued", job_id=item["id"]) for filename, _, _, item in written]
+        )
+    except Exception:
+        for filename, _, _, _ in written:
+            discard_job(filename)
+        raise
+
+    saved = []
+    removed = []
+    for filename, ctime, job_class, item in written:
+        try:
+            publish_job(filename)
+        except Exception as e:
+            discard_job(filename)
+            removed.append(JOB_STATES.row(filename, "removed", job_id=item["id"]))
+            item["status"] = "error"
+            item["error"] = str(e)
+            continue
+
+        saved.append((filename, ctime, job_class))
+        item["status"] = "queued"
+
+    if removed:
+        JOB_STATES.update_many(removed)
+
+    QUEUE.add_many(
+        [filename for filename, _, _ in saved],
+        [job_class for _, _, job_class in saved],
+        [ctime for _, ctime, _ in saved],
+    )
+
+    return {
+        "accepted": len(saved),
+        "rejected": len(items) - len(saved),
+        "items": items,
+        "queue_size": {
+            "process": QUEUE.count(SAVE_FOLDER),
+            "priority": QUEUE.count(PRIORITY_FOLDER),
+            "user_prompt": QUEUE.count(USER_PROMPT_FOLDER),
+        },
+        "status": "success",
+    }
+
+
+def read_json(path):
+    """Contents of a job file, None if it is gone or half written."""
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def job_status(job_id):
+    """State of the job, with its result once done and its partial answer
+    while it is generated. None if we never saw the job."""
+    for _ in range(2):
+        state = JOB_STATES.get(job_id)
+        if not state:
+            return None
+
+        status = {
+            "id": state["id"],
+            "state": state["state"],
+            "delivered": state["delivered"],
+            "updated": state["updated"],
+        }
+
+        if state["state"] == "processing":
+            partial = read_json(os.path.join(PARTIAL_FOLDER, state["name"]))
+            if partial:
+                status["partial"] = partial
+            return status
+
+        if state["state"] == "queued":
+            eta = job_eta(state["path"])
+            if eta:
+                status["eta"] = eta
+            return status
+
+        if state["state"] != "done":
+            return status
+
+        data = read_json(state["path"])
+        if data is not None:
+            status["result"] = {key: data[key] for key in RESULT_KEYS if key in data}
+            return status
+
+        # Moved between the lookup and the read, the row has the new path now
+
+    return status
+
+
+def job_state(job_id):
+    """The job_states row of the job, an index lookup, what the waits poll.
+
+    job_status() has the ETA of a queued job, it counts the jobs ahead, so
+    it is only built for the answer or when the state changed."""
+    return JOB_STATES.get(job_id)
+
+
+def job_changed(status, since):
+    """Is this status worth answering a long-poll that knows `since`."""
+    if status is None:
+        return False
+
+    if since:
+        return status["state"] != since
+
+    return status["state"] in FINAL_STATES
+
+
+def wait_job_status(job_id, since=None, wait=0):
+    """Long-poll, the status once it changed from `since` (once it is final
+    without since) or after wait seconds."""
+    deadline = time.time() + min(wait, LONG_POLL_MAX)
+
+    state = job_state(job_id)
+    while not job_changed(state, since) and time.time() < deadline:
+        time.sleep(POLL_INTERVAL)
+        state = job_state(job_id)
+
+    return job_status(job_id)
+
+
+class JobWatcher:
+    """What changed for a job since the last poll(), for the event streams.
+
+    A "status" event every time the state changes, the last one has the
+    result, and a "partial" event every time the partial answer grows.
+    """
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.state = None
+        self.tokens = None
+        self.finished = False
+
+    def poll(self):
+        state = job_state(self.job_id)
+
+        events = []
+        partial = None
+        if (state["state"] if state else "unknown") != self.state:
+            status = job_status(self.job_id) or {"id": self.job_id, "state": "unknown"}
+            partial = status.pop("partial", None)
+
+            self.state = status["state"]
+            events.append(("status", status))
+
+        elif self.state == "processing":
+            partial = read_json(os.path.join(PARTIAL_FOLDER, state["name"]))
+
+        if partial and partial.get("tokens") != self.tokens:
+            self.tokens = partial.get("tokens")
+            events.append(("partial", partial))
+
+        self.finished = self.state in FINAL_STATES
+        return events
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def job_events(job_id):
+    """Server-Sent Events of the job until it is final or EVENTS_MAX seconds."""
+    watcher = JobWatcher(job_id)
+    start = last_sent = time.time()
+
+    while time.time() - start < EVENTS_MAX:
+        for event, data in watcher.poll():
+            yield sse_event(event, data)
+            last_sent = time.time()
+
+        if watcher.finished:
+            return
+
+        # Keeps the proxies from closing an idle stream
+        if time.time() - last_sent >= EVENTS_PING:
+            yield ": ping\n\n"
+            last_sent = time.time()
+
+        time.sleep(POLL_INTERVAL)
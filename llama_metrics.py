@@ -0,0 +1,243 @@
+import threading
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from llama_utils import print_g, print_exception
+
+# Prometheus text format, no client library needed. Every worker process
+# serves its own /metrics, see --metrics_port.
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+QUEUE_BUCKETS = (1, 5, 15, 60, 300, 900, 1800, 3600, 3 * 3600, 6 * 3600, 12 * 3600, 24 * 3600)
+RATE_BUCKETS = (1, 5, 10, 20, 30, 40, 60, 80, 120, 160, 240)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names, values, extra=()):
+    pairs = [f'{n}="{escape(v)}"' for n, v in list(zip(names, values)) + list(extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def samples(self):
+        """[(suffix, label values, extra labels, value)]"""
+        with self.lock:
+            return [("", key, (), value) for key, value in self.values.items()]
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for suffix, key, extra, value in self.samples():
+            lines.append(
+                f"{self.name}{suffix}{format_labels(self.labels, key, extra)} {format_value(value)}"
+            )
+
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A value we set, or a function called on every scrape that returns
+    {label values: value}."""
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labels=(), collect=None):
+        super().__init__(name, documentation, labels)
+        self.collect = collect
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def samples(self):
+        if not self.collect:
+            return super().samples()
+
+        try:
+            values = self.collect()
+        except Exception as e:
+            print_exception(e, "METRIC " + self.name)
+            return []
+
+        return [("", tuple(str(k) for k in key), (), value) for key, value in values.items()]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+
+            self.values[key] = (counts, total + value)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, (counts, total) in self.values.items():
+                for bound, count in zip(self.buckets, counts):
+                    samples.append(("_bucket", key, [("le", format_value(bound))], count))
+
+                samples.append(("_sum", key, (), total))
+                samples.append(("_count", key, (), counts[-1]))
+
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labels=()):
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, labels=(), collect=None):
+        return self.register(Gauge(name, documentation, labels, collect))
+
+    def histogram(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def render(self):
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+QUEUE_WAIT = REGISTRY.histogram(
+    "llama_queue_wait_seconds", "Time from upload to claim", ["queue"], QUEUE_BUCKETS
+)
+JOB_SECONDS = REGISTRY.histogram(
+    "llama_job_seconds", "Processing time of the jobs with a result", ["type"]
+)
+JOBS = REGISTRY.counter("llama_jobs_total", "Jobs processed by outcome", ["type", "outcome"])
+STAGE_SECONDS = REGISTRY.histogram(
+    "llama_stage_seconds", "Latency of every ollama chat call", ["stage", "model"]
+)
+STAGE_ERRORS = REGISTRY.counter(
+    "llama_stage_errors_total", "ollama chat calls that failed", ["stage", "model"]
+)
+PROMPT_TOKENS = REGISTRY.counter(
+    "llama_prompt_tokens_total", "prompt_eval_count reported by Ollama", ["stage", "model"]
+)
+COMPLETION_TOKENS = REGISTRY.counter(
+    "llama_completion_tokens_total", "eval_count reported by Ollama", ["stage", "model"]
+)
+TOKENS_PER_SECOND = REGISTRY.histogram(
+    "llama_tokens_per_second", "eval_count / eval_duration", ["model"], RATE_BUCKETS
+)
+TIME_TO_FIRST_TOKEN = REGISTRY.histogram(
+    "llama_time_to_first_token_seconds", "Streamed chats, time to the first token", ["model"]
+)
+FALLBACKS = REGISTRY.counter(
+    "llama_fallbacks_total", "Jobs retried on the fallback model", ["model", "fallback"]
+)
+CACHE_LOOKUPS = REGISTRY.counter(
+    "llama_cache_lookups_total", "Inference cache lookups", ["result"]
+)
+CALLBACK_SECONDS = REGISTRY.histogram(
+    "llama_callback_seconds", "Latency of the callback POSTs", ["outcome"]
+)
+CALLBACK_RETRIES = REGISTRY.counter(
+    "llama_callback_retries_total", "Callbacks that failed and were scheduled again"
+)
+CALLBACK_PARKED = REGISTRY.counter(
+    "llama_callback_parked_total", "Callbacks held back by an open circuit"
+)
+
+
+def observe_usage(stage, model, response):
+    """Token counts and speed from the final ollama response, if it has them."""
+    if not response or not hasattr(response, "get"):
+        return
+
+    prompt_tokens = response.get("prompt_eval_count")
+    tokens = response.get("eval_count")
+    duration = response.get("eval_duration")
+
+    if prompt_tokens:
+        PROMPT_TOKENS.inc(prompt_tokens, stage=stage, model=model)
+
+    if tokens:
+        COMPLETION_TOKENS.inc(tokens, stage=stage, model=model)
+
+        if duration:
+            TOKENS_PER_SECOND.observe(tokens / (duration / 1e9), model=model)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        body = self.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(port, host="0.0.0.0"):
+    """Serve /metrics on a daemon thread, None if the port is taken."""
+    try:
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+    except OSError as e:
+        print_exception(e, f"METRICS PORT {port}")
+        return None
+
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print_g(f" METRICS ON http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,310 @@
+import json
+import time
+import asyncio
+
+from llama_utils import print_g, print_exception, json_serialize_toolcall
+
+
+class PipelineError(Exception):
+    pass
+
+
+class Stage:
+    """One LLM call of the enrichment.
+
+    name:       unique name of the stage, used for timings and dependencies.
+    messages:   callable that receives the pipeline context and returns the
+                ollama messages for this stage.
+    tool:       tool schema, the stage result is the serialized tool_calls.
+                Without a tool the stage result is the message content.
+    inputs:     context keys the stage reads, either job inputs (system,
+                assistant, message, arr_messages...) or keys provided by
+                another stage.
+    provides:   context key where the result of this stage is published.
+    model:      fixed model for this stage, None uses the job model.
+    num_ctx:    send the job num_ctx on this call.
+    required:   the pipeline has no result if this stage fails.
+    """
+
+    def __init__(
+        self,
+        name,
+        messages,
+        tool=None,
+        inputs=(),
+        provides=None,
+        model=None,
+        num_ctx=False,
+        required=False,
+    ):
+        self.name = name
+        self.messages = messages
+        self.tool = tool
+        self.inputs = tuple(inputs)
+        self.provides = provides
+        self.model = model
+        self.num_ctx = num_ctx
+        self.required = required
+
+    def __repr__(self):
+        return f"Stage({self.name})"
+
+
+class PipelineResult:
+    def __init__(self):
+        self.outputs = {}
+        self.context = {}
+        self.errors = {}
+        self.timings = {}
+        self.skipped = []
+        self.cached = []
+
+        # Token counts Ollama reported for each stage that called the model
+        self.usage = {}
+        self.dict = []
+        self.ok = True
+        self.elapsed = 0
+
+    def failed(self, stages):
+        return any(name in self.errors for name in stages)
+
+
+class Pipeline:
+    """Runs a set of stages as a DAG.
+
+    Dependencies come from the stage inputs, a stage waits for the stages that
+    provide what it reads. Independent stages run at the same time when the
+    pipeline is parallel. Two stages that would send exactly the same request
+    share a single call, the duplicate is skipped.
+    """
+
+    def __init__(self, stages):
+        self.stages = {}
+        self.providers = {}
+
+        for stage in stages:
+            if stage.name in self.stages:
+                raise PipelineError("Duplicated stage name " + stage.name)
+
+            self.stages[stage.name] = stage
+            if stage.provides:
+                self.providers[stage.provides] = stage.name
+
+        self.order = self.topological_order()
+
+    def dependencies(self, stage):
+        return [self.providers[key] for key in stage.inputs if key in self.providers]
+
+    def topological_order(self):
+        order = []
+        state = {}
+
+        def visit(name, path):
+            if state.get(name) == "done":
+                return
+
+            if state.get(name) == "visiting":
+                raise PipelineError("Cycle in pipeline: " + " > ".join(path + [name]))
+
+            state[name] = "visiting"
+            for dep in self.dependencies(self.stages[name]):
+                visit(dep, path + [name])
+
+            state[name] = "done"
+            order.append(name)
+
+        for name in self.stages:
+            visit(name, [])
+
+        return order
+
+    def select(self, targets):
+        """Stages needed to run the targets, in topological order."""
+        if not targets:
+            return list(self.order)
+
+        needed = set()
+        pending = list(targets)
+        while pending:
+            name = pending.pop()
+            if name in needed:
+                continue
+
+            needed.add(name)
+            pending.extend(self.dependencies(self.stages[name]))
+
+        return [name for name in self.order if name in needed]
+
+    def signature(self, stage, model, messages, options):
+        return json.dumps(
+            [
+                model,
+                messages,
+                stage.tool["function"]["name"] if stage.tool else None,
+                options,
+            ],
+            sort_keys=True,
+            default=str,
+        )
+
+    async def call(self, client, stage, model, messages, options, keep_alive=None, usage=None, stream=None):
+        if stream and not stage.tool:
+            # Raises GenerationAborted past the limits of the StreamingChat
+            message, stats = await stream.achat(client, model, messages, options, keep_alive)
+
+            if usage is not None:
+                usage["stream"] = stats
+                if stats.get("prompt_tokens"):
+                    usage["prompt_eval_count"] = stats["prompt_tokens"]
+                if stats["tokens"]:
+                    usage["eval_count"] = stats["tokens"]
+                if stats["tokens"] and stats["tokens_per_sec"]:
+                    usage["eval_duration"] = int(stats["tokens"] / stats["tokens_per_sec"] * 1e9)
+
+            return message["content"]
+
+        response = await client.chat(
+            model=model,
+            messages=messages,
+            tools=[stage.tool] if stage.tool else None,
+            options=options,
+            keep_alive=keep_alive,
+        )
+
+        if usage is not None:
+            for key in ("prompt_eval_count", "eval_count", "eval_duration"):
+                if response.get(key):
+                    usage[key] = response[key]
+
+        if not stage.tool:
+            return response["message"]["content"]
+
+        if "tool_calls" not in response["message"] or not response["message"]["tool_calls"]:
+            raise PipelineError("No tool_calls on " + stage.name)
+
+        dmp = json_serialize_toolcall(response["message"]["tool_calls"])
+        print(dmp)
+        return json.loads(dmp)
+
+    def merge(self, result, names):
+        """Tool results of the stages, in the order the stages were declared."""
+        merged = []
+        for name, stage in self.stages.items():
+            if name not in names or not stage.tool:
+                continue
+
+            if name in result.outputs and name not in result.skipped:
+                merged.extend(result.outputs[name])
+
+        return merged
+
+    async def arun(
+        self,
+        client,
+        context,
+        model,
+        num_ctx=None,
+        targets=None,
+        parallel=True,
+        keep_alive=None,
+        cache=None,
+        stream=None,
+    ):
+        """Run the pipeline, context holds the job inputs.
+
+        keep_alive is a callable that returns the keep_alive for a model.
+        cache is an InferenceCache, stages found there don't call the model
+        and are listed in result.cached.
+        stream is a StreamingChat, the stages without a tool stream through it
+        and their result.usage has its stats under "stream".
+
+        Returns a PipelineResult, the tool results are merged in result.dict in
+        the order the stages were declared.
+        """
+        start_time = time.time()
+        result = PipelineResult()
+        result.context = dict(context)
+
+        selected = self.select(targets)
+        tasks = {}
+        calls = {}
+
+        async def run_stage(name):
+            stage = self.stages[name]
+
+            for dep in self.dependencies(stage):
+                await tasks[dep]
+
+                if dep in result.errors:
+                    raise PipelineError(f"{name} depends on failed stage {dep}")
+
+            stage_model = stage.model or model
+            options = {"num_ctx": num_ctx} if stage.num_ctx and num_ctx else None
+            messages = stage.messages(result.context)
+
+            cache_key = None
+            if cache:
+                tools = [stage.tool] if stage.tool else None
+                cache_key = cache.key(stage_model, messages, tools, options, f"pipeline:{name}")
+                output = cache.get(cache_key)
+                if output is not None:
+                    result.cached.append(name)
+                    result.timings[name] = 0
+
+                    if stage.provides:
+                        result.context[stage.provides] = output
+
+                    return output
+
+            key = self.signature(stage, stage_model, messages, options)
+            if key in calls:
+                result.skipped.append(name)
+                output = await calls[key]
+            else:
+                start_time = time.time()
+                calls[key] = asyncio.ensure_future(
+                    self.call(
+                        client,
+                        stage,
+                        stage_model,
+                        messages,
+                        options,
+                        keep_alive(stage_model) if keep_alive else None,
+                        result.usage.setdefault(name, {}),
+                        stream,
+                    )
+                )
+
+                try:
+                    output = await calls[key]
+                finally:
+                    result.timings[name] = round(time.time() - start_time, 2)
+
+                if cache:
+                    cache.put(cache_key, stage_model, output)
+
+            if stage.provides:
+                result.context[stage.provides] = output
+
+            return output
+
+        async def guarded(name):
+            try:
+                result.outputs[name] = await run_stage(name)
+            except Exception as e:
+                print_exception(e, "STAGE " + name)
+                result.errors[name] = e
+
+        for name in selected:
+            tasks[name] = asyncio.ensure_future(guarded(name))
+            if not parallel:
+                await tasks[name]
+
+        await asyncio.gather(*tasks.values())
+
+        result.dict = self.merge(result, selected)
+        result.ok = not any(self.stages[name].required for name in result.errors)
+        result.elapsed = round(time.time() - start_time, 2)
+
+        print_g(" PIPELINE " + json.dumps(result.timings))
+        return result
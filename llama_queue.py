@@ -0,0 +1,615 @@
+import os
+import json
+import time
+import socket
+import sqlite3
+import threading
+
+QUEUE_DB = "./DATA/queue.sqlite"
+
+# INSERT OR REPLACE deletes the old row without firing the count trigger
+UPSERT_JOB = """
+    INSERT INTO jobs (path, folder, priority, ctime, job_class) VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT (path) DO UPDATE SET ctime = excluded.ctime,
+        job_class = COALESCE(excluded.job_class, jobs.job_class)
+"""
+
+
+def file_priority(path):
+    """First character of the file name, the prefix decides the order."""
+    return ord(os.path.basename(path)[0])
+
+
+class QueueIndex:
+    """Index of the .json jobs waiting in the queue folders.
+
+    The folders are still the source of truth, the index is a SQLite table
+    ordered by (folder, priority, ctime) so the next job is an index lookup
+    instead of a listdir, a stat per file and a sort.
+
+    Every writer that knows about the index (worker moves, launcher uploads)
+    updates it. Anything else (rsync, manual moves) is picked up by sync(),
+    which rescans a folder when its mtime changed, at most once every
+    rescan_interval seconds. rebuild() rescans everything, the worker calls
+    it on startup.
+
+    Triggers keep a count of the jobs per (folder, priority), so the size of
+    a queue and the position of a new job don't depend on the backlog, and
+    per (folder, job_class) for the drain time of a queue.
+
+    job_class is what the ETA estimator needs to know of a job (type, model,
+    size, see llama_stats.get_job_class), NULL for the files that showed up
+    behind our back.
+    """
+
+    def __init__(self, db_path=QUEUE_DB, folders=(), rescan_interval=30):
+        self.db_path = db_path
+        self.folders = [os.path.abspath(f) for f in folders]
+        self.rescan_interval = rescan_interval
+
+        self.lock = threading.RLock()
+        self.synced = {}
+
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+
+        self.db = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                path TEXT PRIMARY KEY,
+                folder TEXT NOT NULL,
+                priority INTEGER NOT NULL,
+                ctime REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS jobs_priority ON jobs (folder, priority, ctime);
+            CREATE INDEX IF NOT EXISTS jobs_ctime ON jobs (folder, ctime);
+
+            CREATE TABLE IF NOT EXISTS counts (
+                folder TEXT NOT NULL,
+                priority INTEGER NOT NULL,
+                n INTEGER NOT NULL,
+                PRIMARY KEY (folder, priority)
+            );
+            CREATE TRIGGER IF NOT EXISTS jobs_count_insert AFTER INSERT ON jobs BEGIN
+                INSERT INTO counts (folder, priority, n) VALUES (NEW.folder, NEW.priority, 1)
+                ON CONFLICT (folder, priority) DO UPDATE SET n = n + 1;
+            END;
+            CREATE TRIGGER IF NOT EXISTS jobs_count_delete AFTER DELETE ON jobs BEGIN
+                UPDATE counts SET n = n - 1 WHERE folder = OLD.folder AND priority = OLD.priority;
+            END;
+            """
+        )
+        self.db.commit()
+
+        # Indexes written before the jobs had a class
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(jobs)")]
+        if "job_class" not in columns:
+            self.db.execute("ALTER TABLE jobs ADD COLUMN job_class TEXT")
+            self.db.commit()
+
+        # Jobs per (folder, job_class) for the ETA, '' for the jobs without class
+        self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS class_counts (
+                folder TEXT NOT NULL,
+                job_class TEXT NOT NULL,
+                n INTEGER NOT NULL,
+                PRIMARY KEY (folder, job_class)
+            );
+            CREATE TRIGGER IF NOT EXISTS jobs_class_insert AFTER INSERT ON jobs BEGIN
+                INSERT INTO class_counts (folder, job_class, n) VALUES (NEW.folder, COALESCE(NEW.job_class, ''), 1)
+                ON CONFLICT (folder, job_class) DO UPDATE SET n = n + 1;
+            END;
+            CREATE TRIGGER IF NOT EXISTS jobs_class_delete AFTER DELETE ON jobs BEGIN
+                UPDATE class_counts SET n = n - 1 WHERE folder = OLD.folder AND job_class = COALESCE(OLD.job_class, '');
+            END;
+            CREATE TRIGGER IF NOT EXISTS jobs_class_update AFTER UPDATE OF job_class ON jobs
+            WHEN COALESCE(OLD.job_class, '') != COALESCE(NEW.job_class, '') BEGIN
+                UPDATE class_counts SET n = n - 1 WHERE folder = OLD.folder AND job_class = COALESCE(OLD.job_class, '');
+                INSERT INTO class_counts (folder, job_class, n) VALUES (NEW.folder, COALESCE(NEW.job_class, ''), 1)
+                ON CONFLICT (folder, job_class) DO UPDATE SET n = n + 1;
+            END;
+            """
+        )
+        self.db.commit()
+
+        self.recount()
+
+    def indexed(self, folder):
+        return os.path.abspath(folder) in self.folders
+
+    def add(self, path, ctime=None, job_class=None):
+        """Add a job file, ignored if its folder is not indexed."""
+        path = os.path.abspath(path)
+        folder = os.path.dirname(path)
+        if not self.indexed(folder):
+            return
+
+        if ctime is None:
+            ctime = os.path.getctime(path)
+
+        with self.lock:
+            self.db.execute(UPSERT_JOB, (path, folder, file_priority(path), ctime, job_class))
+            self.db.commit()
+
+    def add_many(self, paths, job_classes=None, ctimes=None):
+        """Add a batch of job files in a single transaction.
+
+        Pass the ctimes taken when the files were written, a worker may have
+        claimed them already. Without one a file that is gone is skipped.
+        """
+        job_classes = job_classes or [None] * len(paths)
+        ctimes = ctimes or [None] * len(paths)
+
+        rows = []
+        for path, job_class, ctime in zip(paths, job_classes, ctimes):
+            path = os.path.abspath(path)
+            folder = os.path.dirname(path)
+            if not self.indexed(folder):
+                continue
+
+            if ctime is None:
+                try:
+                    ctime = os.path.getctime(path)
+                except OSError:
+                    continue
+
+            rows.append((path, folder, file_priority(path), ctime, job_class))
+
+        with self.lock:
+            self.db.executemany(UPSERT_JOB, rows)
+            self.db.commit()
+
+    def remove(self, path):
+        with self.lock:
+            self.db.execute("DELETE FROM jobs WHERE path = ?", (os.path.abspath(path),))
+            self.db.commit()
+
+    def job_class(self, path):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT job_class FROM jobs WHERE path = ?", (os.path.abspath(path),)
+            ).fetchone()
+
+        return row[0] if row else None
+
+    def moved(self, old_path, new_path):
+        job_class = self.job_class(old_path)
+        self.remove(old_path)
+
+        if self.indexed(os.path.dirname(os.path.abspath(new_path))):
+            self.add(new_path, job_class=job_class)
+
+    def peek(self, folder, limit=1, by_priority=True):
+        """First jobs of the folder, by file name priority and ctime, or ctime only."""
+        folder = os.path.abspath(folder)
+        order = "priority, ctime" if by_priority else "ctime"
+
+        while True:
+            with self.lock:
+                rows = self.db.execute(
+                    f"SELECT path FROM jobs WHERE folder = ? ORDER BY {order} LIMIT ?",
+                    (folder, limit),
+                ).fetchall()
+
+            paths = [row[0] for row in rows]
+            missing = [p for p in paths if not os.path.exists(p)]
+            if not missing:
+                return paths
+
+            # Somebody else took these files, forget them and look again
+            with self.lock:
+                self.db.executemany("DELETE FROM jobs WHERE path = ?", [(p,) for p in missing])
+                self.db.commit()
+
+    def first(self, folder, by_priority=True):
+        paths = self.peek(folder, 1, by_priority)
+        return paths[0] if paths else None
+
+    def count(self, folder, max_priority=None):
+        """Jobs in the folder, only the ones up to max_priority if set."""
+        query = "SELECT COALESCE(SUM(n), 0) FROM counts WHERE folder = ?"
+        args = [os.path.abspath(folder)]
+
+        if max_priority is not None:
+            query += " AND priority <= ?"
+            args.append(max_priority)
+
+        with self.lock:
+            return self.db.execute(query, args).fetchone()[0]
+
+    def position(self, path, by_priority=True):
+        """Position of a job that was just added, it is the newest of its priority."""
+        folder = os.path.dirname(os.path.abspath(path))
+        return self.count(folder, file_priority(path) if by_priority else None)
+
+    def class_counts(self, folder):
+        """{job_class: jobs} of the folder, from the counts the triggers keep."""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT job_class, n FROM class_counts WHERE folder = ? AND n > 0",
+                (os.path.abspath(folder),),
+            ).fetchall()
+
+        return {job_class or None: n for job_class, n in rows}
+
+    def class_counts_before(self, path, by_priority=True):
+        """{job_class: jobs} of the jobs that run before this one in its folder."""
+        path = os.path.abspath(path)
+        with self.lock:
+            row = self.db.execute(
+                "SELECT folder, priority, ctime FROM jobs WHERE path = ?", (path,)
+            ).fetchone()
+            if not row:
+                return None
+
+            folder, priority, ctime = row
+            if by_priority:
+                where = "(priority < ? OR (priority = ? AND ctime < ?))"
+                args = [folder, priority, priority, ctime]
+            else:
+                where = "ctime < ?"
+                args = [folder, ctime]
+
+            rows = self.db.execute(
+                f"SELECT job_class, COUNT(*) FROM jobs WHERE folder = ? AND {where} GROUP BY job_class",
+                args,
+            ).fetchall()
+
+        return dict(rows)
+
+    def recount(self):
+        """Counts from scratch, for indexes written before they had counts."""
+        with self.lock:
+            self.db.execute("DELETE FROM counts")
+            self.db.execute(
+                "INSERT INTO counts (folder, priority, n) SELECT folder, priority, COUNT(*) FROM jobs GROUP BY folder, priority"
+            )
+            self.db.execute("DELETE FROM class_counts")
+            self.db.execute(
+                "INSERT INTO class_counts (folder, job_class, n) SELECT folder, COALESCE(job_class, ''), COUNT(*) FROM jobs GROUP BY folder, COALESCE(job_class, '')"
+            )
+            self.db.commit()
+
+    def listing(self, folder, offset=0, limit=100, by_priority=True):
+        """A page of the folder's jobs, as (path, ctime), in the order they run."""
+        folder = os.path.abspath(folder)
+        order = "priority, ctime" if by_priority else "ctime"
+
+        with self.lock:
+            return self.db.execute(
+                f"SELECT path, ctime FROM jobs WHERE folder = ? ORDER BY {order} LIMIT ? OFFSET ?",
+                (folder, limit, offset),
+            ).fetchall()
+
+    def after(self, folder, cursor=None, limit=100):
+        """Jobs of the folder by ctime, after cursor (ctime, path) of the last
+        page, as (path, ctime). The index walk doesn't slow down with depth."""
+        folder = os.path.abspath(folder)
+        with self.lock:
+            if cursor is None:
+                return self.db.execute(
+                    "SELECT path, ctime FROM jobs WHERE folder = ? ORDER BY ctime, path LIMIT ?",
+                    (folder, limit),
+                ).fetchall()
+
+            return self.db.execute(
+                """
+                SELECT path, ctime FROM jobs WHERE folder = ? AND (ctime, path) > (?, ?)
+                ORDER BY ctime, path LIMIT ?
+                """,
+                (folder, cursor[0], cursor[1], limit),
+            ).fetchall()
+
+    def reconcile(self, folder):
+        """Make the index match the folder, only the new files are stat'ed."""
+        folder = os.path.abspath(folder)
+        mtime = os.path.getmtime(folder)
+
+        names = set(f for f in os.listdir(folder) if f.endswith(".json"))
+
+        with self.lock:
+            rows = self.db.execute("SELECT path FROM jobs WHERE folder = ?", (folder,))
+            known = set(os.path.basename(row[0]) for row in rows)
+
+            rows = []
+            for name in names - known:
+                path = os.path.join(folder, name)
+                try:
+                    rows.append((path, folder, file_priority(path), os.path.getctime(path), None))
+                except OSError:
+                    continue
+
+            self.db.executemany(UPSERT_JOB, rows)
+            self.db.executemany(
+                "DELETE FROM jobs WHERE path = ?",
+                [(os.path.join(folder, name),) for name in known - names],
+            )
+            self.db.commit()
+
+        self.synced[folder] = (mtime, time.time())
+
+    def sync(self, folder):
+        """Rescan the folder if it changed behind our back, rate limited."""
+        folder = os.path.abspath(folder)
+        mtime = os.path.getmtime(folder)
+
+        last = self.synced.get(folder)
+        if last and (last[0] == mtime or time.time() - last[1] < self.rescan_interval):
+            return
+
+        self.reconcile(folder)
+
+    def rebuild(self):
+        for folder in self.folders:
+            self.reconcile(folder)
+
+        self.recount()
+
+
+class JobLeases:
+    """Claims jobs for one worker, safe with many workers on the same DATA tree.
+
+    A claim is a rename of the job into the processing folder, the rename is
+    atomic so only one worker gets the file, the others get FileNotFoundError.
+    Next to the claimed job we write <job>.lease with the worker id, the
+    folder it came from and the claim time. A heartbeat thread touches the
+    leases we hold, a lease that hasn't been touched for lease_ttl seconds
+    belongs to a dead worker and reap() puts its job back on the queue.
+    """
+
+    def __init__(self, processing_folder, worker_id=None, lease_ttl=120, queue=None):
+        self.processing_folder = processing_folder
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.lease_ttl = lease_ttl
+        self.queue = queue
+
+        self.lock = threading.Lock()
+        self.held = {}
+        self.heartbeat_thread = None
+        self.stop_event = threading.Event()
+
+    def lease_path(self, path):
+        return path + ".lease"
+
+    def claim(self, path):
+        """Move the job to the processing folder, None if another worker got it."""
+        target = os.path.join(self.processing_folder, os.path.basename(path))
+        if os.path.exists(target):
+            # Same job is being processed, leave this copy for later
+            return None
+
+        try:
+            os.rename(path, target)
+        except FileNotFoundError:
+            if self.queue:
+                self.queue.remove(path)
+
+            return None
+
+        lease = {
+            "worker": self.worker_id,
+            "origin": os.path.abspath(os.path.dirname(path)),
+            "claimed": time.time(),
+        }
+
+        with open(self.lease_path(target), "w") as f:
+            json.dump(lease, f)
+
+        with self.lock:
+            self.held[target] = lease
+
+        if self.queue:
+            self.queue.remove(path)
+
+        return target
+
+    def release(self, path):
+        with self.lock:
+            self.held.pop(path, None)
+
+        try:
+            os.remove(self.lease_path(path))
+        except FileNotFoundError:
+            pass
+
+    def retarget(self, path, origin):
+        """Where the job goes if we die holding it, a finished job goes to FAILED."""
+        with self.lock:
+            lease = self.held.get(path)
+            if not lease:
+                return
+
+            lease["origin"] = os.path.abspath(origin)
+
+        with open(self.lease_path(path), "w") as f:
+            json.dump(lease, f)
+
+    def holding(self):
+        with self.lock:
+            return list(self.held)
+
+    def heartbeat(self):
+        for path in self.holding():
+            try:
+                os.utime(self.lease_path(path), None)
+            except FileNotFoundError:
+                pass
+
+    def heartbeat_loop(self):
+        while not self.stop_event.wait(self.lease_ttl / 4):
+            self.heartbeat()
+
+    def start(self):
+        if self.heartbeat_thread:
+            return
+
+        self.heartbeat_thread = threading.Thread(target=self.heartbeat_loop, daemon=True)
+        self.heartbeat_thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def requeue(self, path, folder, name):
+        """Move path to folder/name without overwriting a newer copy of the
+        job queued there meanwhile, ours gets a suffix then."""
+        target = os.path.join(folder, name)
+        try:
+            os.link(path, target)
+        except FileExistsError:
+            target = os.path.join(folder, f"{name[:-len('.json')]}.{int(time.time() * 1000)}.json")
+            os.link(path, target)
+
+        os.unlink(path)
+        return target
+
+    def reap(self, default_folder):
+        """Put back on the queue the jobs of workers that stopped heartbeating.
+
+        Jobs without lease (left by an old worker) are reaped lease_ttl seconds
+        after they were moved into processing. Returns the requeued files.
+        """
+        now = time.time()
+        requeued = []
+
+        held = set(self.holding())
+        for name in os.listdir(self.processing_folder):
+            if not name.endswith(".json"):
+                continue
+
+            path = os.path.join(self.processing_folder, name)
+            if path in held:
+                continue
+
+            lease_file = self.lease_path(path)
+            try:
+                if os.path.exists(lease_file):
+                    if now - os.path.getmtime(lease_file) < self.lease_ttl:
+                        continue
+
+                    with open(lease_file, "r") as f:
+                        origin = json.load(f).get("origin") or default_folder
+                else:
+                    # ctime changes with the rename into processing
+                    if now - os.path.getctime(path) < self.lease_ttl:
+                        continue
+
+                    origin = default_folder
+
+                # Only one reaper wins the rename, the file is ours from here
+                reaping = f"{path}.{self.worker_id}.reap"
+                os.rename(path, reaping)
+            except (OSError, ValueError):
+                # Another worker is reaping it, or the lease is half written
+                continue
+
+            target = self.requeue(reaping, origin, name)
+
+            try:
+                os.remove(lease_file)
+            except FileNotFoundError:
+                pass
+
+            if self.queue:
+                self.queue.add(target)
+
+            requeued.append(target)
+
+        return requeued
+
+
+class JobStates:
+    """Where every job is, so the launcher can answer a status without
+    looking through the DATA folders.
+
+    One row per job file with its state, its path and if the callback took
+    the result. The launcher adds the jobs it queues and the workers update
+    them on every move. Rows of jobs not touched for max_age seconds go.
+    """
+
+    def __init__(self, db_path=QUEUE_DB, max_age=7 * 24 * 3600):
+        self.max_age = max_age
+
+        self.lock = threading.RLock()
+        self.updates = 0
+
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+
+        self.db = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS job_states (
+                name TEXT PRIMARY KEY,
+                job_id TEXT NOT NULL,
+                state TEXT NOT NULL,
+                path TEXT NOT NULL,
+                delivered INTEGER,
+                updated REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS job_states_id ON job_states (job_id, updated);
+            CREATE INDEX IF NOT EXISTS job_states_updated ON job_states (updated);
+            """
+        )
+        self.db.commit()
+
+    def row(self, path, state, delivered=None, job_id=None):
+        name = os.path.basename(path)
+
+        # Dev results that failed their callback are renamed <job>.FAILED
+        if name.endswith(".FAILED"):
+            name = name[: -len(".FAILED")]
+            delivered = False
+
+        if not job_id:
+            job_id = name[: -len("_data.json")] if name.endswith("_data.json") else name
+
+        return (name, job_id, state, os.path.abspath(path), delivered, time.time())
+
+    def update_many(self, rows):
+        with self.lock:
+            # The id from the upload stays, the workers only know the file name
+            self.db.executemany(
+                """
+                INSERT INTO job_states (name, job_id, state, path, delivered, updated) VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (name) DO UPDATE SET state = excluded.state, path = excluded.path,
+                    delivered = excluded.delivered, updated = excluded.updated
+                """,
+                rows,
+            )
+
+            self.updates += len(rows)
+            if self.updates >= 1000:
+                self.updates = 0
+                self.db.execute(
+                    "DELETE FROM job_states WHERE updated < ?", (time.time() - self.max_age,)
+                )
+
+            self.db.commit()
+
+    def update(self, path, state, delivered=None, job_id=None):
+        self.update_many([self.row(path, state, delivered, job_id)])
+
+    def get(self, job_id):
+        """Last known state of the job, None if we never saw it."""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT name, job_id, state, path, delivered, updated FROM job_states WHERE job_id = ? ORDER BY updated DESC LIMIT 1",
+                (job_id,),
+            ).fetchone()
+
+        if not row:
+            return None
+
+        name, job_id, state, path, delivered, updated = row
+        return {
+            "id": job_id,
+            "name": name,
+            "state": state,
+            "path": path,
+            "delivered": None if delivered is None else bool(delivered),
+            "updated": updated,
+        }
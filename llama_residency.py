@@ -0,0 +1,110 @@
+import time
+
+from llama_utils import print_g, print_r, print_exception
+
+
+def model_name(name):
+    """Ollama reports llama3.1 as llama3.1:latest"""
+    if name and name.endswith(":latest"):
+        return name[: -len(":latest")]
+
+    return name
+
+
+class ModelResidency:
+    """Owns the keep_alive policy of the models and knows which ones are loaded.
+
+    Pinned models are the ones we run all day, they are preloaded when the
+    daemon starts and stay loaded (keep_alive=-1). Any other model gets
+    default_keep_alive so it leaves the GPU soon after we stop using it.
+    """
+
+    def __init__(
+        self,
+        client,
+        pinned=(),
+        fallback=None,
+        pinned_keep_alive=-1,
+        default_keep_alive="5m",
+        allow_cold_fallback=False,
+        ps_ttl=5,
+    ):
+        # client is the ollama module or an ollama.Client
+        self.client = client
+        self.pinned = pinned
+        self.fallback = fallback
+        self.pinned_keep_alive = pinned_keep_alive
+        self.default_keep_alive = default_keep_alive
+        self.allow_cold_fallback = allow_cold_fallback
+        self.ps_ttl = ps_ttl
+
+        self.hot = set()
+        self.hot_time = 0
+
+    @property
+    def pinned(self):
+        return self._pinned
+
+    @pinned.setter
+    def pinned(self, models):
+        # --pin=llama3.2:latest must match what /api/ps reports, once
+        pinned = []
+        for model in models:
+            if model_name(model) not in pinned:
+                pinned.append(model_name(model))
+
+        self._pinned = pinned
+
+    def keep_alive(self, model):
+        if model_name(model) in self.pinned:
+            return self.pinned_keep_alive
+
+        return self.default_keep_alive
+
+    def refresh(self, force=False):
+        """Models loaded in Ollama right now, cached for ps_ttl seconds."""
+        if not force and time.time() - self.hot_time < self.ps_ttl:
+            return self.hot
+
+        try:
+            response = self.client.ps()
+            self.hot = set(model_name(m["model"]) for m in response["models"])
+        except Exception as e:
+            print_exception(e, "OLLAMA PS FAILED")
+
+        self.hot_time = time.time()
+        return self.hot
+
+    def is_hot(self, model):
+        return model_name(model) in self.refresh()
+
+    def preload(self, models=None):
+        """Load the models with their keep_alive, before the first job arrives."""
+        for model in models or self.pinned:
+            start_time = time.time()
+            try:
+                self.client.generate(model=model, keep_alive=self.keep_alive(model))
+                print_g(f" MODEL LOADED {model} {time.time() - start_time:.2f} sec")
+            except Exception as e:
+                print_exception(e, "PRELOAD FAILED " + model)
+
+        self.refresh(force=True)
+
+    def fallback_for(self, model):
+        """Model to retry a lazy answer with.
+
+        The fallback model only if it is loaded already, loading it would
+        evict the model we are running. Otherwise we try our model again.
+        """
+        if not self.fallback or model_name(model) == model_name(self.fallback):
+            return model
+
+        if self.allow_cold_fallback or self.is_hot(self.fallback):
+            return self.fallback
+
+        if not self.is_hot(model):
+            # Nothing to protect, our model is not loaded either
+            return self.fallback
+
+        print_r(f" {self.fallback} IS NOT LOADED, RETRY WITH {model}")
+        return model
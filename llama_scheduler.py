@@ -0,0 +1,114 @@
+import os
+import time
+
+
+class AffinityScheduler:
+    """Picks the next job so consecutive jobs share the same (model, num_ctx).
+
+    Ollama has to unload and load the weights every time the model or the
+    context size changes. The scheduler keeps running the batch of the job it
+    ran last while there are jobs with the same key in the look ahead window,
+    and switches when there are none.
+
+    Jobs don't wait forever: a job that has been skipped at the head of its
+    queue for more than max_delay seconds is taken even if it breaks the
+    batch, priority jobs first.
+    """
+
+    def __init__(self, key_func, lookahead=64, max_delay=60):
+        # key_func(path) returns the (model, num_ctx) of a queued job
+        self.key_func = key_func
+        self.lookahead = lookahead
+        self.max_delay = max_delay
+
+        self.current = None
+        self.keys = {}
+
+        # Head of a queue we skipped to keep the batch, and since when
+        self.deferred = {}
+
+        self.batch_size = 0
+        self.switches = 0
+
+    def get_key(self, path):
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return None
+
+        cached = self.keys.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+
+        try:
+            key = self.key_func(path)
+        except Exception:
+            # Let the worker find out what is wrong with the file
+            key = None
+
+        self.keys[path] = (mtime, key)
+        return key
+
+    def matches(self, key):
+        return key is None or self.current is None or key == self.current
+
+    def find_match(self, files):
+        for path in files[: self.lookahead]:
+            if self.matches(self.get_key(path)):
+                return path
+
+        return None
+
+    def next_job(self, priority_files, queue_files):
+        """Next file to process.
+
+        priority_files and queue_files are in the order the worker would take
+        them without batching, the oldest or most important first.
+        """
+        priority_files = priority_files or []
+        queue_files = queue_files or []
+
+        now = time.time()
+
+        # Overdue jobs preempt the batch
+        for files in (priority_files, queue_files):
+            if files and now - self.deferred.get(files[0], now) > self.max_delay:
+                return self.take(files[0])
+
+        # Keep the current batch running, priority jobs first
+        for files in (priority_files, queue_files):
+            path = self.find_match(files)
+            if path:
+                for heads in (priority_files, queue_files):
+                    if heads and heads[0] != path:
+                        self.deferred.setdefault(heads[0], now)
+
+                return self.take(path)
+
+        # Nothing left for this batch, start a new one
+        for files in (priority_files, queue_files):
+            if files:
+                return self.take(files[0])
+
+        return None
+
+    def take(self, path):
+        key = self.get_key(path)
+
+        if key is not None and key != self.current:
+            if self.current is not None:
+                self.switches += 1
+
+            self.current = key
+            self.batch_size = 0
+
+        self.batch_size += 1
+        self.keys.pop(path, None)
+        self.deferred.pop(path, None)
+
+        # Forget files that left the queue a long time ago
+        if len(self.keys) > self.lookahead * 16:
+            self.keys = {p: k for p, k in self.keys.items() if os.path.exists(p)}
+            self.deferred = {p: t for p, t in self.deferred.items() if os.path.exists(p)}
+
+        return path
@@ -0,0 +1,307 @@
+import os
+import math
+import time
+import sqlite3
+import threading
+
+STATS_DB = "./DATA/stats.sqlite"
+
+# Characters of text in a job, the limits of the small and medium classes
+SIZE_CLASSES = ((2000, "s"), (8000, "m"))
+
+# A worker that didn't write for this long is gone
+WORKER_TTL = 60
+
+TEXT_KEYS = ("article", "prompt", "message", "system", "assistant")
+
+
+def percentile(values, p):
+    """Nearest rank percentile of sorted values."""
+    if not values:
+        return None
+
+    rank = max(1, math.ceil(p / 100 * len(values)))
+    return values[min(rank, len(values)) - 1]
+
+
+def job_size(data):
+    """Characters the model has to read, the article, the prompts or the raw chat."""
+    size = sum(len(data[key]) for key in TEXT_KEYS if isinstance(data.get(key), str))
+
+    for message in data.get("raw_messages") or []:
+        if isinstance(message, dict) and isinstance(message.get("content"), str):
+            size += len(message["content"])
+
+    return size
+
+
+def get_job_class(data, default_model="default"):
+    """type|model|size class of a job, the unit of the queue estimates."""
+    size = job_size(data)
+    size_class = "l"
+    for limit, name in SIZE_CLASSES:
+        if size < limit:
+            size_class = name
+            break
+
+    job_type = data.get("type") or "None"
+    model = data.get("model") or default_model
+    return f"{job_type}|{model}|{size_class}"
+
+
+class StatsStore:
+    """Job times of every worker, in SQLite instead of .stats.json.
+
+    record() only appends to a buffer, a thread writes the buffer in one
+    transaction every flush_interval seconds, so the job never waits on the
+    disk or on another process. Every sample is kept for `retention`
+    seconds under five kinds: all jobs ("all", "job"), per model, per job
+    type, per job class (see get_job_class) and per stage. Percentiles are computed on a rolling window of
+    samples, and an EWMA per kind/key follows the recent trend.
+
+    BEGIN IMMEDIATE takes the write lock before the EWMAs are read, so
+    workers sharing the file don't lose updates.
+
+    The daemons also write a heartbeat with their number of slots, that is
+    how the launcher knows how many workers drain the queue.
+    """
+
+    def __init__(
+        self,
+        db_path=STATS_DB,
+        alpha=0.1,
+        retention=7 * 24 * 3600,
+        flush_interval=5,
+        max_buffer=1000,
+    ):
+        self.alpha = alpha
+        self.retention = retention
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+
+        self.lock = threading.Lock()
+        self.db_lock = threading.Lock()
+        self.buffer = []
+        self.flushes = 0
+        self.flush_thread = None
+        self.stop_event = threading.Event()
+        self.worker_id = None
+        self.slots = 0
+
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+
+        self.db = sqlite3.connect(
+            db_path, timeout=30, check_same_thread=False, isolation_level=None
+        )
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS samples (
+                ts REAL NOT NULL,
+                kind TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS samples_key ON samples (kind, key, ts);
+            CREATE INDEX IF NOT EXISTS samples_ts ON samples (ts);
+
+            CREATE TABLE IF NOT EXISTS ewma (
+                kind TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value REAL NOT NULL,
+                count INTEGER NOT NULL,
+                updated REAL NOT NULL,
+                PRIMARY KEY (kind, key)
+            );
+
+            CREATE TABLE IF NOT EXISTS workers (
+                worker_id TEXT PRIMARY KEY,
+                slots INTEGER NOT NULL,
+                last_seen REAL NOT NULL
+            );
+            """
+        )
+
+    def record(self, elapsed, model=None, job_type=None, stages=None, job_class=None):
+        """Buffer the samples of a finished job, no I/O here."""
+        now = time.time()
+        rows = [(now, "all", "job", elapsed)]
+
+        if model:
+            rows.append((now, "model", str(model), elapsed))
+
+        if job_type:
+            rows.append((now, "type", str(job_type), elapsed))
+
+        if job_class:
+            rows.append((now, "class", str(job_class), elapsed))
+
+        for stage, seconds in (stages or {}).items():
+            rows.append((now, "stage", str(stage), seconds))
+
+        with self.lock:
+            self.buffer.extend(rows)
+            full = len(self.buffer) >= self.max_buffer
+
+        # No flush thread (one shot mode) or a burst, write now
+        if full or not self.flush_thread:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            rows, self.buffer = self.buffer, []
+
+        if not rows:
+            return
+
+        with self.db_lock:
+            try:
+                self.db.execute("BEGIN IMMEDIATE")
+                self.db.executemany(
+                    "INSERT INTO samples (ts, kind, key, value) VALUES (?, ?, ?, ?)", rows
+                )
+
+                self.update_ewma(rows)
+
+                self.flushes += 1
+                if self.flushes % 100 == 1:
+                    self.db.execute(
+                        "DELETE FROM samples WHERE ts < ?", (time.time() - self.retention,)
+                    )
+
+                self.db.execute("COMMIT")
+            except sqlite3.Error:
+                if self.db.in_transaction:
+                    self.db.execute("ROLLBACK")
+
+                # The next flush tries again, a dead disk doesn't eat the memory
+                with self.lock:
+                    self.buffer = (rows + self.buffer)[-self.max_buffer * 10 :]
+
+                raise
+
+    def update_ewma(self, rows):
+        current = {}
+        for kind, key, value, count in self.db.execute(
+            "SELECT kind, key, value, count FROM ewma"
+        ):
+            current[(kind, key)] = (value, count)
+
+        for ts, kind, key, value in rows:
+            if (kind, key) in current:
+                average, count = current[(kind, key)]
+                current[(kind, key)] = (self.alpha * value + (1 - self.alpha) * average, count + 1)
+            else:
+                current[(kind, key)] = (value, 1)
+
+        touched = set((kind, key) for _, kind, key, _ in rows)
+        now = time.time()
+        self.db.executemany(
+            """
+            INSERT INTO ewma (kind, key, value, count, updated) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (kind, key) DO UPDATE SET value = excluded.value,
+                count = excluded.count, updated = excluded.updated
+            """,
+            [(kind, key) + current[(kind, key)] + (now,) for kind, key in touched],
+        )
+
+    def heartbeat(self):
+        if not self.worker_id:
+            return
+
+        with self.db_lock:
+            self.db.execute(
+                """
+                INSERT INTO workers (worker_id, slots, last_seen) VALUES (?, ?, ?)
+                ON CONFLICT (worker_id) DO UPDATE SET slots = excluded.slots,
+                    last_seen = excluded.last_seen
+                """,
+                (self.worker_id, self.slots, time.time()),
+            )
+
+    def flush_loop(self):
+        while not self.stop_event.wait(self.flush_interval):
+            try:
+                self.flush()
+                self.heartbeat()
+            except sqlite3.Error:
+                # Locked for longer than the timeout, the rows are back in the buffer
+                pass
+
+    def start(self, worker_id=None, slots=1):
+        """Flush on a thread, with a worker_id the heartbeat of the worker too."""
+        if self.flush_thread:
+            return
+
+        self.worker_id = worker_id
+        self.slots = slots
+        self.heartbeat()
+
+        self.flush_thread = threading.Thread(target=self.flush_loop, daemon=True)
+        self.flush_thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.flush()
+
+        if self.worker_id:
+            with self.db_lock:
+                self.db.execute("DELETE FROM workers WHERE worker_id = ?", (self.worker_id,))
+
+    def live_workers(self, ttl=WORKER_TTL):
+        """(workers, slots) of the daemons seen in the last `ttl` seconds."""
+        with self.db_lock:
+            row = self.db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(slots), 0) FROM workers WHERE last_seen >= ?",
+                (time.time() - ttl,),
+            ).fetchone()
+
+        return row[0], row[1]
+
+    def ewma(self, kind="all", key="job"):
+        with self.db_lock:
+            row = self.db.execute(
+                "SELECT value FROM ewma WHERE kind = ? AND key = ?", (kind, key)
+            ).fetchone()
+
+        return row[0] if row else None
+
+    def values(self, kind, key, window):
+        with self.db_lock:
+            rows = self.db.execute(
+                "SELECT value FROM samples WHERE kind = ? AND key = ? AND ts >= ? ORDER BY value",
+                (kind, key, time.time() - window),
+            ).fetchall()
+
+        return [row[0] for row in rows]
+
+    def percentiles(self, kind="all", key="job", window=3600, ps=(50, 90, 99)):
+        """Count, mean and percentiles of the last `window` seconds."""
+        values = self.values(kind, key, window)
+
+        ewma = self.ewma(kind, key)
+
+        stats = {"count": len(values), "mean": None, "ewma": round(ewma, 3) if ewma else ewma}
+        if values:
+            stats["mean"] = round(sum(values) / len(values), 3)
+
+        for p in ps:
+            value = percentile(values, p)
+            stats[f"p{p}"] = round(value, 3) if value is not None else None
+
+        return stats
+
+    def summary(self, window=3600, ps=(50, 90, 99)):
+        """percentiles() of every kind and key seen in the window."""
+        with self.db_lock:
+            keys = self.db.execute(
+                "SELECT DISTINCT kind, key FROM samples WHERE ts >= ?",
+                (time.time() - window,),
+            ).fetchall()
+
+        summary = {}
+        for kind, key in keys:
+            summary.setdefault(kind, {})[key] = self.percentiles(kind, key, window, ps)
+
+        return summary
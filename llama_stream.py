@@ -0,0 +1,202 @@
+import os
+import json
+import time
+import asyncio
+
+import httpx
+import ollama
+
+PARTIAL_FOLDER = "./DATA/PARTIAL"
+
+
+class GenerationAborted(TimeoutError):
+    """The generation ran away or stalled, stats has what we got until then."""
+
+    def __init__(self, reason, content, stats):
+        super().__init__(f"Generation aborted: {reason} after {stats.get('tokens', 0)} tokens")
+        self.reason = reason
+        self.content = content
+        self.stats = stats
+
+
+class StreamingChat:
+    """ollama chats with stream=True, so we see the answer while it is written.
+
+    Every chunk is about one token. We record the time to the first token and
+    the tokens per second, and give up on a generation that passes max_tokens
+    or max_seconds instead of waiting for the job timeout. A server that stops
+    sending chunks for stall_timeout seconds is a stalled generation too, the
+    first token counts, so leave room for the prompt evaluation of a big num_ctx.
+
+    With a partial_file the content so far is written there every
+    partial_every seconds, the chat UIs poll it while the job runs.
+
+    achat() is the same on the AsyncClient of the enrichment pipeline, the
+    text stages of an article stream with the same limits.
+    """
+
+    def __init__(
+        self,
+        timeout=300,
+        max_tokens=8192,
+        max_seconds=240,
+        stall_timeout=120,
+        partial_every=0.5,
+    ):
+        self.max_tokens = max_tokens
+        self.max_seconds = max_seconds
+        self.stall_timeout = stall_timeout
+        self.partial_every = partial_every
+
+        # httpx applies the read timeout between chunks, that catches the stalls
+        self.client = ollama.Client(timeout=httpx.Timeout(timeout, read=stall_timeout))
+
+    def write_partial(self, partial_file, content, stats, done=False):
+        if not partial_file:
+            return
+
+        state = dict(stats, content=content, done=done, updated=time.time())
+
+        tmp_file = partial_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(state, f)
+
+        os.replace(tmp_file, partial_file)
+
+    def chat(self, model, messages, options=None, keep_alive=None, partial_file=None):
+        """Returns ({"role", "content"}, stats), raises GenerationAborted."""
+        generation = Generation(self, model, partial_file)
+
+        stream = self.client.chat(
+            model=model,
+            messages=messages,
+            options=options,
+            keep_alive=keep_alive,
+            stream=True,
+        )
+
+        try:
+            for chunk in stream:
+                if generation.add(chunk):
+                    break
+
+        except httpx.TimeoutException:
+            generation.reason = "stalled"
+
+        finally:
+            # Closing the stream drops the connection, Ollama stops generating
+            stream.close()
+
+        return generation.finish()
+
+    async def achat(self, client, model, messages, options=None, keep_alive=None, partial_file=None):
+        """chat() on an ollama.AsyncClient, for the pipeline stages."""
+        generation = Generation(self, model, partial_file)
+
+        stream = await client.chat(
+            model=model,
+            messages=messages,
+            options=options,
+            keep_alive=keep_alive,
+            stream=True,
+        )
+
+        try:
+            while True:
+                # The AsyncClient has the job timeout, the stall is checked here
+                chunk = await asyncio.wait_for(stream.__anext__(), self.stall_timeout)
+                if generation.add(chunk):
+                    break
+
+        except StopAsyncIteration:
+            pass
+
+        except (asyncio.TimeoutError, httpx.TimeoutException):
+            generation.reason = "stalled"
+
+        finally:
+            try:
+                await stream.aclose()
+            except RuntimeError:
+                pass
+
+        return generation.finish()
+
+
+class Generation:
+    """What a streamed chat produced so far, and why it stopped."""
+
+    def __init__(self, streaming, model, partial_file=None):
+        self.streaming = streaming
+        self.partial_file = partial_file
+        self.start = time.time()
+        self.first = None
+        self.last_partial = 0
+        self.tokens = 0
+        self.parts = []
+        self.final = None
+        self.reason = None
+
+        self.stats = {"model": model, "ttft": None, "tokens": 0, "tokens_per_sec": 0, "elapsed": 0}
+
+    def update(self):
+        now = time.time()
+        self.stats["tokens"] = self.tokens
+        self.stats["elapsed"] = round(now - self.start, 2)
+        if self.tokens > 1 and now > self.first:
+            self.stats["tokens_per_sec"] = round((self.tokens - 1) / (now - self.first), 1)
+
+    def add(self, chunk):
+        """Take a chunk, True once the generation is over."""
+        streaming = self.streaming
+
+        text = chunk["message"]["content"] or ""
+        if text:
+            if self.first is None:
+                self.first = time.time()
+                self.stats["ttft"] = round(self.first - self.start, 3)
+
+            self.parts.append(text)
+            self.tokens += 1
+
+        if chunk.get("done"):
+            self.final = chunk
+            return True
+
+        if self.tokens > streaming.max_tokens:
+            self.reason = "max_tokens"
+            return True
+
+        if time.time() - self.start > streaming.max_seconds:
+            self.reason = "max_seconds"
+            return True
+
+        if self.partial_file and time.time() - self.last_partial >= streaming.partial_every:
+            self.update()
+            streaming.write_partial(self.partial_file, "".join(self.parts), self.stats)
+            self.last_partial = time.time()
+
+        return False
+
+    def finish(self):
+        """({"role", "content"}, stats), raises GenerationAborted."""
+        self.update()
+        stats = self.stats
+        content = "".join(self.parts)
+
+        final = self.final
+        if final and final.get("eval_count") and final.get("eval_duration"):
+            # The server count is exact, ours is a chunk count
+            stats["tokens"] = final["eval_count"]
+            stats["prompt_tokens"] = final.get("prompt_eval_count")
+            stats["tokens_per_sec"] = round(
+                final["eval_count"] / (final["eval_duration"] / 1e9), 1
+            )
+
+        if self.reason:
+            stats["aborted"] = self.reason
+            self.streaming.write_partial(self.partial_file, content, stats, done=True)
+            raise GenerationAborted(self.reason, content, stats)
+
+        self.streaming.write_partial(self.partial_file, content, stats, done=True)
+        return {"role": "assistant", "content": content}, stats
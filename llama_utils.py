@@ -0,0 +1,134 @@
+import ast
+import json
+import threading
+
+from colorama import Fore, Back, init
+
+init(autoreset=True)
+
+# Keeps the multi line prints of the pool threads together
+print_lock = threading.RLock()
+
+
+def print_w(text):
+    print(Fore.LIGHTWHITE_EX + text)
+
+
+def print_b(text):
+    print(Fore.LIGHTBLUE_EX + text)
+
+
+def print_g(text, in_place=False):
+    print(Fore.GREEN + text, end="\r" if in_place else "\n", flush=in_place)
+
+
+def print_r(text, in_place=False):
+    print(Fore.RED + text, end="\r" if in_place else "\n", flush=in_place)
+
+
+line_80 = (
+    "--------------------------------------------------------------------------------"
+)
+
+
+def print_h(text):
+    with print_lock:
+        print(Back.GREEN + Fore.BLUE + line_80)
+        print(Back.GREEN + Fore.BLUE + text.center(80))
+        print(Back.GREEN + Fore.BLUE + line_80)
+        print("\n")
+
+
+def print_e(text):
+    with print_lock:
+        print(Back.RED + line_80)
+        print(Back.RED + text.center(80))
+        print(Back.RED + line_80)
+
+
+def print_json(json_in):
+    print_b(json.dumps(json_in, indent=4))
+
+
+def print_exception(err, text=""):
+    import traceback
+
+    with print_lock:
+        print(Fore.RED + str(err))
+        traceback.print_tb(err.__traceback__)
+
+
+def fix_array(company_list):
+    """
+    Checks if the input is a string representation of a list or an actual list.
+    Converts it to a proper Python list if necessary.
+
+    Args:
+        company_list (str or list): The input to be checked and fixed.
+
+    Returns:
+        list: A properly formatted Python list.
+    """
+    if not company_list:
+        return []
+
+    if isinstance(company_list, str):
+        try:
+            # Try to safely evaluate the string as a list
+            parsed_list = ast.literal_eval(company_list)
+            if isinstance(parsed_list, list):
+                return parsed_list
+        except (ValueError, SyntaxError):
+            pass
+        # If parsing fails, wrap the string in a list
+        return [company_list]
+
+    elif isinstance(company_list, list):
+        return company_list
+
+    # If neither, raise an error
+    raise TypeError("Input must be a string or a list.")
+
+
+def fix_nested_lists(data):
+    """
+    Recursively traverses a dictionary and fixes any keys ending with '_list'.
+
+    Args:
+        data (dict): The dictionary to be traversed.
+
+    Returns:
+        dict: The dictionary with fixed list formats.
+    """
+    if isinstance(data, list):
+        for obj in data:
+            fix_nested_lists(obj)
+        return obj
+
+    if isinstance(data, dict):
+        for key, value in data.items():
+            if key.endswith("_list"):
+                data[key] = fix_array(value)
+                continue
+
+            fix_nested_lists(value)
+    return data
+
+
+def json_serialize_toolcall(result):
+
+    serialz = []
+    for tool in result:
+        f = tool["function"]
+        old_format = {
+            "function": {
+                "name": f["name"],
+                "arguments": f["arguments"],
+            }
+        }
+        serialz.append(old_format)
+
+    fix_nested_lists(serialz)
+    dmp = json.dumps(serialz, indent=4)
+
+    return dmp
@@ -0,0 +1,25 @@
+#!/bin/bash
+
+cd "${BASH_SOURCE%/*}"
+
+export LC_ALL=C.UTF-8
+export LANG=C.UTF-8
+
+. .venv/bin/activate
+
+echo "Running uvicorn!"
+export LAUNCHER_PORT=${LAUNCHER_PORT:-5111}
+export LAUNCHER_WORKERS=${LAUNCHER_WORKERS:-4}
+
+while true; do
+    echo " "
+    echo "------------------------------"
+    echo "------------ LAUNCH ----------"
+    echo "------------------------------"
+    echo " "
+
+    uvicorn imgapi_llama_asgi:app --host 0.0.0.0 --port $LAUNCHER_PORT --workers $LAUNCHER_WORKERS --no-access-log
+    sleep 10s
+done
+
+$SHELL
@@ -7,6 +7,6 @@ source .venv/bin/activate
 #export PYTHONPATH=$PYTHONPATH:/home/amcell/LLAMA/llama-agentic-system
 
 while true; do
-    python3 llama_batch_process.py localhost 5000
+    python3 llama_batch_process.py localhost 5000 --daemon
     done
 
@@ -0,0 +1,91 @@
+import os
+import json
+import time
+
+import pytest
+
+import llama_batch_process as worker
+from llama_queue import JobLeases, QueueIndex
+
+
+class FakeDelivery:
+    """Takes the results like CallbackDelivery, without sending them."""
+
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, json_file, data=None):
+        self.submitted.append(json_file)
+
+
+@pytest.fixture(params=[False, True], ids=["noindex", "index"])
+def leases(request, tmp_path, monkeypatch):
+    for folder in worker.PATHS:
+        for name in os.listdir(folder):
+            os.remove(os.path.join(folder, name))
+
+    queue = None
+    if request.param:
+        queue = QueueIndex(
+            str(tmp_path / "queue.sqlite"),
+            [worker.source_folder, worker.priority_folder, worker.failed_folder],
+        )
+
+    leases = JobLeases(worker.processing_folder, "test", queue=queue)
+    monkeypatch.setattr(worker, "QUEUE", queue)
+    monkeypatch.setattr(worker, "LEASES", leases)
+    monkeypatch.setattr(worker, "DELIVERY", None)
+    monkeypatch.setattr(worker, "JOB_STATES", None)
+    monkeypatch.setattr(worker, "SCHEDULER", None)
+    return leases
+
+
+def queue_job(folder, job_id):
+    path = os.path.join(folder, job_id + "_data.json")
+    with open(path, "w") as f:
+        json.dump({"id": job_id}, f)
+
+    if worker.QUEUE:
+        worker.QUEUE.add(path)
+
+    # The queue runs by ctime
+    time.sleep(0.01)
+    return path
+
+
+def test_claim_passes_over_a_job_still_in_processing(leases):
+    queue_job(worker.processing_folder, "x")
+    for job_id in ("x", "y", "z"):
+        queue_job(worker.source_folder, job_id)
+
+    claimed = [worker.claim_next_job() for _ in range(3)]
+
+    assert [os.path.basename(c) if c else c for c in claimed] == [
+        "y_data.json",
+        "z_data.json",
+        False,
+    ]
+    assert os.path.exists(os.path.join(worker.source_folder, "x_data.json"))
+
+
+def test_crash_leaves_the_results_waiting_on_delivery(leases, monkeypatch):
+    delivery = FakeDelivery()
+    monkeypatch.setattr(worker, "DELIVERY", delivery)
+
+    done = worker.api_file_claim(queue_job(worker.source_folder, "a"))
+    worker.thread_state.json_file = done
+    worker.deliver_result(done, {"id": "a"})
+
+    crashed = worker.api_file_claim(queue_job(worker.source_folder, "b"))
+    worker.thread_state.json_file = crashed
+    worker.api_abandon_job(worker.ai_crashed)
+
+    assert delivery.submitted == [done]
+    assert os.path.exists(done)
+    assert os.listdir(worker.ai_crashed) == ["b_data.json"]
+
+
+def test_upload_of_a_file_already_gone(leases):
+    missing = os.path.join(worker.processing_folder, "gone_data.json")
+
+    assert worker.upload_file(missing) is False
@@ -0,0 +1,34 @@
+import os
+import json
+
+import pytest
+
+import llama_ingest
+
+
+def job(job_id, **fields):
+    return dict(
+        {"id": job_id, "callback_url": "http://localhost/cb", "hostname": "test", "type": "article"},
+        **fields,
+    )
+
+
+def test_bulk_repeated_id_keeps_the_first():
+    result = llama_ingest.save_bulk([(job("dup", v=1), None), (job("dup", v=2), None)])
+
+    assert [item["status"] for item in result["items"]] == ["queued", "error"]
+    assert result["items"][1]["error"] == "Duplicate id"
+
+    path = os.path.join(llama_ingest.SAVE_FOLDER, "dup_data.json")
+    with open(path) as f:
+        assert json.load(f)["v"] == 1
+
+    assert not os.path.exists(path + ".tmp")
+    assert llama_ingest.JOB_STATES.get("dup")["state"] == "queued"
+
+
+def test_plain_body_past_the_limit(monkeypatch):
+    monkeypatch.setattr(llama_ingest, "BULK_MAX_BYTES", 10)
+
+    with pytest.raises(llama_ingest.BodyTooLarge):
+        llama_ingest.decompress_body(b'[{"id": "a"}, {"id": "b"}]')
@@ -0,0 +1,35 @@
+import os
+import json
+
+from llama_queue import JobLeases
+
+
+def write(path, data):
+    with open(path, "w") as f:
+        json.dump(data, f)
+
+
+def test_reap_keeps_the_newer_queued_copy(tmp_path):
+    queued = tmp_path / "queue"
+    processing = tmp_path / "processing"
+    queued.mkdir()
+    processing.mkdir()
+
+    # A dead worker's copy without lease, and the job uploaded again meanwhile
+    stale = processing / "job_data.json"
+    write(stale, {"id": "job", "v": 1})
+    os.utime(stale, (0, 0))
+    write(queued / "job_data.json", {"id": "job", "v": 2})
+
+    leases = JobLeases(str(processing), "reaper", lease_ttl=0)
+    requeued = leases.reap(str(queued))
+
+    assert len(requeued) == 1
+    assert os.path.basename(requeued[0]) != "job_data.json"
+    assert os.listdir(processing) == []
+
+    with open(queued / "job_data.json") as f:
+        assert json.load(f)["v"] == 2
+
+    with open(requeued[0]) as f:
+        assert json.load(f)["v"] == 1